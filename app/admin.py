@@ -6,9 +6,13 @@ __license__ = 'MIT'
 import logging
 import traceback
 
+from . import dates
 from . import db
+from . import exception as ex
 from . import fields
 from . import html
+from . import memory as memory_
+from . import profiler
 from . import shared
 from . import task
 from . import text
@@ -22,6 +26,7 @@ l = logging.getLogger(__name__)
 
 
 async def authorize_admin(hd):
+	await shared.principal(hd)
 	if not hd.admin:
 		l.warn(f'User {hd.uid} attempting to be admin:')
 		l.warn('\n'.join(traceback.format_stack()))
@@ -32,9 +37,8 @@ async def authorize_logged_in(hd):
 
 async def authorize_parent_or_admin(hd):
 	person_id = int(hd.payload.get('person_id', hd.task.state.get('person_id', 0)))
-	result = person_id == (await db.get_user_person(hd.dbc, hd.uid))['id'] or \
-		person_id in [c['id'] for c in (await db.get_user_children_ids(hd.dbc, hd.uid))] or \
-		hd.admin
+	p = await shared.principal(hd)
+	result = bool(p and person_id in p.family) or hd.admin
 	if not result:
 		l.warn(f'User {hd.uid} attempting to be family:')
 		l.warn('\n'.join(traceback.format_stack()))
@@ -105,8 +109,12 @@ async def user_detail(hd, reverting = False):
 		if un != hd.task.state['user']['username'] and await db.username_exists(hd.dbc, un):
 			await ws.send_content(hd, 'detail_banner', html.error(text.Valid.username_exists))
 			return # finished
+		if data['timezone'] and not dates.known(data['timezone']):
+			await ws.send_content(hd, 'detail_banner', html.error(text.Valid.timezone))
+			return # finished
 		#else all good, move on!
 		data['active'] = html.checkbox_value(data, 'active')
+		data['timezone'] = data['timezone'] or None # (no preference)
 		await db.update_user(hd.dbc, hd.task.state['user']['id'], fields.USER.keys(), data)
 		await task.finish(hd)
 		await ws.send_content(hd, 'banner', html.info(text.change_detail_success.format(change = f'"{un}"')))
@@ -343,3 +351,22 @@ async def add_user_to_tag(hd):
 	await _remove_or_add_user_to_tag(hd, db.add_user_to_tag, text.added_user_to_tag)
 
 
+@ws.handler(auth_func = authorize_admin)
+async def profile(hd):
+	'''Profile the server (see profiler.py) for payload 'seconds', and send the collapsed stacks back, for download.'''
+	seconds = float(hd.payload.get('seconds', 10))
+	await ws.send_content(hd, 'banner', html.info(text.profiling.format(seconds = seconds)))
+	await ws.send(hd, 'download', filename = 'profile.folded', text = await profiler.profile(seconds))
+
+@ws.handler(auth_func = authorize_admin)
+async def memory(hd):
+	'''Send back, for download, memory accounting of connection state, or, given payload 'trace' ('start', 'snapshot' or 'stop'), a tracemalloc report (see memory.py).'''
+	if command := hd.payload.get('trace'):
+		try:
+			report = await memory_.trace(command)
+		except ex.InvalidInput:
+			await ws.send_content(hd, 'banner', html.error(text.invalid_trace_command.format(command = command)))
+			return
+	else:
+		report = memory_.accounting(hd.rq.app['hds'])
+	await ws.send(hd, 'download', filename = 'memory.txt', text = report)
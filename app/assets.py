@@ -0,0 +1,104 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+try:
+	import brotli # pip install Brotli (optional - without it, there are just .gz siblings)
+except ImportError:
+	brotli = None
+
+from .settings import cache_buster
+
+l = logging.getLogger(__name__)
+
+# Startup "build" of our static assets: each bundle's sources are concatenated, lightly minified, and written (once) under a content-hashed
+# name, with .gz and .br siblings (for nginx's gzip_static/brotli_static), so that browsers can cache them forever - any change is a new name.
+# html gets bundle urls from urls(); until build() has run (or if settings.bundle_assets is off), those are just the source files, as before.
+
+k_static_path = 'static/'
+k_build_path = k_static_path + 'build/'
+k_bundles = {
+	'app.css': ('css/common.css',),
+	'app.js': ('js/basic.js', 'js/ws.js', 'js/persistence.js', 'js/main.js', 'js/admin.js', 'js/submit.js', 'js/player.js', 'js/messages.js', 'js/assignments.js'), # (order matters) TODO: only load admin.js if user is an admin
+}
+k_keep_seconds = 7 * 24 * 3600 # superseded builds are kept this long after they were last current, for pages still open from before a deploy
+
+manifest = {} # bundle name -> url of its current build
+
+k_css_url_rec = re.compile(r'''url\(\s*(['"]?)(?!/|data:|https?:)([^'")]+)\1\s*\)''') # relative url()s
+
+
+def urls(bundle):
+	if url := manifest.get(bundle):
+		return [url]
+	return [f'/{k_static_path}{source}?{cache_buster}' for source in k_bundles[bundle]]
+
+
+def build():
+	'''(Re)build every bundle whose content has changed; fills in `manifest`.'''
+	os.makedirs(k_build_path, exist_ok = True)
+	current = {'manifest.json'}
+	for name, sources in k_bundles.items():
+		stem, ext = os.path.splitext(name)
+		if ext == '.css':
+			content = '\n'.join(_minify_css(_read(source)) for source in sources)
+		else:
+			content = ';\n'.join(_minify_js(_read(source)) for source in sources) # (the ';' in case a file ends without one, and the next starts with, say, a '(')
+		content = content.encode()
+		filename = f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+		fp = k_build_path + filename
+		if not os.path.exists(fp):
+			_write(fp + '.gz', gzip.compress(content, 9, mtime = 0))
+			if brotli:
+				_write(fp + '.br', brotli.compress(content))
+			_write(fp, content) # last - its existence means "all built"
+			l.info(f'built {fp} ({len(content)} bytes)')
+		current.update((filename, filename + '.gz', filename + '.br'))
+		for each in (fp, fp + '.gz', fp + '.br'):
+			try: os.utime(each) # (mtime is "last current", for _prune())
+			except FileNotFoundError: pass
+		manifest[name] = '/' + fp
+	_write(k_build_path + 'manifest.json', json.dumps(manifest, indent = '\t').encode())
+	_prune(current)
+	return manifest
+
+def _read(source):
+	with open(k_static_path + source, encoding = 'utf-8') as f:
+		content = f.read()
+	if source.endswith('.css'): # relative url()s have to be made absolute, as the bundle lives elsewhere
+		base = '/' + k_static_path + os.path.dirname(source) + '/'
+		content = k_css_url_rec.sub(lambda m: f'url({m[1]}{base}{m[2]}{m[1]})', content)
+	return content
+
+def _minify_css(content):
+	content = re.sub(r'/\*.*?\*/', '', content, flags = re.DOTALL) # comments
+	content = re.sub(r'\s+', ' ', content)
+	return re.sub(r' ?([{};,]) ?', r'\1', content).strip() # (not around ':', which is significant in selectors, like "a :hover")
+
+def _minify_js(content):
+	# Conservative (there's no parser here): drops indentation, blank lines and whole-line // comments - except any that close a /* */ block (like persistence.js's toggle trick)
+	lines = (line.strip() for line in content.splitlines())
+	return '\n'.join(line for line in lines if line and not (line.startswith('//') and '*/' not in line))
+
+def _write(fp, content):
+	tmp = f'{fp}.{os.getpid()}.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(content)
+	os.replace(tmp, fp) # atomic; other server processes, starting at the same time, may be writing the same file
+
+def _prune(current):
+	cutoff = time.time() - k_keep_seconds
+	with os.scandir(k_build_path) as it:
+		for entry in it:
+			if entry.name not in current and entry.stat().st_mtime < cutoff:
+				try: os.remove(entry.path)
+				except FileNotFoundError: pass
@@ -21,9 +21,11 @@ l = logging.getLogger(__name__)
 
 
 async def authorize_admin(hd):
+	await shared.principal(hd)
 	return hd.admin
 
 async def authorize_sub_manager(hd):
+	await shared.principal(hd)
 	return hd.sub_manager
 
 async def authorize_logged_in(hd):
@@ -44,6 +46,10 @@ async def main(hd, reverting = False):
 	person_id = hd.payload.get('person_id', 0) if hd.admin else None
 	uid = (await db.get_person_user(hd.dbc, person_id))['id'] if hd.admin and person_id else hd.uid
 
+	if filt == Filter.all and hd.admin:
+		await _stream_assignments_print(hd, uid, subj_id)
+		return # done
+	#else:
 	fs = hd.task.state.get('filtersearch', {})
 	assignments = await db.get_assignments(hd.dbc, uid,
 							like = fs.get('searchtext', ''),
@@ -53,9 +59,29 @@ async def main(hd, reverting = False):
 	subjects = set([html.DropselOption(a['subject_name'], a['subject_id']) for a in assignments])
 	await ws.send_sub_content(hd, 'filter_container', html.assignments_filter(filt, subjects, subj_id))
 
-	tsk = 'show_assignments_print' if filt == Filter.all and hd.admin else 'show_assignments'
 	#WISH (see comment on next line): await ws.send_sub_content(hd, k_assignments_container_id, html.assignments(assignments))
-	await ws.send_content(hd, tsk, html.assignments(assignments)) # TODO would prefer the above ("WISH"), to centralize k_assignments_container_id, but have to refactor the send_content semantics to handle sub_content hide_dialog() behavior....
+	await ws.send_content(hd, 'show_assignments', html.assignments(assignments)) # TODO would prefer the above ("WISH"), to centralize k_assignments_container_id, but have to refactor the send_content semantics to handle sub_content hide_dialog() behavior....
+
+async def _stream_assignments_print(hd, uid, subj_id):
+	# The printable all-weeks view is (potentially) the whole rest of the school year, so it's read, rendered and sent a week at a time: an empty
+	# print page first, then each week appended to it as it's ready.  (The filter bar isn't sent; the print view replaces the whole page anyway.)
+	await ws.send_content(hd, 'show_assignments_print', html.assignments([]))
+	renderer = html.AssignmentsRenderer()
+	week = []
+	dbc = await db.cursor(hd.rq.app['db_connection']) # the stream's own - hd.dbc is used by others (e.g., messages.deliver_message()) during the sends, below
+	try:
+		async for assignment in db.stream_assignments(dbc, uid, Filter.all, subj_id):
+			if week and assignment['week'] != week[0]['week']:
+				await _send_assignments_week(hd, renderer, week)
+				week = []
+			week.append(assignment)
+	finally:
+		await dbc.close()
+	if week:
+		await _send_assignments_week(hd, renderer, week)
+
+async def _send_assignments_week(hd, renderer, assignments):
+	await ws.send(hd, 'append_assignments_print', content = ''.join(element.render() for element in renderer.render(assignments)))
 
 
 @ws.handler(auth_func = authorize_logged_in)
@@ -213,7 +239,7 @@ async def finances(hd, reverting = False):
 		await ws.send_sub_content(hd, 'filter_container', html.financials_mainbar(parents))
 
 	ay = _get_set_state(hd, 'academic_year', (await db.get_academic_years(hd.dbc))[0]['id']) #TODO: use user's school config....
-	guardian_id = int(_get_set_state(hd, 'guardian', (await db.get_user_person(hd.dbc, hd.uid))['id']))
+	guardian_id = int(_get_set_state(hd, 'guardian', (await shared.principal(hd)).person))
 	guardian = await db.get_person(hd.dbc, guardian_id)
 	enrollments = await db.get_family_enrollments(hd.dbc, guardian_id)
 	costs = await db.get_family_costs(hd.dbc, guardian_id)
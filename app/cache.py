@@ -0,0 +1,228 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import logging
+import sys
+import time
+import unittest
+
+from collections import OrderedDict
+
+l = logging.getLogger(__name__)
+
+# In-process caches - one mechanism for all of them (rendered fragments, calendar weeks, user settings...), and, via caches/stats(), one place
+# to see what they all hold.  Keys are tuples, whose leading elements are prefixes (see invalidate_prefix()), like ('week', campus, year, n);
+# tags name the things an entry was derived from, like ('user', uid), so that whoever changes such a thing (usually a db.py write function)
+# can drop everything derived from it, in every cache, with invalidate_tag().
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+#Note the '__main__' at end of this file, which can be used to run from parent dir as:
+#   python -m app.cache
+
+# -----------------------------------------------------------------------------
+
+caches = {} # name -> Cache; every Cache registers itself
+
+_missing = object()
+
+
+class Cache:
+	'''
+	LRU-evicting cache, bounded by entry count and/or by (roughly) bytes, as measured by `sizeof`, with optional TTL expiry.
+	load() is single-flight: concurrent misses on the same key all await the one load, which an invalidation (of that key,
+	by key, prefix or tag) disowns, so that a load racing a change can't cache what it read before the change.
+	'''
+	def __init__(self, name, max_entries = None, max_bytes = None, ttl = None, sizeof = sys.getsizeof):
+		self.name = name
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl # seconds, or None (no expiry)
+		self.sizeof = sizeof
+		self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+		self._entries = OrderedDict() # key -> (value, size, expiry, tags); least-recently-used first
+		self._tags = {} # tag -> keys (of entries and of pending loads) so tagged
+		self._pending = {} # key -> (load task, tags)
+		self._bytes = 0
+		caches[name] = self
+
+	def get(self, key, default = None):
+		if (entry := self._entries.get(key)) is not None:
+			if entry[2] is None or entry[2] > time.monotonic():
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			self._remove(key)
+			self.expirations += 1
+		self.misses += 1
+		return default
+
+	def put(self, key, value, tags = (), ttl = None):
+		if key in self._entries:
+			self._remove(key)
+		ttl = ttl or self.ttl
+		size = self.sizeof(value)
+		self._entries[key] = (value, size, time.monotonic() + ttl if ttl else None, tags)
+		self._bytes += size
+		for tag in tags:
+			self._tags.setdefault(tag, set()).add(key)
+		while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+			self._remove(next(iter(self._entries)))
+			self.evictions += 1
+
+	async def load(self, key, loader, tags = (), ttl = None):
+		'''Return the cached value for `key`, else await `loader()` for it (just once, for all concurrent callers), and cache that.'''
+		if (value := self.get(key, _missing)) is not _missing:
+			return value
+		if pending := self._pending.get(key):
+			return await asyncio.shield(pending[0])
+		job = asyncio.ensure_future(self._load(key, loader, tags, ttl))
+		self._pending[key] = (job, tags)
+		for tag in tags:
+			self._tags.setdefault(tag, set()).add(key)
+		job.add_done_callback(lambda _: self._forget(key, job))
+		return await asyncio.shield(job) # shield: one impatient (disconnecting) caller mustn't cancel the load for the others
+
+	async def _load(self, key, loader, tags, ttl):
+		value = await loader()
+		if (pending := self._pending.get(key)) and pending[0] is asyncio.current_task(): # (else invalidated meanwhile)
+			self.put(key, value, tags, ttl)
+		return value
+
+	def _forget(self, key, job):
+		if (pending := self._pending.get(key)) and pending[0] is job:
+			del self._pending[key]
+			if key not in self._entries: # (else its tags are the entry's, now)
+				self._untag(key, pending[1])
+
+	def invalidate(self, key):
+		self._drop((key,))
+
+	def invalidate_prefix(self, prefix):
+		n = len(prefix)
+		self._drop([key for key in (*self._entries, *self._pending) if key[:n] == prefix])
+
+	def invalidate_tag(self, tag):
+		self._drop(list(self._tags.get(tag, ())))
+
+	def clear(self):
+		self._drop(list(self._entries) + list(self._pending))
+
+	def stats(self):
+		return dict(hits = self.hits, misses = self.misses, evictions = self.evictions, expirations = self.expirations, invalidations = self.invalidations, entries = len(self._entries), bytes = self._bytes)
+
+	def _drop(self, keys):
+		for key in keys:
+			if key in self._entries:
+				self._remove(key)
+				self.invalidations += 1
+			if pending := self._pending.pop(key, None): # (the load carries on, for its callers, but won't cache its result)
+				self._untag(key, pending[1])
+
+	def _remove(self, key):
+		_, size, _, tags = self._entries.pop(key)
+		self._bytes -= size
+		if key not in self._pending:
+			self._untag(key, tags)
+
+	def _untag(self, key, tags):
+		for tag in tags:
+			if keys := self._tags.get(tag):
+				keys.discard(key)
+				if not keys:
+					del self._tags[tag]
+
+
+def invalidate_tag(*tags):
+	'''Drop everything derived from any of `tags`, in every cache.'''
+	for cache in caches.values():
+		for tag in tags:
+			cache.invalidate_tag(tag)
+
+def stats():
+	return dict((name, cache.stats()) for name, cache in caches.items())
+
+
+# Tests -----------------------------------------------------------------------
+
+def _test_cache(**kwargs):
+	cache = Cache('_test', **kwargs)
+	del caches['_test']
+	return cache
+
+@addtest()
+def test_lru(self):
+	c = _test_cache(max_entries = 2)
+	c.put(('a',), 1)
+	c.put(('b',), 2)
+	self.assertEqual(c.get(('a',)), 1) # ('b') is now least-recently used...
+	c.put(('c',), 3)
+	self.assertIsNone(c.get(('b',))) # ...so it went
+	self.assertEqual((c.get(('a',)), c.get(('c',))), (1, 3))
+	self.assertEqual(c.stats()['evictions'], 1)
+	c = _test_cache(max_bytes = 10, sizeof = len)
+	c.put(('a',), 'x' * 6)
+	c.put(('b',), 'y' * 6)
+	self.assertEqual((c.get(('a',)), c.stats()['bytes']), (None, 6))
+
+@addtest()
+def test_ttl(self):
+	c = _test_cache(ttl = 60)
+	c.put(('a',), 1)
+	c.put(('b',), 2, ttl = 0.01)
+	time.sleep(0.02)
+	self.assertEqual((c.get(('a',)), c.get(('b',))), (1, None))
+	self.assertEqual(c.stats()['expirations'], 1)
+
+@addtest()
+def test_invalidation(self):
+	c = _test_cache()
+	c.put(('week', 1, 1), 'w1', tags = ('calendar',))
+	c.put(('week', 1, 2), 'w2', tags = ('calendar',))
+	c.put(('weeks', 1), 2)
+	c.put(('color', 7), 'red', tags = (('user', 7),))
+	c.invalidate_prefix(('week', 1))
+	self.assertEqual([c.get(k) for k in (('week', 1, 1), ('week', 1, 2), ('weeks', 1))], [None, None, 2])
+	caches['_test'] = c
+	try: invalidate_tag(('user', 7))
+	finally: del caches['_test']
+	self.assertIsNone(c.get(('color', 7)))
+	self.assertEqual(c._tags, {}) # (nothing left behind)
+
+@addtest()
+def test_load(self):
+	c = _test_cache()
+	calls = []
+	async def loader():
+		calls.append(1)
+		await asyncio.sleep(0.01)
+		return len(calls)
+	async def run():
+		self.assertEqual(await asyncio.gather(*[c.load(('k',), loader) for _ in range(5)]), [1] * 5) # single-flight...
+		self.assertEqual(await c.load(('k',), loader), 1) # ...and cached
+		c.invalidate(('k',))
+		job = asyncio.ensure_future(c.load(('k',), loader, tags = ('t',)))
+		await asyncio.sleep(0)
+		c.invalidate_tag('t') # mid-load - the load completes, for its caller...
+		self.assertEqual(await job, 2)
+		self.assertIsNone(c.get(('k',))) # ...but isn't cached
+		self.assertEqual(await c.load(('k',), loader, tags = ('t',)), 3)
+		c.invalidate_tag('t')
+		self.assertIsNone(c.get(('k',)))
+	asyncio.run(run())
+	self.assertEqual(len(calls), 3)
+	self.assertEqual(c._tags, {})
+
+
+if __name__ == '__main__':
+	unittests()
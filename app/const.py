@@ -6,9 +6,22 @@ k_pdf_formats = ('.pdf', )
 k_thumbnail_size = 300
 k_reduced_image_size = 1800
 k_reduced_video_size = 1200
+k_image_widths = (320, 640, 1200, 1800) # srcset ladder of derivative widths, for each uploaded image; generated on demand, so widths can be added here at any time
+k_webp_quality = 80
+k_jpeg_quality = 82
+k_thumbnail_sizes = '(max-width: 600px) 45vw, 300px' # `sizes` for thumbnail_strip images (matches .thumbnail_strip img max-width in common.css)
+k_pdf_page_width = 1200 # PDF page-viewer previews (see media.render_pdf_page())
+k_pdf_max_dpi = 150 # ...but never rasterize past this, however small the page
+k_pdf_timeout = 60 # seconds, per poppler call
 k_thumb_appendix = '.small.jpg'
+k_thumb_version = 1 # bump after regenerating the (upload-time) thumbnails, so that browsers - which otherwise cache them forever - refetch (see media.thumb_url())
+k_derivative_version = 1 # bump whenever media's derivative output changes (widths aside - those are in the names); makes new urls and new cache keys, so derivatives are regenerated and refetched
+k_hls_appendix = '.hls' # directory, beside a video, of its HLS packaging (see settings.hls_videos)
+k_hls_renditions = ((1200, '2500k', '128k'), (480, '600k', '64k')) # (max dimension, video bitrate, audio bitrate)
+k_hls_segment_seconds = 4
 k_orig_appendix = '.orig.'
 k_upload_path = 'static/uploads/'
+k_media_cache_path = k_upload_path + 'cache/' # on-demand derivatives (see media.DerivativeCache)
 k_video_overlay = 'static/overlay.png'
 #!!k_landscape_video_overlay = 'static/landscape_overlay.png'
 #!!k_portrait_video_overlay = 'static/portrait_overlay.png'
@@ -0,0 +1,211 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import logging
+import unittest
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, date, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from . import text
+
+l = logging.getLogger(__name__)
+
+# Local dates - db timestamps (UTC, with a trailing 'Z'; see db.k_now) converted to, and formatted in, a user's timezone, so that "today"
+# and "yesterday" mean what they do to that user, not to UTC or to the server.  There's one LocalDates per timezone (see of()), shared by
+# all of its users; each connection carries its user's (main.Hd.local_dates) and makes it current() while handling that connection's messages,
+# so html's date formatting needn't be handed one.
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+#Note the '__main__' at end of this file, which can be used to run from parent dir as:
+#   python -m app.dates
+
+# -----------------------------------------------------------------------------
+
+k_default_tz = 'America/Los_Angeles' # for users (and browsers) that haven't told us theirs, and for anything done outside of any user's context (like finding the current academic week)
+k_max_memo = 4096 # casual2() results kept per timezone (per day)
+
+_parse = lru_cache(maxsize = k_max_memo)(datetime.fromisoformat) # the same few timestamps (message 'sent's, week start dates...) come by again and again
+
+
+class LocalDates:
+	'''
+	Conversions and casual formats for one timezone.  The day boundaries ("today", "yesterday") are computed once per
+	local day, rather than once per timestamp, as are casual2() results, which depend only on the (local) day.
+	'''
+	def __init__(self, name):
+		self.name = name
+		self.zone = ZoneInfo(name)
+		self._tomorrow = None # start of the next local day, when everything below goes stale
+		self._today = self._yesterday = None
+		self._casual2 = {} # raw date -> casual2() result
+
+	def _roll(self, now):
+		if self._tomorrow is None or now >= self._tomorrow:
+			day = now.date()
+			self._today = datetime.combine(day, time(), self.zone)
+			self._yesterday = datetime.combine(day - timedelta(days = 1), time(), self.zone)
+			self._tomorrow = datetime.combine(day + timedelta(days = 1), time(), self.zone)
+			self._casual2.clear()
+
+	def today(self):
+		self._roll(datetime.now(self.zone))
+		return self._today.date()
+
+	def local(self, raw):
+		'''`raw` - a db timestamp string, or a datetime or date - as an aware datetime in this timezone; naive values (like calendar dates) are taken to be local already.'''
+		if isinstance(raw, str):
+			raw = _parse(raw)
+		elif not isinstance(raw, datetime): # a date
+			return datetime.combine(raw, time(), self.zone)
+		if raw.tzinfo is None:
+			return raw.replace(tzinfo = self.zone)
+		return raw if raw.tzinfo is self.zone else raw.astimezone(self.zone)
+
+	def localize(self, rows, *fields):
+		'''Batch local(): replace `fields` of each of `rows` (in place) with local datetimes, converting each distinct value just once; returns `rows`.'''
+		done = {}
+		for row in rows:
+			for field in fields:
+				if raw := row[field]:
+					if (dt := done.get(raw)) is None:
+						dt = done[raw] = self.local(raw)
+					row[field] = dt
+		return rows
+
+	def iso(self, raw):
+		'''Naive local iso format - what javascript (see messages.js) interprets as "local".'''
+		return self.local(raw).replace(tzinfo = None).isoformat()
+
+	def casual(self, raw): # NOTE: we have an equivalent version of this in Javascript, client-side, in order to update periodically.
+		dt = self.local(raw)
+		diff = datetime.now(timezone.utc) - dt # (differing tzinfos, so this is a true, UTC, difference, even across a DST change)
+		self._roll(datetime.now(self.zone))
+		if diff < timedelta(hours = 1): # within the last hour
+			if diff.seconds < 2:
+				return 'just now'
+			elif diff.seconds < 60:
+				return f"{diff.seconds} seconds ago"
+			else:
+				return f"{diff.seconds // 60} minutes ago"
+		elif dt >= self._today: # earlier today
+			return dt.strftime('%I:%M %p')
+		elif self._yesterday < dt: # yesterday
+			return f"yesterday @ {dt.strftime('%I:%M %p')}"
+		else: # before yesterday
+			return dt.strftime('%m/%d/%Y')
+
+	def casual2(self, raw):
+		self._roll(datetime.now(self.zone))
+		if (result := self._casual2.get(raw)) is None:
+			dt = self.local(raw)
+			if dt.date() == self._today.date():
+				result = text.today
+			elif dt.year == self._today.year:
+				result = dt.strftime('%b %d')
+			else:
+				result = dt.strftime('%m/%d/%Y')
+			if len(self._casual2) >= k_max_memo:
+				self._casual2.clear()
+			self._casual2[raw] = result
+		return result
+
+
+@lru_cache(maxsize = 64) # (names come from browsers, too, so keep it bounded)
+def of(name):
+	'''The (shared) LocalDates for timezone `name`, or the default's, if `name` is empty or unknown.'''
+	if name:
+		try:
+			return LocalDates(name)
+		except (ValueError, KeyError): # (ZoneInfoNotFoundError is a KeyError; malformed names are ValueErrors)
+			l.warning(f'Unknown timezone "{name}"; using {k_default_tz}')
+	return default()
+
+def known(name):
+	'''True if `name` is a timezone we know (as opposed to one that of() would replace with the default).'''
+	return of(name).name == name
+
+@lru_cache(maxsize = 1)
+def default():
+	return LocalDates(k_default_tz)
+
+
+_current = ContextVar('local_dates', default = None)
+
+def current():
+	return _current.get() or default()
+
+def use(local_dates):
+	'''Make `local_dates` current(), for the rest of this task (e.g., one connection's websocket loop).'''
+	return _current.set(local_dates)
+
+@contextmanager
+def using(local_dates):
+	'''Make `local_dates` current() just within the block - e.g., to render for some other connection than the one being handled.'''
+	token = _current.set(local_dates)
+	try:
+		yield local_dates
+	finally:
+		_current.reset(token)
+
+
+# Tests -----------------------------------------------------------------------
+
+@addtest()
+def test_local(self):
+	ld = of('America/New_York')
+	self.assertEqual(ld.iso('2024-01-01 05:30:00Z'), '2024-01-01T00:30:00')
+	self.assertEqual(ld.iso('2024-07-01 05:30:00Z'), '2024-07-01T01:30:00') # (DST)
+	self.assertEqual(ld.iso(date(2024, 3, 10)), '2024-03-10T00:00:00') # calendar dates stay put
+	self.assertEqual(ld.iso('2024-03-10'), '2024-03-10T00:00:00')
+	self.assertIs(of('Nowhere/Special'), default())
+	self.assertIs(of(None), default())
+	self.assertIs(of('America/New_York'), ld)
+	self.assertTrue(known('America/New_York'))
+	self.assertFalse(known('Nowhere/Special'))
+
+@addtest()
+def test_localize(self):
+	ld = of('Asia/Tokyo')
+	rows = [dict(sent = '2024-01-01 20:00:00Z'), dict(sent = '2024-01-01 20:00:00Z'), dict(sent = None)]
+	ld.localize(rows, 'sent')
+	self.assertEqual(rows[0]['sent'], datetime(2024, 1, 2, 5, tzinfo = ld.zone))
+	self.assertIs(rows[0]['sent'], rows[1]['sent']) # (converted just once)
+	self.assertIsNone(rows[2]['sent'])
+	self.assertEqual(of('UTC').iso(rows[0]['sent']), '2024-01-01T20:00:00') # already-converted values convert again, to any other zone
+
+@addtest()
+def test_casual(self):
+	ld = of('Pacific/Auckland')
+	now = datetime.now(timezone.utc)
+	self.assertEqual(ld.casual(now), 'just now')
+	self.assertEqual(ld.casual(now - timedelta(minutes = 5)), '5 minutes ago')
+	self.assertEqual(ld.casual('2001-02-03 04:05:06Z'), '02/03/2001')
+	self.assertEqual(ld.casual2(now), text.today)
+	self.assertEqual(ld.casual2(date(2001, 2, 3)), '02/03/2001')
+	self.assertEqual(ld.casual2(date(2001, 2, 3)), '02/03/2001') # (memoized)
+
+@addtest()
+def test_current(self):
+	self.assertIs(current(), default())
+	ny = of('America/New_York')
+	with using(ny):
+		self.assertIs(current(), ny)
+	self.assertIs(current(), default())
+
+
+if __name__ == '__main__':
+	unittests()
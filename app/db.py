@@ -3,12 +3,14 @@ __copyright__ = '2024'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+import asyncio
 import logging
 import random
 import re
 import string
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field as dataclass_field
 from datetime import datetime, date, timedelta
 from enum import Enum
@@ -19,12 +21,18 @@ from uuid import uuid4
 import aiosqlite
 import bcrypt # cf https://security.stackexchange.com/questions/133239/what-is-the-specific-reason-to-prefer-bcrypt-or-pbkdf2-over-sha256-crypt-in-pass
 	# pip install bcrypt
+import regex # for k_url_re's recursion
 from sqlite3 import PARSE_DECLTYPES, IntegrityError, Error as SQL_Error
 
+from . import cache
+from . import dates
 from . import exception as ex
+from . import metrics
 from . import messages_const
 from . import assignments_const
 
+from .const import k_url_re, k_url_replacement
+
 l = logging.getLogger(__name__)
 
 # Unit testing suite/setup ----------------------------------------------------
@@ -50,6 +58,23 @@ k_now = f"strftime('{k_datetime_format}')" # could use datetime('now'), but that
 k_default_resultset_limit = 10
 k_assignment_resultset_limit = 50
 
+k_cache_entries = 4096 # cap on (small) query results held in memory (see _cache)
+k_cache_ttl = 3600 # seconds; the backstop for changes made other than by this module's write functions (which invalidate, see _changed()) - e.g., to academic_calendar, by hand
+
+_cache = cache.Cache('db', max_entries = k_cache_entries, ttl = k_cache_ttl)
+_changed = cache.invalidate_tag # (call AFTER the write - see cache.Cache.load())
+
+k_hash_threads = 2 # bcrypt hashings/checks (~100-300ms of CPU, each) run at once, off the event loop; more wait their turn (see _hashing())
+k_login_attempts = 5 # failed logins allowed per client (idid), and per username, within...
+k_login_window = 300 # ...this many seconds of the last one, before login() refuses (see ex.Throttled) without even checking
+
+_hash_pool = ThreadPoolExecutor(max_workers = k_hash_threads, thread_name_prefix = 'bcrypt')
+_hash_jobs = 0 # submitted to _hash_pool and not yet done (see hash_stats())
+_touches = {} # idid -> touch_timestamp, not yet written (see flush_touches())
+_login_failures = cache.Cache('login_failures', max_entries = 100000, ttl = k_login_window) # ('idid', idid) or ('username', username) -> count
+
+k_render_version = 1 # bump whenever render_message() changes; stored renderings of older versions are then re-rendered lazily, on read (see _render_stale()), or ahead of time by periodic_message_renderer
+
 k_campus = 2 # TODO: kludge!
 k_academic_year = 6 # TODO: KLUDGE!
 
@@ -66,7 +91,13 @@ async def connect(filename):
 	return result
 
 async def cursor(connection):
-	return await connection.cursor()
+	return _TimedCursor(connection, (await connection.cursor())._cursor)
+
+class _TimedCursor(aiosqlite.Cursor):
+	'''A cursor that counts the time it spends in the db toward the current ws.handler invocation (see metrics.invocation()).'''
+	async def _execute(self, fn, *args, **kwargs): # (every execute and fetch goes through this)
+		with metrics.spending('db'):
+			return await super()._execute(fn, *args, **kwargs)
 
 
 async def test_fetch(dbc, pattern):
@@ -93,27 +124,109 @@ class Week:
 	is_default_current: bool
 async def get_week(dbc, week_number = None, campus_id = k_campus, academic_year_id = k_academic_year):
 	if not week_number:
-		nowish = datetime.utcnow() - timedelta(hours = 4) # TODO: this would be 8PM before midnight of the changeover, but since we don't have timezones worked out aright, yet, this is about midnight, since UTC is +8 over Pacific time... kludge...
-		w = await _fetch1(dbc, f'select week, date from academic_calendar where date <= ? and campus = ? and academic_year = ? order by date desc limit 1', (nowish.strftime(k_date_format), campus_id, academic_year_id))
+		today = dates.default().today() # the campus's today (not the user's); the week changes over at local midnight
+		return await _cache.load(('week', campus_id, academic_year_id, None, today), lambda: _get_week(dbc, None, campus_id, academic_year_id, today), ('calendar',))
+	return await _cache.load(('week', campus_id, academic_year_id, week_number), lambda: _get_week(dbc, week_number, campus_id, academic_year_id), ('calendar',))
+async def _get_week(dbc, week_number, campus_id, academic_year_id, today = None):
+	if not week_number:
+		w = await _fetch1(dbc, f'select week, date from academic_calendar where date <= ? and campus = ? and academic_year = ? order by date desc limit 1', (today.strftime(k_date_format), campus_id, academic_year_id))
 	else:
 		w = await _fetch1(dbc, f'select week, date from academic_calendar where week = ? and campus = ? and academic_year = ?', (week_number, campus_id, academic_year_id))
 	d = datetime.strptime(w['date'], k_date_format)
 	return Week(w['week'], d, d + timedelta(days = 7), week_number == None)
 async def get_weeks(dbc, campus_id = k_campus, academic_year_id = k_academic_year):
-	w = await _fetch1(dbc, f'select week from academic_calendar where campus = ? and academic_year = ? order by date desc limit 1', (campus_id, academic_year_id))
-	return w['week']
+	async def load():
+		w = await _fetch1(dbc, f'select week from academic_calendar where campus = ? and academic_year = ? order by date desc limit 1', (campus_id, academic_year_id))
+		return w['week']
+	return await _cache.load(('weeks', campus_id, academic_year_id), load, ('calendar',))
 
 async def add_idid_key(dbc, idid, key):
 	r = await dbc.execute(f'insert into id_key (idid, key, login_timestamp) values (?, ?, {k_now})', (idid, key))
+	_changed(('id_key', idid))
 	return r.lastrowid
 
 async def get_user_by_id_key(dbc, idid, pub, hsh):
-	r = await _fetch1(dbc, f'select key, user from id_key join user on user.id = id_key.user where id_key.idid = ? and user.active = 1', (idid,))
-	if not r:
+	'''
+	Served from cache - the id_key row, and the user's Principal (for `active`) - since this is called on every (re)connect of every tab;
+	the touch_timestamp is likewise just noted, here, and written later, with others, in one batch (see flush_touches()).
+	'''
+	r = await _cache.load(('id_key', idid), lambda: _fetch1(dbc, 'select key, user from id_key where idid = ?', (idid,)), (('id_key', idid),))
+	if not r or not r['user'] or not (p := await get_principal(dbc, r['user'])) or not p.active:
 		return None # not found (id-key doesn't exist or user is (now) inactive); new idid-key pair is going to be needed (see add_idid_key())  NOTE: inactive user is an exception, and a potential point of confusion, but essential to security; must be able to deactivate a user, as an admin, for example, to disable login/auto-login and activity
-	await _update1(dbc, f'update id_key set touch_timestamp = {k_now} where idid = ?', (idid,))
 	hsh2 = sha256(r['key'].encode("utf-8") + pub.encode("utf-8")).hexdigest()
-	return r['user'] if hsh2 == hsh else None
+	if hsh2 != hsh:
+		return None
+	_touches[idid] = datetime.utcnow().strftime(k_datetime_format)
+	return r['user']
+
+async def flush_touches(dbc):
+	'''Write the touch_timestamps noted (by get_user_by_id_key()) since the last flush, in one batch.'''
+	if not _touches:
+		return
+	rows = [(timestamp, idid) for idid, timestamp in _touches.items()]
+	_touches.clear()
+	try:
+		await dbc.executemany('update id_key set touch_timestamp = ? where idid = ?', rows)
+	except:
+		for timestamp, idid in rows:
+			_touches.setdefault(idid, timestamp) # (try again next time)
+		raise
+
+async def _id_key_tags(dbc, where, args):
+	'''Cache tags of the id_keys `where` - to _changed(), after changing (deleting) them.'''
+	return [('id_key', r['idid']) for r in await _fetchall(dbc, f'select idid from id_key where {where}', args)]
+
+k_session_table = 'session (idid TEXT NOT NULL, page_id TEXT NOT NULL, snapshot TEXT NOT NULL, saved TEXT NOT NULL, PRIMARY KEY (idid, page_id))' # (also in um.sql)
+
+async def init_sessions(dbc):
+	await dbc.execute(f'create table if not exists {k_session_table}')
+
+k_added_columns = { # table -> ((column, type)...) added since databases were first created (also in um.sql); see migrate()
+	'user': (('timezone', 'TEXT'),), # see get_principal()
+	'message': (('rendered', 'TEXT'), ('rendered_version', 'INTEGER')), # see _mega_message_select() and _render_stale() (and periodic_message_renderer, to backfill)
+}
+
+async def migrate(dbc):
+	'''Add any k_added_columns that an older database lacks; idempotent, so run at every startup (see main._init_db()).'''
+	for table, columns in k_added_columns.items():
+		existing = [r['name'] for r in await _fetchall(dbc, f'pragma table_info({table})')]
+		for column, type_ in columns:
+			if column not in existing:
+				l.info(f'...adding column {table}.{column}...')
+				await dbc.execute(f'alter table {table} add column {column} {type_}')
+
+@addtest()
+def test_migrate(self):
+	async def run():
+		connection = await connect(':memory:')
+		try:
+			for table in k_added_columns:
+				await connection.execute(f'create table {table} (id INTEGER PRIMARY KEY)') # (an "old" database)
+			await migrate(connection)
+			await migrate(connection) # (idempotent)
+			for table, columns in k_added_columns.items():
+				self.assertEqual([r['name'] for r in await _fetchall(connection, f'pragma table_info({table})')], ['id'] + [c for c, _ in columns])
+		finally:
+			await connection.close()
+	asyncio.run(run())
+
+async def save_sessions(dbc, snapshots, max_age):
+	'''`snapshots` maps (idid, page_id) to snapshot text, or to None, to delete; snapshots older than `max_age` seconds are deleted, too.'''
+	try:
+		await begin(dbc)
+		await dbc.executemany(f'insert into session (idid, page_id, snapshot, saved) values (?, ?, ?, {k_now}) on conflict (idid, page_id) do update set snapshot = excluded.snapshot, saved = excluded.saved',
+			[(idid, page_id, s) for (idid, page_id), s in snapshots.items() if s is not None])
+		await dbc.executemany('delete from session where idid = ? and page_id = ?', [key for key, s in snapshots.items() if s is None])
+		await dbc.execute('delete from session where saved < ?', (_ago(max_age),))
+		await commit(dbc)
+	except SQL_Error:
+		await rollback(dbc)
+		raise
+
+async def take_session(dbc, idid, page_id, max_age):
+	r = await _fetch1(dbc, 'select snapshot from session where idid = ? and page_id = ? and saved >= ?', (idid, page_id, _ago(max_age)))
+	await dbc.execute('delete from session where idid = ? and page_id = ?', (idid, page_id))
+	return r['snapshot'] if r else None
 
 async def add_person(dbc, first_name, last_name):
 	r = await dbc.execute('insert into person (first_name, last_name) values (?, ?)', (first_name, last_name))
@@ -168,6 +281,7 @@ async def add_child(dbc, guardian_person_id, first_name, last_name, birth_date):
 		id = await _insert1(dbc, 'insert into person (first_name, last_name, birth_date) values (?, ?, ?)', (first_name, last_name, birth_date))
 		await _insert1(dbc, 'insert into child_guardian (child, guardian) values (?, ?)', (id, guardian_person_id))
 		await commit(dbc)
+		await _family_changed(dbc, guardian_person_id)
 		return id
 	except:
 		await rollback(dbc)
@@ -193,6 +307,11 @@ async def get_user_children_ids(dbc, user_id):
 
 async def orphan_child(dbc, child_person_id, guardian_person_id): # i.e., "delete" child from family (but don't delete the base child record)
 	await dbc.execute('delete from child_guardian where child = ? and guardian = ?', (child_person_id, guardian_person_id))
+	await _family_changed(dbc, guardian_person_id)
+
+async def _family_changed(dbc, guardian_person_id):
+	if r := await get_person_user(dbc, guardian_person_id): # (the guardian's Principal.children)
+		_changed(('user', r['id']))
 
 
 async def get_person_spouse(dbc, person_id):
@@ -253,13 +372,16 @@ async def add_user(dbc, person_id, username):
 	try:
 		# Note that user is inactive until reset_user_password() completes, and activates (inactive until password is set, that is)
 		r = await dbc.execute(f'insert into user (username, person, created, active) values (?, ?, {k_now}, 0)', (username, person_id,)) # NOTE: this TRIGGERs (SQL) to insert new tag (user's own tag) and that, in turn, TRIGGERs an insert into user_tag
+		_changed(('user', r.lastrowid)) # (in case the id is a re-used one)
 		return r.lastrowid
 	except IntegrityError:
 		raise ex.AlreadyExists() # should be rare if username_exists() is used properly, but there's still a chance
 
 async def update_user(dbc, id, fields, data):
-	return await _update1(dbc, f"update user set {', '.join([f'{name} = ?' for name in fields])} where id = ?",
+	r = await _update1(dbc, f"update user set {', '.join([f'{name} = ?' for name in fields])} where id = ?",
 							  [data[name] for name in fields] + [id,])
+	_changed(('user', id))
+	return r
 
 async def get_users(dbc, active = True, persons = True, like = None, limit = k_default_resultset_limit):
 	where = []
@@ -287,6 +409,15 @@ async def verify_new_user(dbc, username):
 	return await _update1(dbc, f'update user set verified = {k_now} where username = ? and active = 1', (username,))
 
 async def login(dbc, idid, username, password):
+	'''
+	Raises ex.Throttled if the client or the username has failed too often, lately (see k_login_attempts).  Each attempt counts as a failure
+	until it succeeds, so that a burst of concurrent attempts, too, gets no more than k_login_attempts password checks.
+	'''
+	keys = (('idid', idid), ('username', username.lower()))
+	if any(_login_failures.get(key, 0) >= k_login_attempts for key in keys):
+		raise ex.Throttled()
+	for key in keys:
+		_login_failures.put(key, _login_failures.get(key, 0) + 1)
 	if password: # password is required!
 		r = await _fetch1(dbc, 'select id, password from user where username = ? COLLATE NOCASE and active = 1', (username,))
 		id = r['id'] if r else None
@@ -294,8 +425,10 @@ async def login(dbc, idid, username, password):
 			# Try email:
 			id = await get_user_id_by_email(dbc, username)
 			r = await _fetch1(dbc, 'select password from user where id = ? and active = 1', (id,))
-		if r and bcrypt.checkpw(password.encode(), r['password']):
+		if r and await _hashing(bcrypt.checkpw, password.encode(), r['password']):
 			if await _login(dbc, idid, id):
+				for key in keys:
+					_login_failures.invalidate(key)
 				return id
 	#else...
 	return None
@@ -307,19 +440,53 @@ async def force_login(dbc, idid, user_id):
 	#else...
 	return None
 
+@dataclass(slots = True, frozen = True)
+class Principal:
+	'''Who a user is, for authorization (and a couple of settings) - loaded in one query, and cached; see get_principal().'''
+	uid: int
+	person: int
+	roles: frozenset # role names, like 'admin'
+	children: frozenset # person ids
+	tags: frozenset # tag ids (subscriptions)
+	color: str | None
+	timezone: str | None
+	active: bool
+
+	@property
+	def family(self):
+		'''Person ids of the user and of the user's children - the persons whose details the user may manage.'''
+		return self.children | {self.person}
+
+async def get_principal(dbc, uid):
+	'''The user's Principal (None if there's no such user), cached until a change to the user's roles, tags, family or settings (see _changed() calls).'''
+	return await _cache.load(('principal', uid), lambda: _get_principal(dbc, uid), (('user', uid),))
+
+async def _get_principal(dbc, uid):
+	r = await _fetch1(dbc, '''select user.person, user.color, user.timezone, user.active,
+		(select group_concat(role.name, char(31)) from user_role join role on role.id = user_role.role where user_role.user = user.id) as roles,
+		(select group_concat(child) from child_guardian where guardian = user.person) as children,
+		(select group_concat(tag) from user_tag where user_tag.user = user.id) as tags
+		from user where user.id = ?''', (uid,))
+	if not r:
+		return None
+	ids = lambda s: frozenset(int(id) for id in s.split(',')) if s else frozenset()
+	return Principal(uid, r['person'], frozenset(r['roles'].split('\x1f')) if r['roles'] else frozenset(), ids(r['children']), ids(r['tags']), r['color'], r['timezone'], bool(r['active']))
+
 async def authorized(dbc, uid, role):
 	if uid == None:
 		raise Exception()
-	result = await _fetch1(dbc, 'select 1 from role join user_role on role.id = user_role.role join user on user.id = user_role.user where user.id = ? and role.name = ?', (uid, role))
-	return bool(result)
+	p = await get_principal(dbc, uid)
+	return bool(p and role in p.roles)
 
 async def authorized_roles(dbc, uid, roles):
-	users_roles = await _fetchall(dbc, 'select role.name from role join user_role on role.id = user_role.role join user on user.id = user_role.user where user.id = ?', (uid,))
-	return bool(set([role['name'] for role in users_roles]).intersection(roles))
+	p = await get_principal(dbc, uid)
+	return bool(p and p.roles.intersection(roles))
 
 async def logout(dbc, uid):
 	if type(uid) == int:
+		tags = await _id_key_tags(dbc, 'user = ?', (uid,))
 		await dbc.execute('delete from id_key where user = ?', (uid,))
+		_changed(*tags)
 
 async def get_username(dbc, idid):
 	r = await _fetch1(dbc, 'select username from user join id_key on user.id = id_key.user where id_key.idid = ?', (idid,))
@@ -361,20 +528,50 @@ async def get_user_id_by_reset_code(dbc, code):
 		return r['user']
 	return None
 
-async def reset_user_password(dbc, uid, new_password):
+async def reset_user_password(dbc, uid, new_password, idid = None):
 	# note that this re-activates a de-activated user (see deactivate_user())
 	# TODO: consider: this is a potential loophole: if a user is marked "not active" (user.active = 0), then a password-reset cycle, initiated by the user, will result in a reset_user_password() call that will re-activate user
-	return await _update1(dbc, 'update user set password = ?, active = 1 where id = ?', (_hashpw(new_password), uid,))
+	r = await _update1(dbc, 'update user set password = ?, active = 1 where id = ?', (await _hashpw(new_password), uid,))
+	_changed(('user', uid))
+	await _forgive_login_failures(dbc, uid, idid)
+	return r
+
+async def _forgive_login_failures(dbc, uid, idid):
+	# A completed reset is what text.too_many_logins suggests, so it lifts the login throttle (see login()) - for the user's username and emails, and for client `idid`, if given
+	names = [r['name'] for r in await _fetchall(dbc, 'select username as name from user where id = ? union select email.email from user join email on user.person = email.person where user.id = ?', (uid, uid))]
+	for key in [('username', name.lower()) for name in names] + ([('idid', idid)] if idid else []):
+		_login_failures.invalidate(key)
+
+@addtest()
+def test_forgive_login_failures(self):
+	async def run():
+		connection = await connect(':memory:')
+		try:
+			await connection.execute('create table user (id INTEGER PRIMARY KEY, username TEXT, person INTEGER)')
+			await connection.execute('create table email (email TEXT, person INTEGER)')
+			await connection.execute("insert into user values (1, 'Pat', 10), (2, 'other', 20)")
+			await connection.execute("insert into email values ('Pat@x.com', 10)")
+			keys = (('username', 'pat'), ('username', 'pat@x.com'), ('idid', 'abc'), ('username', 'other'))
+			for key in keys:
+				_login_failures.put(key, k_login_attempts)
+			await _forgive_login_failures(connection, 1, 'abc')
+			self.assertEqual([_login_failures.get(key) for key in keys], [None, None, None, k_login_attempts])
+		finally:
+			_login_failures.clear()
+			await connection.close()
+	asyncio.run(run())
 
 async def deactivate_user(dbc, username):
 	# note: use reset_user_password() to re-activate
 	user_id = '(select id from user where user.username = ?)'
 	try:
 		await begin(dbc)
+		tags = await _id_key_tags(dbc, f'user = {user_id}', (username,))
 		await dbc.execute(f'delete from id_key where user = {user_id}', (username,))
 		await _update1(dbc, 'update user set active = 0 where username = ?', (username,))
 		await _update1(dbc, f'update tag set active = 0 where user = {user_id}', (username,))
 		await commit(dbc)
+		_changed(('user', await get_user_id(dbc, username)), *tags)
 		return True # superfluous, at best (?!)
 	except SQL_Error:
 		await rollback(dbc)
@@ -413,9 +610,12 @@ async def get_other_logins(dbc, uid):
 	return r
 
 async def get_user_color(dbc, uid):
-	r = await _fetch1(dbc, 'select color from user where id = ?', (uid,))
-	return r['color'] if (r and r['color']) else '#ffffff'
+	p = await get_principal(dbc, uid)
+	return p.color if (p and p.color) else '#ffffff'
 
+async def get_user_timezone(dbc, uid):
+	p = await get_principal(dbc, uid)
+	return p.timezone if p else None # (None - no preference - is the norm; see main._identified())
 
 async def add_role(dbc, user_id, role):
 	await add_roles(dbc, user_id, (role,))
@@ -440,6 +640,7 @@ async def add_role_ids(dbc, role_ids, user_id = None):
 		role_ids = [(user_id, role_id) for role_id in role_ids]
 	#else role_ids is already a list of (user_id, role_id) tuples
 	await dbc.executemany('insert into user_role (user, role) values (?, ?)', role_ids)
+	_changed(*set(('user', uid) for uid, _ in role_ids))
 
 
 async def get_tags(dbc, active = True, like = None, get_subscriber_count = False, limit = k_default_resultset_limit):
@@ -461,7 +662,9 @@ async def new_tag(dbc, name, active):
 
 async def clone_tag(dbc, name, active, id):
 	new_id = await new_tag(dbc, name, active)
-	return await dbc.execute(f'insert into user_tag (user, tag) select user, ? from user_tag where tag = ?', (new_id, id))
+	r = await dbc.execute(f'insert into user_tag (user, tag) select user, ? from user_tag where tag = ?', (new_id, id))
+	_changed(*[('user', u['user']) for u in await _fetchall(dbc, 'select user from user_tag where tag = ?', (new_id,))]) # (their Principal.tags)
+	return r
 
 async def get_tag(dbc, id, fields: str | None = None):
 	if not fields:
@@ -469,7 +672,9 @@ async def get_tag(dbc, id, fields: str | None = None):
 	return await _fetch1(dbc, f'select {fields} from tag where id = ?', (id,))
 
 async def set_tag(dbc, id, name, active):
-	return await _update1(dbc, 'update tag set name = ?, active = ? where id = ?', (name, active, id))
+	r = await _update1(dbc, 'update tag set name = ?, active = ? where id = ?', (name, active, id))
+	_changed(('tag', id))
+	return r
 
 
 async def get_tag_users(dbc, tag_id, limit, active = True, like = None, include_unsubscribed = False):
@@ -490,10 +695,14 @@ async def get_tag_users(dbc, tag_id, limit, active = True, like = None, include_
 
 
 async def remove_user_from_tag(dbc, user_id, tag_id):
-	return await dbc.execute(f'delete from user_tag where user = ? and tag = ?', (user_id, tag_id))
+	r = await dbc.execute(f'delete from user_tag where user = ? and tag = ?', (user_id, tag_id))
+	_changed(('user', user_id), ('tag', tag_id))
+	return r
 
 async def add_user_to_tag(dbc, user_id, tag_id):
-	return await _insert1(dbc, 'insert into user_tag (user, tag) values (?, ?)', (user_id, tag_id))
+	r = await _insert1(dbc, 'insert into user_tag (user, tag) values (?, ?)', (user_id, tag_id))
+	_changed(('user', user_id), ('tag', tag_id))
+	return r
 
 async def get_user_tags(dbc, user_id, limit, active = True, like = None, include_unsubscribed = False):
 	return await _get_xaa(dbc,
@@ -548,7 +757,7 @@ async def save_message(dbc, message_id, content):
 		more = f'deleted = {k_now}, '
 	else: # otherwise, even if it used to be deleted, if we're 'saving' it now, then untrash it!
 		more = 'deleted = null, '
-	return await _update1(dbc, f'update message set {more} message = ?, teaser = ? where id = ?', args)
+	return await _update1(dbc, f'update message set {more} message = ?, teaser = ?, rendered_version = null where id = ?', args) # the teaser is kept current (it's cheap, and searched - see get_messages()), but the rendering is made just once, at send_message(), rather than on every autosave; until then, readers render lazily (see _render_stale())
 
 Send_Message_Result = Enum('SMR', ('EmptyMessage', 'NoTags', 'Success'))
 async def send_message(dbc, user_id, message_id) -> Send_Message_Result | dict:
@@ -574,20 +783,23 @@ async def send_message(dbc, user_id, message_id) -> Send_Message_Result | dict:
 		message['edited'] = 1 # kludge - parties using the return from this function (the message) need that 'edited' field, and, in fact, need it to be meaningful for a wide audience, such as: in order to "deliver" (inject) the message to all live clients, in real time.  This value for message['edited'] (1) makes the most sense if the message was ALREADY ['sent'], before, and yet here we are in send_message (obviously "re-sending", e.g., an edit). In another arc, e.g., when a user loads new messages, this ['edited'] value gets set to 1, for that user alone, fetching the message(s), when it lands in his "unstashed" (which only happens if it was previously in his "stashed").
 	if message['reply_chain_patriarch'] == message['id']: # if this is the patriarch of the thread, update its thread_updated
 		sets.append(f'thread_updated = {k_now}')
-	if sets: # only continue if there's actually something to set(); else no-op
-		sets = 'set ' + ', '.join(sets)
-		try:
-			await begin(dbc)
+	message['teaser'] = make_teaser(content)
+	message['rendered'] = render_message(content)
+	try:
+		await begin(dbc)
+		await _update1(dbc, f'update message set teaser = ?, rendered = ?, rendered_version = {k_render_version} where id = ?', (message['teaser'], message['rendered'], message_id)) # (within the transaction, so that a failed send stores none of it)
+		if sets: # only continue if there's actually something (else) to set(); else no-op
+			sets = 'set ' + ', '.join(sets)
 			await _update1(dbc, f'update message {sets} where id = ?', args)
 			await dbc.execute('insert into message_unstashed (message, unstashed_for) select message, stashed_by from message_stashed where message_stashed.message = ?', (message_id,))
 			await dbc.execute('delete from message_stashed where message = ?', (message_id,))
 			if message['reply_chain_patriarch'] != message['id']:
 				# Need to update reply_chain_patriarch's thread_updated field, too:
 				await _update1(dbc, f'update message set thread_updated = {k_now} where id = ?', (message['reply_chain_patriarch'],))
-			await commit(dbc)
-		except SQL_Error:
-			await rollback(dbc)
-			raise
+		await commit(dbc)
+	except SQL_Error:
+		await rollback(dbc)
+		raise
 
 	return message
 
@@ -598,6 +810,31 @@ async def has_tags(dbc, message_id):
 def make_teaser(content):
 	return strip_tags(content[:100])[:50] # [:50] to just operate on opening portion of content, but then, once stripped of tags, whittle down to [:20]; if only one of these was used, "taggy" content would be rather over-shrunk or under-taggy content would be rather under-shrunk
 
+k_url_rec = regex.compile(k_url_re)
+
+def render_message(content):
+	'''Return message `content` as displayed: markdown-style [text](url) links made real <a href>s.  (Bump k_render_version when changing this!)'''
+	return k_url_rec.sub(k_url_replacement, content)
+
+@addtest()
+def test_render_message(self):
+	self.assertEqual(render_message('<div>see [this (one)](https://x.com/a_(b)) now</div>'), '<div>see <a target="_blank" rel="noopener noreferrer" href="https://x.com/a_(b)">this (one)</a> now</div>')
+	self.assertEqual(render_message('<div>no links</div>'), '<div>no links</div>')
+
+async def _render_stale(dbc, rows, like = None):
+	# Fill in each row's 'rendered' (and, if `like`, search-highlight it), rendering only what isn't already stored at k_render_version; storing that, for sent messages, so the work is done just once
+	stale = []
+	for row in rows:
+		if row['rendered_version'] != k_render_version:
+			row['rendered'] = render_message(row['message'] or '')
+			if row['sent']: # (drafts change with every autosave; not worth storing)
+				stale.append((row['rendered'], row['id']))
+		if like:
+			row['rendered'] = row['rendered'].replace(like, f"<span class='highlight'>{like}</span>")
+	if stale:
+		await dbc.executemany(f'update message set rendered = ?, rendered_version = {k_render_version} where id = ?', stale)
+	return rows
+
 def strip_tags(content):
 	return re.sub(r'&nbsp;', '', re.sub(r'<.*', '', re.sub(r'<[^<]+?>', '', re.sub(r'</[^<]+?>', '...', content))))
 
@@ -611,7 +848,7 @@ def test_strip_tags(self):
 	t('<div>hello</div><div>', 'hello...')
 	t('<div>hello</div><div>oh', 'hello...oh')
 
-_mega_message_select = lambda message: f"select message.id, {message}, message.deleted, GROUP_CONCAT(DISTINCT attachment.filename) as attachments, message.reply_chain_patriarch, message.teaser, parent.teaser as parent_teaser, sender.username as sender, sender.id as sender_id, message.reply_to, message.sent as sent, message.deleted, patriarch.thread_updated as thread_updated, GROUP_CONCAT(DISTINCT tag.name) as tags, (select 1 from message_pin where user = ? and message = message.id) as pinned, (select 1 from message_peg where message = message.id) as pegged, (select 1 from message_stashed where stashed_by = ? and message = message.id) as stashed, (select 1 from message_deferred where deferred_by = ? and message = message.id) as deferred, (select 1 from message_unstashed where unstashed_for = ? and message = message.id) as edited  from message join user as sender on message.author = sender.id join message as patriarch on message.reply_chain_patriarch = patriarch.id left join message as parent on message.reply_to = parent.id left join message_attachment on message.id = message_attachment.message left join attachment on attachment.id = message_attachment.attachment" # NOTE that GROUP_CONCAT(DISTINCT tag.name) is the only way to get singles (not multiple copies) of group names - using GROUP_CONCAT(tag.name, ', ') would be nice, since the default doesn't place a space after the comma, but providing the ', ' argument only works if you do NOT use DISTINCT, which isn't an option for us.  Similar goes for attachment.filename
+_mega_message_select = lambda message: f"select message.id, {message}, message.rendered, message.rendered_version, message.deleted, GROUP_CONCAT(DISTINCT attachment.filename) as attachments, message.reply_chain_patriarch, message.teaser, parent.teaser as parent_teaser, sender.username as sender, sender.id as sender_id, message.reply_to, message.sent as sent, message.deleted, patriarch.thread_updated as thread_updated, GROUP_CONCAT(DISTINCT tag.name) as tags, (select 1 from message_pin where user = ? and message = message.id) as pinned, (select 1 from message_peg where message = message.id) as pegged, (select 1 from message_stashed where stashed_by = ? and message = message.id) as stashed, (select 1 from message_deferred where deferred_by = ? and message = message.id) as deferred, (select 1 from message_unstashed where unstashed_for = ? and message = message.id) as edited  from message join user as sender on message.author = sender.id join message as patriarch on message.reply_chain_patriarch = patriarch.id left join message as parent on message.reply_to = parent.id left join message_attachment on message.id = message_attachment.message left join attachment on attachment.id = message_attachment.attachment" # NOTE that GROUP_CONCAT(DISTINCT tag.name) is the only way to get singles (not multiple copies) of group names - using GROUP_CONCAT(tag.name, ', ') would be nice, since the default doesn't place a space after the comma, but providing the ', ' argument only works if you do NOT use DISTINCT, which isn't an option for us.  Similar goes for attachment.filename
 
 
 _message_tag_join = 'left join message_tag on message.id = message_tag.message left join tag on message_tag.tag = tag.id'
@@ -619,7 +856,10 @@ _message_tag_join = 'left join message_tag on message.id = message_tag.message l
 _user_tag_join = 'left join user_tag on tag.id = user_tag.tag'
 
 async def get_message(dbc, user_id, message_id):
-	return await _fetch1(dbc, f'{_mega_message_select("message.message")} {_message_tag_join} where message.id = ?', (user_id, user_id, user_id, user_id, message_id,))
+	result = await _fetch1(dbc, f'{_mega_message_select("message.message")} {_message_tag_join} where message.id = ?', (user_id, user_id, user_id, user_id, message_id,))
+	if result:
+		await _render_stale(dbc, [result])
+	return result
 
 async def get_whole_thread(dbc, user_id, patriarch_id):
 	where = ['((message.sent is not null and user_tag.user = ?) or (message.author = ? and (message.reply_to is not null or message.sent is not null)))', 'message.reply_chain_patriarch = ?']
@@ -630,7 +870,7 @@ async def get_whole_thread(dbc, user_id, patriarch_id):
 	query = f'{_mega_message_select("message.message")} {_message_tag_join} {_user_tag_join} {where} {group_by} {asc_order}'
 	#l.debug(f'get_messages query: {query}    ... args: {args}')
 	# SEE: giant_sql_laid_out.txt to show/study the above laid out for straight comprehension.
-	return await _fetchall(dbc, query, args)
+	return await _render_stale(dbc, await _fetchall(dbc, query, args))
 
 async def get_messages(dbc, user_id, include_trashed = False, deep = False, like = None, filt = messages_const.Filter.new, ignore = None, limit = k_default_resultset_limit):
 	where = ['message.message != ""' ]
@@ -668,8 +908,7 @@ async def get_messages(dbc, user_id, include_trashed = False, deep = False, like
 	where = 'where ' + ' and '.join(where)
 	group_by = 'group by message.id' # query produces many rows for a message, one per tag for that message; this is required to consolidate to one row, but allows GROUP_CONCAT() to properly build the list of tags that match
 	asc_order = f'order by thread_updated asc, sent asc nulls last' # "nulls last" is for unsent messages, which don't yet have 'sent' set (so, it's null) - those should be "lowest" in the list
-	msg_field = f'''REPLACE(message.message, "{like}", "<span class='highlight'>{like}</span>") as message''' if like else 'message.message'
-	query = f'{_mega_message_select(msg_field)} {_message_tag_join} {_user_tag_join} {where} {group_by}'
+	query = f'{_mega_message_select("message.message")} {_message_tag_join} {_user_tag_join} {where} {group_by}'
 
 	if filt == messages_const.Filter.new:
 		query = f'{query} {asc_order} limit {limit}'
@@ -677,7 +916,7 @@ async def get_messages(dbc, user_id, include_trashed = False, deep = False, like
 		query = f'select * from ({query} order by thread_updated desc, sent desc limit {limit}) {asc_order}'
 	#l.debug(f'get_messages query: {query}    ... args: {args}')
 	# SEE: giant_sql_laid_out.txt to show/study the above laid out for straight comprehension.
-	return await _fetchall(dbc, query, args)
+	return await _render_stale(dbc, await _fetchall(dbc, query, args), like) # (search highlighting is done on the rendering, rather than in the query, so stored renderings still serve)
 
 async def delivery_recipient(dbc, user_id, message_id):
 	return await _fetch1(dbc, f'select 1 from message {_message_tag_join} {_user_tag_join} where (user_tag.user = ? or message.author = ?) and message.id = ?', (user_id, user_id, message_id))
@@ -822,6 +1061,17 @@ async def get_user_enrollments(dbc, user_id):
 	return await _fetchall(dbc, 'select enrollment.id from enrollment join person on enrollment.person = person.id join user on user.person = person.id where user.id = ?', (user_id,))
 
 async def get_assignments(dbc, user_id, like = None, filt = assignments_const.Filter.current, subj_id = None, limit = k_assignment_resultset_limit):
+	return await _fetchall(dbc, *await _assignments_query(dbc, user_id, filt, subj_id))
+
+async def stream_assignments(dbc, user_id, filt = assignments_const.Filter.current, subj_id = None, batch_size = 200):
+	'''
+	Like get_assignments(), but yields rows as they're read (a batch at a time), rather than returning them all at once.  `dbc` must be a cursor of
+	the stream's own (see _stream()), not main.Hd.dbc, which other coroutines use (e.g., messages.deliver_message()) while the caller awaits sends.
+	'''
+	async for row in _stream(dbc, *await _assignments_query(dbc, user_id, filt, subj_id), batch_size):
+		yield row
+
+async def _assignments_query(dbc, user_id, filt, subj_id):
 	wheres = [	'user.id = ?',
 					'assignment.deleted is NULL',
 					'(assignment.teacher is null or assignment.teacher = 0 or enrollment.teacher = 1)',
@@ -876,7 +1126,7 @@ async def get_assignments(dbc, user_id, like = None, filt = assignments_const.Fi
 	froms = ' join '.join(froms)
 	orders = 'assignment.week, class.subject, class.id, assignment.resource, optional, assignment.sequence'
 	query = f'select {fields} from {froms} where {wheres} order by {orders}'
-	return await _fetchall(dbc, query, args)
+	return query, args
 
 
 async def mark_assignment_complete(dbc, user_id, assignment_id, enrollment_id, complete):
@@ -1130,6 +1380,34 @@ async def _fetchall(dbc, sql, args = None):
 	#l.debug(f"{sql} ... {args}")
 	return await r.fetchall()
 
+async def _stream(dbc, sql, args, batch_size):
+	'''Yield the rows of `sql`, fetched `batch_size` at a time.  (`dbc` mustn't be used for anything else until the rows run out - so it should be a cursor opened just for this, and closed by the caller.)'''
+	await dbc.execute(sql, args)
+	while rows := await dbc.fetchmany(batch_size):
+		for row in rows:
+			yield row
+
+@addtest()
+def test_stream(self):
+	async def run():
+		connection = await connect(':memory:')
+		try:
+			dbc = await cursor(connection) # (a real cursor, like main.Hd.dbc)
+			await dbc.execute('create table t (n INTEGER)')
+			await dbc.executemany('insert into t (n) values (?)', [(n,) for n in range(5)])
+			stream_dbc = await cursor(connection) # (the stream's own)
+			try:
+				rows = []
+				async for r in _stream(stream_dbc, 'select n from t where n >= ? order by n', (1,), 2):
+					rows.append(r['n'])
+					await _fetch1(dbc, 'select count(*) as c from t') # (others' use of the shared cursor, mid-stream, doesn't disturb it)
+				self.assertEqual(rows, [1, 2, 3, 4])
+			finally:
+				await stream_dbc.close()
+		finally:
+			await connection.close()
+	asyncio.run(run())
+
 async def _update1(dbc, sql, args):
 	r = await dbc.execute(sql, args)
 	assert(r.rowcount < 2) # 0 or 1
@@ -1139,11 +1417,28 @@ async def _insert1(dbc, sql, args):
 	r = await dbc.execute(sql, args)
 	return r.lastrowid
 
-def _hashpw(password):
-	return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+def _ago(seconds):
+	return (datetime.utcnow() - timedelta(seconds = seconds)).strftime(k_datetime_format) # (in the format of k_now, so that they compare)
+
+async def _hashpw(password):
+	return await _hashing(bcrypt.hashpw, password.encode(), bcrypt.gensalt())
+
+async def _hashing(func, *args):
+	'''Run bcrypt `func` in _hash_pool, so that it doesn't stall every other connection.'''
+	global _hash_jobs
+	_hash_jobs += 1
+	try:
+		return await asyncio.get_running_loop().run_in_executor(_hash_pool, func, *args)
+	finally:
+		_hash_jobs -= 1
+
+def hash_stats():
+	return dict(threads = k_hash_threads, running = min(_hash_jobs, k_hash_threads), queued = max(0, _hash_jobs - k_hash_threads))
 
 async def _login(dbc, idid, user_id):
-	return await _update1(dbc, f'update id_key set user = ?, login_timestamp = {k_now} where idid = ?', (user_id, idid))
+	r = await _update1(dbc, f'update id_key set user = ?, login_timestamp = {k_now} where idid = ?', (user_id, idid))
+	_changed(('id_key', idid))
+	return r
 
 def _add_like(like, fields, where, args):
 	if like:
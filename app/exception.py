@@ -12,3 +12,9 @@ class InvalidInput(UmException):
 
 class AlreadyExists(UmException):
 	pass
+
+class NotFound(UmException):
+	pass
+
+class Throttled(UmException):
+	pass
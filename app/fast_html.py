@@ -0,0 +1,478 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import json
+import logging
+import sys
+import timeit
+import unittest
+
+from collections import OrderedDict
+from functools import lru_cache
+
+from dominate.util import escape, raw
+
+from . import cache
+from . import dates
+from . import db
+from . import html
+from . import media
+from . import text
+
+from .const import *
+from .settings import fragment_cache_bytes, fragment_cache_versions, hls_videos
+
+l = logging.getLogger(__name__)
+
+# Fast-path equivalents of html.messages(), html.message(), html.inline_reply_box() and html.thumbnail_strip(), for the message-list hot path.
+# Each emits markup identical to its dominate counterpart (see Tests, below), but from string templates that are built (with a tiny stand-in for
+# dominate's pretty-printer) just once per variant - per indentation level and set of on/off features - and then merely format()ed per message.
+# Results are raw() objects, so they can be handed to ws.send_content() just like dominate tags.
+# Benchmark (against dominate) with:
+#   python -m app.fast_html bench
+# and test (equivalence) with:
+#   python -m app.fast_html
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+
+# -----------------------------------------------------------------------------
+
+class FragmentCache(cache.Cache):
+	'''
+	Rendered message fragments, keyed by (message id, content version, variant); bounded by (roughly) bytes, LRU-evicted.
+	invalidate_message() whenever a message changes - that drops its fragments and bumps its version, so a render racing the change can't re-cache stale
+	content.  Versions are kept for the max_versions most recently changed messages; forgetting an older one drops its fragments, too (so that none
+	outlive it, cached under a version that would come around again).
+	'''
+	def __init__(self, max_bytes, max_versions):
+		super().__init__('fragments', max_bytes = max_bytes, sizeof = len)
+		self.max_versions = max_versions
+		self._versions = OrderedDict() # message id -> content version; least-recently changed first
+
+	def version(self, mid):
+		return self._versions.get(mid, 0)
+
+	def put_fragment(self, key, fragment):
+		mid = key[0]
+		if key[1] != self.version(mid):
+			return # rendered from content that has since changed
+		self.put(key, fragment, tags = (('message', mid),))
+
+	def invalidate_message(self, mid):
+		mid = int(mid)
+		self._versions[mid] = self.version(mid) + 1
+		self._versions.move_to_end(mid)
+		self.invalidate_tag(('message', mid))
+		while len(self._versions) > self.max_versions:
+			self.invalidate_tag(('message', self._versions.popitem(last = False)[0]))
+
+fragments = FragmentCache(fragment_cache_bytes, fragment_cache_versions)
+
+# -----------------------------------------------------------------------------
+
+k_indent = '  ' # dominate's default
+k_inline_tags = ('i',) # of the tags we use, those that dominate renders inline (no newline/indent before them)
+k_single_tags = ('hr', 'img', 'source') # ... and those that have no closing tag
+k_max_recipients = 3 # same as html.message()
+
+_slot = lambda name: f'\x00{name}\x00' # placeholder, in a template under construction; escape() leaves these alone
+_el = lambda tag, attrs = None, *children: (tag, attrs or {}, children) # element; `children` are elements or (already escaped!) strings
+_button = lambda icon, title, onclick, **attrs: _el('button', dict(onclick = onclick, title = title, **attrs), _el('i', {'class': f'i {icon}'}))
+_bumper = lambda: _el('div', {'class': 'bumper'})
+
+
+def _render(node, level, sb):
+	# Mirrors dominate's (pretty) render(): non-inline children go on their own lines, indented a level deeper, and then so does the closing tag
+	tag, attrs, children = node
+	sb.append('<' + tag)
+	for name, value in sorted(attrs.items()):
+		sb.append(f' {name}="{escape(str(value), True)}"')
+	sb.append('>')
+	if tag in k_single_tags:
+		return sb
+	inline = True
+	for child in children:
+		if isinstance(child, str):
+			sb.append(child)
+		else:
+			if child[0] not in k_inline_tags:
+				inline = False
+				sb.append('\n' + k_indent * (level + 1))
+			_render(child, level + 1, sb)
+	if not inline:
+		sb.append('\n' + k_indent * level)
+	sb.append(f'</{tag}>')
+	return sb
+
+def _template(node, level):
+	# Render `node` at indentation `level`, as a leading (non-inline) child would be rendered, then turn its _slot()s into format() fields; returns (head, tail), split at the 'replies' slot (where nested messages go)
+	result = ''.join(_render(node, level, ['\n' + k_indent * level]))
+	result = result.replace('{', '{{').replace('}', '}}')
+	for name in ('id', 'parent_mid', 'patriarch', 'teaser', 'message', 'attachments', 'sender', 'recipients', 'isodate', 'content'):
+		result = result.replace(_slot(name), '{' + name + '}')
+	head, _, tail = result.partition(_slot('replies'))
+	return head, tail
+
+
+@lru_cache(maxsize = 2048)
+def _message_template(level, hr, teaser, edited, attachments, stashable, deferrable, pinned, editable, whole_thread, injection):
+	mid = _slot('id')
+	cls = 'container'
+	if injection:
+		cls += ' injection'
+	if whole_thread:
+		cls += ' bluish'
+	children = []
+	if hr:
+		children.append(_el('hr', {'class': hr} if hr != 'plain' else None))
+	if teaser:
+		children.append(_el('div', {'class': 'italic'}, escape('Reply to "') + _slot('teaser') + escape('...":')))
+	if edited:
+		children.append(_el('div', {'class': 'italic bold'}, escape(text.edited + ':')))
+	children.append(_el('div', None, _slot('message')))
+	if attachments:
+		children.append(_el('div', {'id': f'attachments_for_message_{mid}'}, _slot('attachments')))
+
+	row1 = []
+	if stashable:
+		row1 += [_button('i-ok', text.stash, f'messages.stash({mid})'), _bumper()]
+	if deferrable:
+		row1 += [_button('i-defer', text.defer, f'messages.defer({mid})'), _bumper()]
+	if pinned:
+		row1 += [_button('i-pin', text.unpin, f'messages.unpin({mid}, this)', **{'class': 'selected'}), _bumper()]
+	else:
+		row1 += [_button('i-pin', text.pin, f"messages.pin({mid}, this, {'true' if stashable else 'false'})"), _bumper()]
+	if editable:
+		row1 += [_button('i-edit', text.edit_message, html._send('messages', 'edit_message', message_id = mid)), _bumper()]
+	row1 += [_el('div', {'class': 'spacer'}), _el('div', None, _el('span', None, _el('b', None, escape('by ')), _slot('sender')))]
+	children.append(_el('div', {'class': 'buttonbar'}, *row1))
+
+	to = [_el('b', None, escape(' to '))]
+	if editable:
+		to.append(_button('i-all', text.recipients, f'messages.change_recipients({mid})'))
+	to.append(_slot('recipients'))
+	if not whole_thread:
+		to.append(_button('i-thread', text.thread, html._send('messages', 'show_whole_thread', message_id = mid, patriarch_id = _slot('patriarch'))))
+	to.append(escape(' · '))
+	row2 = [
+		_el('div', {'class': 'spacer'}),
+		_button('i-reply', text.reply, html._send('messages', 'compose_reply', message_id = mid)),
+		_el('span', None, *to),
+		_el('span', {'class': 'time_updater', 'data-isodate': _slot('isodate')}, escape(text.just_now if injection else '...')),
+	]
+	if editable:
+		row2.append(_button('i-trash', text.delete_message, f'messages.delete_message({mid}, false)'))
+	children.append(_el('div', {'class': 'buttonbar'}, *row2))
+	children.append(_slot('replies'))
+	return _template(_el('div', {'class': cls, 'id': f'message_{mid}'}, *children), level)
+
+@lru_cache(maxsize = 64)
+def _inline_reply_box_template(level):
+	mid = _slot('id')
+	return _template(_el('div', {'class': 'container yellow_border', 'id': f'message_{mid}'},
+		_el('div', {'class': 'edit_message_content', 'contenteditable': 'true', 'id': f'edit_message_content_{mid}', 'onblur': f'messages.stop_saving({mid})', 'onfocus': f'messages.start_saving(this, {mid})'}, _slot('content')),
+		_el('div', {'id': f'attachments_for_message_{mid}'}),
+		_el('div', {'class': 'buttonbar'},
+			_button('i-attach', text.attach, f'messages.attach_upload({mid})'),
+			_bumper(),
+			_button('i-all', text.reply_all, f'messages.reply_recipient_one({mid})', id = f'rr_all_{mid}'),
+			_bumper(),
+			_button('i-one', text.reply_one, f'messages.reply_recipient_all({mid})', id = f'rr_one_{mid}', **{'class': 'hide'}),
+			_bumper(),
+			_button('i-send', text.send_message, f'''messages.send_reply({mid}, {_slot('parent_mid')}, $('reply_recipient_{mid}').dataset.replyrecipient)'''),
+			_el('div', {'class': 'spacer'}),
+			_button('i-trash', text.delete, f'messages.delete_unsent_reply_draft({mid}, "{text.delete_confirmation}")'),
+			_el('div', {'class': 'hide', 'data-replyrecipient': 'A', 'id': f'reply_recipient_{mid}'}),
+		),
+		_slot('replies'),
+	), level)
+
+
+def _thumbnail_strip(filenames, level):
+	spans = []
+	for name in filenames:
+		path = f'/{k_upload_path}{name}'
+		lilname = name.lower()
+		poster_path = path + k_thumb_appendix
+		onclick = None
+		if lilname.endswith(k_video_formats):
+			onclick = f'messages.play_video("{path}", "{poster_path}", "{path}{k_hls_appendix}/master.m3u8")' if hls_videos else f'messages.play_video("{path}", "{poster_path}")'
+		elif lilname.endswith(k_image_formats):
+			onclick = f'messages.play_image("{path}", "{media.srcset(name, "webp")}", "{media.srcset(name, "jpg")}")'
+			spans.append(_el('span', {'onclick': onclick}, _el('picture', None,
+				_el('source', {'sizes': k_thumbnail_sizes, 'srcset': media.srcset(name, 'webp'), 'type': 'image/webp'}),
+				_el('img', {'alt': name, 'sizes': k_thumbnail_sizes, 'src': media.thumb_url(name), 'srcset': media.srcset(name, 'jpg')}),
+			)))
+			continue
+		elif lilname.endswith(k_pdf_formats):
+			onclick = f'messages.play_pdf("{path}", "{media.url(name, "")}")'
+		spans.append(_el('span', {'onclick': onclick} if onclick else None, _el('img', {'alt': name, 'src': media.thumb_url(name)})))
+	return ''.join(_render(_el('div', {'class': 'thumbnail_strip'}, *spans), level, []))
+
+
+def _message(msg, level, user_id, is_admin, stashable, deferrable, thread_patriarch, skip_first_hr, injection, searchtext, whole_thread):
+	editable = msg['sender_id'] == user_id or is_admin
+	continuation = False
+	hr = None
+	if skip_first_hr and thread_patriarch == None:
+		thread_patriarch = msg['reply_chain_patriarch']
+	elif msg['reply_chain_patriarch'] == thread_patriarch:
+		hr = 'gray'
+		continuation = True
+	else:
+		hr = 'plain'
+		thread_patriarch = msg['reply_chain_patriarch']
+	teaser = bool(msg['reply_to'] and not continuation)
+	variant = (level, hr, teaser, bool(msg['edited']), bool(msg['attachments']), bool(stashable), bool(deferrable), bool(msg['pinned']), bool(editable), bool(whole_thread), bool(injection))
+	head, tail = _message_template(*variant)
+	if searchtext: # (search-highlighted content is one-off; don't cache it)
+		return thread_patriarch, _fill_message(head, msg, level, teaser), tail
+	key = (msg['id'], fragments.version(msg['id']), msg['parent_teaser'] if teaser else None, dates.current().name) + variant # (the parent's teaser is the parent's content, so it's part of the key, rather than a reason to invalidate this message; likewise the timezone, in which the 'sent' date is given)
+	if (fragment := fragments.get(key)) is None:
+		fragment = _fill_message(head, msg, level, teaser)
+		fragments.put_fragment(key, fragment)
+	return thread_patriarch, fragment, tail
+
+def _fill_message(head, msg, level, teaser):
+	all_recipients = '' if not msg['tags'] else msg['tags'].split(',')
+	recipients = ', '.join(all_recipients[0:k_max_recipients])
+	if len(all_recipients) > k_max_recipients:
+		recipients += ', ...'
+	return head.format(
+		id = msg['id'],
+		patriarch = msg['reply_chain_patriarch'],
+		teaser = escape(f"{msg['parent_teaser']}") if teaser else '',
+		message = msg['rendered'],
+		attachments = '\n' + k_indent * (level + 2) + _thumbnail_strip(msg['attachments'].split(','), level + 2) + '\n' + k_indent * (level + 1) if msg['attachments'] else '',
+		sender = escape(msg['sender']),
+		recipients = escape(recipients),
+		isodate = dates.current().iso(msg['sent']),
+	)
+
+def _inline_reply_box(message_id, parent_mid, content, level):
+	head, tail = _inline_reply_box_template(level)
+	return head.format(id = message_id, parent_mid = parent_mid, content = content or ''), tail
+
+
+def messages(msgs, user_id, is_admin, stashable, deferrable, last_thread_patriarch = None, skip_first_hr = False, searchtext = None, whole_thread = False):
+	dates.current().localize(msgs, 'sent')
+	top = []
+	nodes = {} # message id -> (level, head, tail, replies)
+	for msg in msgs:
+		parent = nodes.get(msg['reply_to'])
+		level = parent[0] + 1 if parent else 1
+		if msg['sender_id'] == user_id and not msg['sent'] and msg['reply_to'] != None: # (see html.messages())
+			last_thread_patriarch = msg['reply_chain_patriarch']
+			head, tail = _inline_reply_box(msg['id'], msg['reply_to'], msg['message'], level)
+		elif msg['sent']:
+			last_thread_patriarch, head, tail = _message(msg, level, user_id, is_admin, stashable, deferrable, last_thread_patriarch, skip_first_hr, False, searchtext, whole_thread)
+		else:
+			continue # a non-reply draft (see html.messages())
+		node = (level, head, tail, [])
+		(parent[3] if parent else top).append(node)
+		nodes[msg['id']] = node
+	sb = ['<div class="container">']
+	stack = list(reversed(top))
+	while stack: # depth-first, without recursion; a str on the stack is a pending tail
+		node = stack.pop()
+		if isinstance(node, str):
+			sb.append(node)
+		else:
+			_, head, tail, replies = node
+			sb.append(head)
+			stack.append(tail)
+			stack.extend(reversed(replies))
+	sb.append('\n</div>' if top else '</div>')
+	return raw(''.join(sb))
+
+def message(msg, user_id, is_admin, stashable, deferrable, thread_patriarch = None, skip_first_hr = False, injection = False, searchtext = None, whole_thread = False):
+	thread_patriarch, head, tail = _message(msg, 0, user_id, is_admin, stashable, deferrable, thread_patriarch, skip_first_hr, injection, searchtext, whole_thread)
+	return thread_patriarch, raw(head[1:] + tail) # [1:] - no leading newline at the top level
+
+def inline_reply_box(message_id, parent_mid, content = None):
+	head, tail = _inline_reply_box(message_id, parent_mid, content, 0)
+	return raw(head[1:] + tail)
+
+def thumbnail_strip(filenames):
+	return raw(_thumbnail_strip(filenames, 0))
+
+
+# JSON records, for client-side rendering (see messages._send_messages()); messages.render_messages(), in messages.js, mirrors the markup above
+
+k_render_config = dict( # sent once per connection
+	text = dict((name, getattr(text, name)) for name in ('stash', 'defer', 'pin', 'unpin', 'edit_message', 'recipients', 'thread', 'reply', 'delete_message', 'just_now', 'edited', 'attach', 'reply_all', 'reply_one', 'send_message', 'delete', 'delete_confirmation')),
+	upload_path = k_upload_path, thumb_appendix = k_thumb_appendix, thumb_version = k_thumb_version, derivative_version = k_derivative_version, hls_appendix = k_hls_appendix, hls_videos = hls_videos,
+	image_formats = k_image_formats, video_formats = k_video_formats, pdf_formats = k_pdf_formats,
+	image_widths = k_image_widths, thumbnail_sizes = k_thumbnail_sizes,
+)
+
+def record(msg, user_id):
+	'''Project a db._mega_message_select() row down to just what messages.js renders; None for a row that isn't rendered at all (a non-reply draft).'''
+	r = dict(id = msg['id'], reply_to = msg['reply_to'], patriarch = msg['reply_chain_patriarch'])
+	if not msg['sent']:
+		if msg['sender_id'] != user_id or msg['reply_to'] == None: # (see html.messages())
+			return None
+		r['draft'] = msg['message'] or ''
+		return r
+	r.update(
+		sender_id = msg['sender_id'],
+		sender = msg['sender'],
+		message = msg['rendered'],
+		sent = dates.current().iso(msg['sent']),
+	)
+	# Optional fields are simply absent when empty/false, to keep records small:
+	if msg['reply_to']:
+		r['teaser'] = msg['parent_teaser']
+	if msg['edited']:
+		r['edited'] = True
+	if msg['pinned']:
+		r['pinned'] = True
+	if msg['tags']:
+		r['tags'] = msg['tags'].split(',')
+	if msg['attachments']:
+		r['attachments'] = msg['attachments'].split(',') # (just filenames; messages.js renders the thumbnail strip)
+	return r
+
+def records(msgs, user_id):
+	dates.current().localize(msgs, 'sent')
+	return [r for msg in msgs if (r := record(msg, user_id))]
+
+
+# Tests and benchmark ---------------------------------------------------------
+
+def _sample_messages(count = 60):
+	# Every variant html.message() knows about, in reply chains (nested several deep), with drafts sprinkled in
+	result = []
+	for i in range(1, count + 1):
+		reply_to = None if i % 5 == 1 else (i - 1 if i % 3 else i - 2)
+		result.append(dict(
+			id = i,
+			sender_id = 1 + i % 3,
+			sender = 'Sender <&> "Quoted"' if i % 7 == 0 else f'user{i % 3}',
+			sent = None if i % 11 == 0 else f'2024-0{1 + i % 9}-1{i % 10} 1{i % 10}:3{i % 10}:00Z',
+			reply_to = reply_to,
+			reply_chain_patriarch = i - (i - 1) % 5,
+			parent_teaser = f'parent <b>{reply_to}</b> & {{braces}}' if reply_to else None,
+			edited = i % 4 == 0,
+			message = f'<div>Hello {{world}} #{i}, see [the link](https://example.com/a_(b)_{i}) & more</div>' if i % 2 else f'plain {i}',
+			attachments = ','.join(('ab_x.jpg', 'cd_y.mp4', 'ef z.pdf', 'gh_w.png')[:i % 5]),
+			pinned = i % 6 == 0,
+			tags = ','.join(f'tag{n}' for n in range(i % 6)),
+			deleted = None,
+		))
+		result[-1]['rendered'] = db.render_message(result[-1]['message'])
+	return result
+
+def _both(func, *args, **kwargs):
+	expected = getattr(html, func)(*args, **kwargs)
+	fragments.clear() # (render afresh, not from earlier tests' fragments)
+	actual = getattr(sys.modules[__name__], func)(*args, **kwargs)
+	if isinstance(expected, tuple):
+		return (expected[0], expected[1].render()), (actual[0], actual[1].render())
+	return expected.render(), actual.render()
+
+@addtest()
+def test_messages(self):
+	msgs = _sample_messages()
+	for user_id in (1, 2):
+		for is_admin in (False, True):
+			for stashable, deferrable, skip_first_hr, whole_thread in ((True, True, True, False), (False, False, False, False), (True, False, False, True)):
+				expected, actual = _both('messages', msgs, user_id, is_admin, stashable, deferrable, None, skip_first_hr, whole_thread = whole_thread)
+				self.assertEqual(expected, actual)
+	self.assertEqual(*_both('messages', msgs, 1, False, True, True, msgs[3]['reply_chain_patriarch']))
+	self.assertEqual(*_both('messages', [], 1, False, True, True))
+
+@addtest()
+def test_message(self):
+	for msg in _sample_messages():
+		if msg['sent']:
+			for injection in (False, True):
+				self.assertEqual(*_both('message', msg, 1, False, True, True, None, injection = injection))
+				self.assertEqual(*_both('message', msg, 2, True, False, False, msg['reply_chain_patriarch'], injection = injection, whole_thread = True))
+
+@addtest()
+def test_inline_reply_box(self):
+	self.assertEqual(*_both('inline_reply_box', 5, 3))
+	self.assertEqual(*_both('inline_reply_box', 5, 3, '<div>draft {x} & "y"</div>'))
+
+@addtest()
+def test_thumbnail_strip(self):
+	self.assertEqual(*_both('thumbnail_strip', ['ab_x.jpg', 'cd_y.MP4', 'ef z.pdf', 'gh_w.m4a']))
+
+@addtest()
+def test_fragment_cache(self):
+	msgs = [m for m in _sample_messages() if not m['attachments']]
+	render = lambda: messages(msgs, 1, False, True, True).render()
+	fragments.clear()
+	first = render()
+	hits = fragments.hits
+	self.assertEqual(render(), first)
+	self.assertGreater(fragments.hits, hits)
+	msgs[2]['rendered'] = 'changed'
+	self.assertEqual(render(), first) # stale - nobody invalidated...
+	fragments.invalidate_message(msgs[2]['id'])
+	self.assertNotEqual(render(), first) # ...but now
+	self.assertIn('changed', render())
+	fragments.max_bytes, max_bytes = 1000, fragments.max_bytes
+	try:
+		fragments.clear()
+		self.assertIn('changed', render())
+		self.assertLessEqual(fragments.stats()['bytes'], 1000)
+	finally:
+		fragments.max_bytes = max_bytes
+
+@addtest()
+def test_fragment_versions(self):
+	c = FragmentCache(1000, 2)
+	cache.caches['fragments'] = fragments # (c registered itself in place of the real one)
+	c.put_fragment((1, 0, 'v'), 'one')
+	c.put_fragment((2, 0, 'v'), 'two')
+	c.invalidate_message(1)
+	c.put_fragment((1, 0, 'v'), 'stale') # (rendered before the change)
+	self.assertIsNone(c.get((1, 0, 'v')))
+	c.put_fragment((1, 1, 'v'), 'one again')
+	c.invalidate_message(3)
+	c.invalidate_message(2)
+	c.invalidate_message(4) # (forgets 1's version, and, with it, 1's fragments)
+	self.assertEqual(list(c._versions), [2, 4])
+	self.assertIsNone(c.get((1, 1, 'v')))
+
+@addtest()
+def test_records(self):
+	msgs = _sample_messages()
+	rs = records(msgs, 1)
+	self.assertEqual([r['id'] for r in rs], [m['id'] for m in msgs if m['sent'] or (m['sender_id'] == 1 and m['reply_to'] != None)]) # same rows messages() renders
+	for r in rs:
+		if 'draft' not in r:
+			self.assertNotIn('[the link]', r['message']) # (links substituted)
+			self.assertEqual('pinned' in r, r['id'] % 6 == 0) # (falsy fields left out)
+	self.assertLess(len(json.dumps(rs)), len(messages(msgs, 1, False, True, True).render()) / 3)
+
+def benchmark(number = 200):
+	msgs = [m for m in _sample_messages(k_benchmark_page_size * 6) if not m['attachments']][:k_benchmark_page_size] # a typical page (attachment rendering is the same (dominate-free) work on both sides; leave it out)
+	fragments.max_bytes = 0 # (the template work, without the fragment cache)
+	for name, renderer in (('dominate', html), ('fast_html', sys.modules[__name__])):
+		seconds = timeit.timeit(lambda: renderer.messages(msgs, 1, False, True, True, None, True).render(), number = number)
+		print(f'{name:>10}: {seconds / number * 1000:.3f} ms per {len(msgs)}-message page')
+	fragments.max_bytes = fragment_cache_bytes
+	seconds = timeit.timeit(lambda: messages(msgs, 1, False, True, True, None, True).render(), number = number)
+	print(f'{"(cached)":>10}: {seconds / number * 1000:.3f} ms per {len(msgs)}-message page; {fragments.stats()}')
+
+k_benchmark_page_size = 10 # settings.messages_per_load, by default
+
+
+if __name__ == '__main__':
+	if sys.argv[1:2] == ['bench']:
+		benchmark()
+	else:
+		unittests()
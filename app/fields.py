@@ -74,6 +74,7 @@ USER = {
 	'username': Field(USERNAME_VALIDATOR, html.Input(text.username, placeholder = False)),
 	'verified': Field(Validator(False), html.Input(type_ = 'date')),
 	'active': Field(None, html.Input(type_ = 'checkbox')),
+	'timezone': Field(Validator(False, valid.TIMEZONE, 1, 64, text.Valid.timezone), html.Input(text.timezone, placeholder = False)), # the user's preference, over the browser's (see main._identified())
 }
 
 RESET_CODE = {
@@ -8,22 +8,23 @@ import logging
 from copy import copy
 from dataclasses import dataclass, field as dataclass_field
 from enum import Enum
-from datetime import datetime, date, timedelta, timezone
-from random import randint
-import regex as re
+from functools import lru_cache
+from datetime import datetime
 from typing import Callable
-from zoneinfo import ZoneInfo
 
 from dominate import document as dominate_document
 from dominate import tags as t
 from dominate.util import raw
 
+from . import assets
+from . import dates
+from . import media
 from . import text
 from . import messages_const
 from . import assignments_const
 
 from .const import *
-from .settings import cache_buster
+from .settings import hls_videos
 
 
 # Logging ---------------------------------------------------------------------
@@ -41,14 +42,14 @@ _send = lambda app, task, **args: f"{app}.send_ws('{task}'" + (f', {{ {", ".join
 
 _cancel_button = lambda title = text.cancel: t.button(title, onclick = _send('main', 'finish'))
 
-k_url_rec = re.compile(k_url_re)
 
 # Document --------------------------------------------------------------------
 
 # Note that there's really only one "document"
 
-def document(ws_url: str, initial = ''):
-	d = _doc(('common.css',))
+def document(ws_url: str):
+	# The same for every page load (per host), so that it can be rendered (and compressed) just once - see main._shell_response(); so, anything variable comes from the url, client-side
+	d = _doc('app.css')
 	with d:
 		t.div(id = 'gray_screen', cls = 'hide') # invisible at first; for dialog_screen, later
 		t.div(id = 'dialog_screen', cls = 'hide') # invisible at first
@@ -65,10 +66,10 @@ def document(ws_url: str, initial = ''):
 				t.div(text.loading)
 
 		with t.div(id = 'scripts', cls = 'container'):
-			t.script(raw(f'var ws = new WebSocket("{ws_url}");'))
-			t.script(raw(f'const initial = "{initial}";'))
-			for script in ('basic.js', 'ws.js', 'persistence.js', 'main.js', 'admin.js', 'submit.js', 'messages.js', 'assignments.js'): # TODO: only load admin.js if user is an admin (somehow? - dom-manipulate with $('scripts').insertAdjacentHTML("beforeend", ...) after login!)!
-				t.script(src = f'/static/js/{script}')
+			t.script(raw('var ws = new WebSocket(document.currentScript.dataset.ws);'), data_ws = ws_url)
+			t.script(raw("const initial = location.pathname.startsWith('/invite/') ? 'code:' + decodeURIComponent(location.pathname.split('/')[2]) : '';")) # an invitation (see main.accept_invite()), else '' 
+			for src in assets.urls('app.js'): # TODO: only load admin.js if user is an admin (somehow? - dom-manipulate with $('scripts').insertAdjacentHTML("beforeend", ...) after login!)!
+				t.script(src = src)
 	return d
 
 
@@ -510,7 +511,7 @@ def user_table(users):
 			with t.tr():
 				t.td(user['username'], cls = 'pointered', align = 'right', onclick = user_detail(user))
 				t.td(f"{user['first_name']} {user['last_name']}", cls = 'pointered', align = 'left', onclick = _send('admin', 'person_detail', person_id = user['person_id']))
-				t.td(datetime.fromisoformat(user['created']).strftime('%m/%d/%Y %H:%M'), align = 'center')
+				t.td(dates.current().local(user['created']).strftime('%m/%d/%Y %H:%M'), align = 'center')
 				t.td(user['verified'] or '', cls = 'pointered', align = 'center', onclick = user_detail(user))
 				t.td(_yes_or_no(int(user['active'])), align = 'center', cls = 'pointered', onclick = user_detail(user))
 	return result
@@ -825,57 +826,73 @@ def no_messages(searchtext = None):
 
 def assignments(assignments):
 	result = t.div(cls = 'container')
-	class_name = None
-	resource_name = None
-	class_div = None
-	week = None
-	class_counter = 0
-	right_page = False
-	for assignment in assignments:
-		# Insert page-break to go to new week ("left page") if we're on a new week
-		if assignment['week'] != week:
-			class_name = None # force reset of class, to make hr()s appropriate, etc.
-			result.add(t.hr(cls = 'page_break_after')) # even first time 'round, when week is None, in order to get the first detail page to be a back-side (double-sided print)
-			if not right_page and week != None:
-				result.add(t.div(cls = 'page_break_after zero')) # a SECOND page-break, for a blank right page, so that starts are always on left pages
-			week = assignment['week']
-			right_page = False
-			class_counter = 0
-			start_date, end_date = casual_date2(assignment['start_date']), casual_date2(assignment['end_date'])
-			header = f"{text.week} {week} ({start_date} - {end_date})"
-			if False:
-				header += f"- {assignment['first_name']} {assignment['last_name']}"
-			result.add(t.div(header, cls = 'week_header'))
-		if assignment['class_name'] != class_name:
-			class_name = assignment['class_name']
-			result.add(t.hr(cls = 'gray'))
-			# Insert page-break to shift to "right page" if necessary:
-			class_counter += 1
-			if not right_page and class_counter > assignments_const.k_classes_per_page:
-				result.add(t.div(cls = 'page_break_after zero'))
-				right_page = True
-		if assignment['resource_name'] != resource_name:
-			resource_name = assignment['resource_name']
-			full_class_name = class_name + (f'(S{assignment["section"]}) - ' if assignment['teacher'] else ' - ')
-			result.add(t.div(full_class_name, t.em(resource_name), cls = 'assignment_header'))
-
-		instruction = assignment['instruction']
-		instruction = instruction.replace('{chapters}', str(assignment['chapters']))
-		instruction = instruction.replace('{pages}', str(assignment['pages']))
-		instruction = instruction.replace('{items}', str(assignment['items']))
-		instruction = instruction.replace('{skips}', str(assignment['skips']) if assignment['skips'] else '')
-		if assignment['optional']:
-			instruction = '<b>[optional]</b> ' + instruction
-		if assignment['teacher']:
-			instruction = f'<b>{instruction}</b>'
-
-		checkbox = t.input_(type = 'checkbox', onclick = f"assignments.mark_complete({assignment['assignment_id']}, {assignment['enrollment_id']}, this)")
-		if assignment['complete']:
-			checkbox['checked'] = 'checked'
-		result.add(t.div(t.label(checkbox, raw(instruction))))
-
+	result.add(*AssignmentsRenderer().render(assignments))
 	return result
 
+class AssignmentsRenderer:
+	'''
+	Renders assignment rows (ordered as db.get_assignments() orders them) into the elements of assignments(), but piece by piece - e.g., a week
+	at a time (see assignments.main()) - carrying the page-layout state from one piece to the next.
+	'''
+	def __init__(self):
+		self.week = None
+		self.class_name = None
+		self.resource_name = None
+		self.class_counter = 0
+		self.right_page = False
+
+	def render(self, assignments):
+		result = []
+		for assignment in assignments:
+			# Insert page-break to go to new week ("left page") if we're on a new week
+			if assignment['week'] != self.week:
+				self.class_name = None # force reset of class, to make hr()s appropriate, etc.
+				result.append(t.hr(cls = 'page_break_after')) # even first time 'round, when week is None, in order to get the first detail page to be a back-side (double-sided print)
+				if not self.right_page and self.week != None:
+					result.append(t.div(cls = 'page_break_after zero')) # a SECOND page-break, for a blank right page, so that starts are always on left pages
+				self.week = assignment['week']
+				self.right_page = False
+				self.class_counter = 0
+				start_date, end_date = casual_date2(assignment['start_date']), casual_date2(assignment['end_date'])
+				header = f"{text.week} {self.week} ({start_date} - {end_date})"
+				if False:
+					header += f"- {assignment['first_name']} {assignment['last_name']}"
+				result.append(t.div(header, cls = 'week_header'))
+			if assignment['class_name'] != self.class_name:
+				self.class_name = assignment['class_name']
+				result.append(t.hr(cls = 'gray'))
+				# Insert page-break to shift to "right page" if necessary:
+				self.class_counter += 1
+				if not self.right_page and self.class_counter > assignments_const.k_classes_per_page:
+					result.append(t.div(cls = 'page_break_after zero'))
+					self.right_page = True
+			if assignment['resource_name'] != self.resource_name:
+				self.resource_name = assignment['resource_name']
+				full_class_name = self.class_name + (f'(S{assignment["section"]}) - ' if assignment['teacher'] else ' - ')
+				result.append(t.div(full_class_name, t.em(self.resource_name), cls = 'assignment_header'))
+
+			instruction = _instruction_template(assignment['instruction'])(chapters = assignment['chapters'], pages = assignment['pages'], items = assignment['items'], skips = assignment['skips'] or '')
+			if assignment['optional']:
+				instruction = '<b>[optional]</b> ' + instruction
+			if assignment['teacher']:
+				instruction = f'<b>{instruction}</b>'
+
+			checkbox = t.input_(type = 'checkbox', onclick = f"assignments.mark_complete({assignment['assignment_id']}, {assignment['enrollment_id']}, this)")
+			if assignment['complete']:
+				checkbox['checked'] = 'checked'
+			result.append(t.div(t.label(checkbox, raw(instruction))))
+		return result
+
+@lru_cache(maxsize = 1024)
+def _instruction_template(instruction):
+	# Compile an instruction's text, once, into a format() - its {chapters}, {pages}, {items} and {skips} become fields, and any other braces stay literal
+	template = instruction.replace('{', '{{').replace('}', '}}')
+	for name in ('chapters', 'pages', 'items', 'skips'):
+		template = template.replace('{{' + name + '}}', '{' + name + '}')
+	return template.format
+
+
+# NOTE: fast_html mirrors messages(), message(), inline_reply_box() and thumbnail_strip() for the hot path - change markup here, change it there (python -m app.fast_html checks that they still match)
 def messages(msgs, user_id, is_admin, stashable, deferrable, last_thread_patriarch = None, skip_first_hr = False, searchtext = None, whole_thread = False):
 	top = t.div(cls = 'container')
 	parents = {None: top}
@@ -885,6 +902,8 @@ def messages(msgs, user_id, is_admin, stashable, deferrable, last_thread_patriar
 			html_message = inline_reply_box(msg['id'], msg['reply_to'], msg['message'])
 		elif msg['sent']: # this test ensures we don't try to present draft messages that aren't replies - user has to re-engage with those in a different way ("new message", then select among drafts)... note that the data (msgs) DO include (or MAY include) non-reply (top-level parent) draft messages; we don't want those messages in our message list here
 			last_thread_patriarch, html_message = message(msg, user_id, is_admin, stashable, deferrable, last_thread_patriarch, skip_first_hr, searchtext = searchtext, whole_thread = whole_thread)
+		else:
+			continue # (otherwise, we'd add the PRIOR html_message (again), or fail on an unassigned one)
 		parent = parents.get(msg['reply_to'], top)
 		parent.add(html_message)
 		parents[msg['id']] = html_message
@@ -915,7 +934,7 @@ def message(msg, user_id, is_admin, stashable, deferrable, thread_patriarch = No
 		if msg['edited']:
 			t.div(text.edited + ':', cls = 'italic bold')
 
-		t.div(raw(re.sub(k_url_rec, k_url_replacement, msg['message']))) # replace url markdown "links" with real <a href>s
+		t.div(raw(msg['rendered'])) # url markdown "links" already replaced with real <a href>s (see db.render_message())
 
 		if msg['attachments']:
 			with t.div(id = f"attachments_for_message_{msg['id']}"):
@@ -950,7 +969,7 @@ def message(msg, user_id, is_admin, stashable, deferrable, thread_patriarch = No
 								onclick = f"messages.change_recipients({msg['id']})") if editable else ''
 			thread_button = t.button(t.i(cls = 'i i-thread'), title = text.thread,
 								onclick = _send('messages', 'show_whole_thread', message_id = msg['id'], patriarch_id = msg['reply_chain_patriarch'])) if not whole_thread else '' # no thread-button when whole-thread is already expanded
-			isodate = local_date_iso(msg["sent"]).isoformat()[:-6] # [:-6] to trim offset from end, as javascript code will expect a naive iso variant, and will interpret as "local"
+			isodate = dates.current().iso(msg["sent"]) # javascript code expects a naive iso variant, and will interpret it as "local"
 			t.div(cls = 'spacer')
 			t.button(t.i(cls = 'i i-reply'), title = text.reply, onclick = _send('messages', 'compose_reply', message_id = msg['id'])) # '◄'
 			t.span(t.b(' to '), edit_recips_button, recipients, thread_button, ' · ')
@@ -970,32 +989,43 @@ def message_tags_table(message_tags, available_tags, mid, count):
 
 def thumbnail_strip(filenames):
 	result = t.div(cls = 'thumbnail_strip')
-	cache_bust = randint(1000, 9999)
 	with result:
 		for name in filenames:
 			path = f'/{k_upload_path}{name}'
 			lilname = name.lower()
 			poster_path = path + k_thumb_appendix
+			onclick = None # (e.g., audio - no player yet)
 			if lilname.endswith(k_video_formats):
-				onclick = f'messages.play_video("{path}", "{poster_path}")'
+				onclick = f'messages.play_video("{path}", "{poster_path}", "{path}{k_hls_appendix}/master.m3u8")' if hls_videos else f'messages.play_video("{path}", "{poster_path}")'
 			elif lilname.endswith(k_image_formats):
-				onclick = f'messages.play_image("{path}")'
+				onclick = f'messages.play_image("{path}", "{media.srcset(name, "webp")}", "{media.srcset(name, "jpg")}")'
+				t.span(_picture(media.thumb_url(name), name, k_thumbnail_sizes), onclick = onclick)
+				continue
 			elif lilname.endswith(k_pdf_formats):
-				onclick = f'messages.play_pdf("{path}")'
-			t.span(t.img(src = f'/{k_upload_path}{name}{k_thumb_appendix}?cache_bust={cache_bust}', alt = name), onclick = onclick)
+				onclick = f'messages.play_pdf("{path}", "{media.url(name, "")}")'
+			t.span(t.img(src = media.thumb_url(name), alt = name), onclick = onclick)
 	return result
 
 
 # Utils -----------------------------------------------------------------------
 
+class picture(t.html_tag): pass # dominate doesn't (yet) provide <picture>
 
-def _doc(css = None): # `css` expected to be a list/tuple of filenames, like ('default.css', 'extra.css', )
+def _picture(src, name, sizes):
+	# WebP ladder for browsers that take it, JPEG ladder (in the <img> itself) for those that don't; `src` is the fallback for browsers that know neither <picture> nor srcset
+	return picture(
+		t.source(type = 'image/webp', srcset = media.srcset(name, 'webp'), sizes = sizes),
+		t.img(src = src, srcset = media.srcset(name, 'jpg'), sizes = sizes, alt = name),
+	)
+
+
+def _doc(css = None): # `css` expected to be an assets bundle name, like 'app.css'
 	d = dominate_document(title = text.doc_title)
 	with d.head:
 		t.meta(name = 'viewport', content = 'width=device-width, initial-scale=1')
 		if css:
-			for c in css:
-				t.link(href = f'/static/css/{c}?{cache_buster}', rel = 'stylesheet')
+			for href in assets.urls(css):
+				t.link(href = href, rel = 'stylesheet')
 		t.script(raw('let FF_FOUC_FIX;')) # trick to avoid possible FOUC complaints (https://stackoverflow.com/questions/21147149/flash-of-unstyled-content-fouc-in-firefox-only-is-ff-slow-renderer) - note that this doesn't cause the warning to go away, it seems, but may cause the problem (if it actually ever visually exhibited) to go away.
 	return d
 
@@ -1053,46 +1083,8 @@ def _xaa_table(availables, assigneds, name_fetcher, left_title, right_title, add
 	return result
 
 
-k_fake_localtz = 'America/Los_Angeles' # TODO - implement user-local timezones (this will be a per-user field in db)!
-def local_date_iso(raw_date, zone_info = None):
-	assert raw_date != None
-	if isinstance(raw_date, datetime) or isinstance(raw_date, date):
-		raw_date = raw_date.isoformat() # ACK?!! TODO - make datetimes more consistant!
-	zi = zone_info or ZoneInfo(k_fake_localtz) # manage all datetimes wrt/ user's local tz, so that "yesterday" means that from the local user's perspective, not from UTC or server-local
-	return datetime.fromisoformat(raw_date).astimezone(zi).astimezone(None) # no need to .replace(tzinfo = timezone.utc) on fromisoformat result because we put the trailing 'Z' on dates in the db, so this fromisoformat() will interpret the datetime not as naive, but at explicitly UTC
-
-def casual_date(raw_date): # NOTE: we have an equivalent version of this in Javascript, client-side, in order to update periodically.
-	zi = ZoneInfo(k_fake_localtz)
-	dt = local_date_iso(raw_date, zi)
-	now = datetime.now(timezone.utc).astimezone(zi)
-	today = datetime.combine(now.date(), datetime.min.time(), now.tzinfo)
-	if now - dt < timedelta(hours = 1): # within the last hour
-		diff = now - dt
-		if diff.seconds < 2:
-			return 'just now'
-		elif diff.seconds < 60:
-			return f"{diff.seconds} seconds ago"
-		else:
-			return f"{diff.seconds // 60} minutes ago"
-	elif dt >= today: # earlier today
-		return dt.strftime('%I:%M %p')
-	elif today - timedelta(days = 1) < dt < today: # yesterday
-		return f"yesterday @ {dt.strftime('%I:%M %p')}"
-	else: # before yesterday
-		return dt.strftime('%m/%d/%Y')
-
-def casual_date2(raw_date):
-	zi = ZoneInfo(k_fake_localtz)
-	dt = local_date_iso(raw_date, zi)
-	now = datetime.now(timezone.utc).astimezone(zi)
-	today_zero = datetime.combine(now.date(), datetime.min.time(), now.tzinfo)
-	dt_zero = datetime.combine(dt.date(), datetime.min.time(), now.tzinfo)
-	if today_zero == dt_zero:
-		return text.today
-	elif today_zero.year == dt.year:
-		return dt.strftime('%b %d')
-	else:
-		return dt.strftime('%m/%d/%Y')
+casual_date = lambda raw_date: dates.current().casual(raw_date)
+casual_date2 = lambda raw_date: dates.current().casual2(raw_date)
 
 
 @dataclass(slots = True, frozen = True)
@@ -3,13 +3,22 @@ __copyright__ = '2024'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+import gzip
+import hmac
 import logging
+import os
 import traceback
 import json
 
 from dataclasses import dataclass, field as dataclass_field
+from hashlib import sha256
 from yarl import URL
 
+try:
+	import brotli # pip install Brotli (optional - without it, the shell document is served gzipped, only)
+except ImportError:
+	brotli = None
+
 import aiosqlite
 import asyncio
 
@@ -20,15 +29,25 @@ from . import admin
 from . import assignments
 from . import messages
 
+from . import assets
+from . import cache
+from . import dates
 from . import db
 from . import emailer
 from . import fields
 from . import html
+from . import media as media_
+from . import memory as memory_
+from . import metrics as metrics_
+from . import profiler
+from . import sessions
 from . import settings
+from . import shared
 from . import task
 from .task import Task
 from . import text
 from . import valid
+from . import watchdog
 from . import ws
 
 from . import exception as ex
@@ -50,6 +69,7 @@ l = logging.getLogger(__name__)
 # Shortcuts -------------------------------------------------------------------
 
 hr = lambda text: web.Response(text = text, content_type = 'text/html')
+k_immutable = 'public, max-age=31536000, immutable'
 gurl = lambda rq, name, **kwargs: str(rq.app.router[name].url_for(**kwargs))
 dbc = lambda rq: db.cursor(rq.app['db_connection'])
 
@@ -61,13 +81,24 @@ rt = web.RouteTableDef()
 async def _init(app):
 	l.info('Initializing...')
 	app['hds'] = []
-	app['hd_backups'] = {}
-	app['active_module'] = 'app.main' # default to ourselves
+	app['media_cache'] = media_.DerivativeCache(k_media_cache_path, settings.media_cache_bytes)
+	app['shells'] = {} # host -> Shell (see _shell_response())
+	if settings.bundle_assets:
+		assets.build() # (before any shell is rendered - it links the builds)
 	await _init_db(app)
+	await sessions.start(app)
+	app['touch_flusher'] = asyncio.create_task(_flush_touches_periodically(app))
+	watchdog.start(app)
 	l.info('...initialization complete')
 
 async def _shutdown(app):
 	l.info('Shutting down...')
+	watchdog.stop(app)
+	await sessions.stop(app) # (first - closing connections loses them)
+	app['touch_flusher'].cancel()
+	async with app['background_lock']:
+		await db.flush_touches(app['background_db'])
+	await app['background_db'].close()
 	while True:
 		try:
 			hd = app['hds'].pop()
@@ -81,8 +112,21 @@ async def _init_db(app):
 
 	app['db_connection'] = await db.connect(settings.db_filename) # sqlite3 offers an "efficient" approach that involves just using the database (dbc) directly - a temp cursor is auto-created under the hood): https://pysqlite.readthedocs.io/en/latest/sqlite3.html#using-sqlite3-efficiently ... however, there's nothing wrong with using connection.cursor() to get and interact (in the more conventional way) with a cursor object rather than interacting with the DB connection object itself.  Note that doing so does NOT imply a separate transaction for every cursor - use db.begin(dbc), db.rollback(dbc), db.commit(dbc) for that....
 
+	app['background_db'] = await db.connect(settings.db_filename) # for writes made in the background (session snapshots, id_key touches), on their own connection, so that they never land in some handler's transaction
+	app['background_lock'] = asyncio.Lock() # held by each background writer (sessions' flushes and takes, touch flushes), so that one's writes never land in another's transaction (e.g., db.save_sessions()'), to be lost in its rollback
+	await db.migrate(app['background_db']) # (before anybody reads a column it adds)
+
 	l.info('...database initialized...')
 
+async def _flush_touches_periodically(app):
+	while True:
+		await asyncio.sleep(settings.touch_flush_seconds)
+		try:
+			async with app['background_lock']:
+				await db.flush_touches(app['background_db'])
+		except Exception:
+			l.error(traceback.format_exc())
+
 
 # Run server like so, from cli, from root directory (containing 'app' directory):
 #		python -m aiohttp.web -H localhost -P 8080 app.main:init
@@ -100,6 +144,9 @@ def init(argv):
 	app.on_startup.append(_init)
 	app.on_shutdown.append(_shutdown)
 
+	if settings.debug:
+		app.on_response_prepare.append(_immutable_static) # (nginx does this, otherwise - see etc/)
+
 	return app
 
 
@@ -113,6 +160,10 @@ def init(argv):
 
 if settings.debug:
 	rt.static('/static', settings.debug_static)
+
+	async def _immutable_static(rq, response):
+		if rq.path.startswith(('/' + assets.k_build_path, '/' + k_upload_path)) and response.status == 200:
+			response.headers['Cache-Control'] = k_immutable # content-hashed builds (see assets.build()) and uploads (uniquely named, written once; see also k_thumb_version) never change
 #else use "real" reverse proxy set up in nginx, e.g., to map static directly
 
 if settings.debug:
@@ -123,12 +174,75 @@ if settings.debug:
 
 @rt.get('/')
 async def main(rq):
-	return hr(html.document(_ws_url(rq)).render())
+	return _shell_response(rq)
 
 @rt.get('/invite/{code}')
 async def accept_invite(rq):
-	code = rq.match_info['code'][:db.k_reset_code_length].replace('"', '') # simple sanitation; sufficient
-	return hr(html.document(_ws_url(rq), f'code:{code}').render())
+	return _shell_response(rq) # the same document; its script takes the code from the url (see html.document() and identify())
+
+@rt.get('/media/{version}/{name}/{variant}')
+async def media(rq): # (`version` is just for browser-cache busting - see media.url(); an outdated one gets the current derivative)
+	name = rq.match_info['name']
+	if '/' in name or name.startswith('.') or not (derivative := media_.derivative(name, rq.match_info['variant'])) or not os.path.isfile(k_upload_path + name):
+		raise web.HTTPNotFound()
+	key, make, content_type = derivative
+	try:
+		fp = await rq.app['media_cache'].get(key, make)
+	except ex.NotFound:
+		raise web.HTTPNotFound()
+	except media_.k_transient_errors:
+		l.error(traceback.format_exc())
+		raise web.HTTPServiceUnavailable(headers = {'Retry-After': '30'})
+	except Exception: # a corrupt (or mis-named) upload, that Pillow or poppler can't read
+		l.error(traceback.format_exc())
+		raise web.HTTPNotFound()
+	return web.FileResponse(fp, headers = {'Content-Type': content_type, 'Cache-Control': k_immutable})
+
+def _authorize_diagnostics(rq):
+	'''
+	Diagnostic routes (/metrics...) answer only requests bearing settings.diagnostics_token (as "Authorization: Bearer <token>"), and exist
+	only if it's set.  (Not by remote address - behind nginx, on a unix socket, that's empty, and behind a TCP proxy it'd be the proxy's;
+	nginx denies these paths anyway - see etc/ - so scrapers reach the app's socket directly, e.g., curl --unix-socket.)
+	'''
+	if not settings.diagnostics_token:
+		raise web.HTTPNotFound()
+	if not hmac.compare_digest(rq.headers.get('Authorization', '').encode(), f'Bearer {settings.diagnostics_token}'.encode()):
+		raise web.HTTPForbidden()
+
+@rt.get('/metrics')
+async def metrics(rq): # (for Prometheus - with authorization credentials - or any scraper, to poll)
+	_authorize_diagnostics(rq)
+	hds = rq.app['hds']
+	caches = cache.stats()
+	gauges = [
+		metrics_.gauge('um_connections', 'Open websocket connections', len(hds)),
+		metrics_.gauge('um_users', 'Distinct users with open websocket connections', len(set(hd.uid for hd in hds if hd.uid))),
+		metrics_.gauge('um_hash_queued', 'Password hashings/checks waiting for a thread', db.hash_stats()['queued']),
+	]
+	for stat in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'invalidations'):
+		gauges.append(metrics_.gauge(f'um_cache_{stat}', f'Cache {stat}', dict(((('cache', name),), s[stat]) for name, s in caches.items())))
+	return web.Response(text = metrics_.render(*gauges), content_type = 'text/plain', charset = 'utf-8')
+
+@rt.get('/profile')
+async def profile(rq): # e.g., curl -s --unix-socket /tmp/um/um_1.sock -H "Authorization: Bearer $TOKEN" 'http://um/profile?seconds=30' | flamegraph.pl > profile.svg
+	_authorize_diagnostics(rq)
+	try:
+		seconds = float(rq.query.get('seconds', 10))
+	except ValueError:
+		raise web.HTTPBadRequest()
+	return web.Response(text = await profiler.profile(seconds), content_type = 'text/plain', charset = 'utf-8')
+
+@rt.get('/memory')
+async def memory(rq): # e.g., curl ... 'http://um/memory' (see profile(), above), or, to find growth: ...?trace=start, later ...?trace=snapshot (repeatedly), ...?trace=stop
+	_authorize_diagnostics(rq)
+	if command := rq.query.get('trace'):
+		try:
+			report = await memory_.trace(command)
+		except ex.InvalidInput:
+			raise web.HTTPBadRequest()
+	else:
+		report = memory_.accounting(rq.app['hds'])
+	return web.Response(text = report, content_type = 'text/plain', charset = 'utf-8')
 
 @rt.get('/_sms/')
 async def sms(rq):
@@ -157,24 +271,27 @@ async def _ws(rq):
 		l.error(traceback.format_exc())
 		l.error('Exception processing WS messages; shutting down WS...')
 	finally:
-		try: rq.app['hds'].remove(hd)
-		except ValueError: pass # not in list; already removed!
+		try:
+			rq.app['hds'].remove(hd)
+			sessions.save(hd) # (for a reconnection to resume)
+		except ValueError: pass # not in list; already removed! (or superseded - see sessions.take())
 		l.info('Websocket connection closed')
 	return wsr
 
 async def _handle_ws_text(rq, hd, data):
 	hd.payload = json.loads(data)
+	dates.use(hd.local_dates) # (this task - the connection's websocket loop - is this connection's alone)
 	module = hd.payload.get('module', 'app.main')
-	active_module = rq.app['active_module']
-	if module != active_module and hd.payload['task'] != 'ping': # (don't switch module for mere (periodic and automatic) pings!)
-		# Call the exit/enter handlers, if switching modules:
-		if 'exit_module' in ws._handlers[active_module]:
-			await ws._handlers[active_module]['exit_module'](hd)
-		if 'enter_module' in ws._handlers[module]:
-			await ws._handlers[module]['enter_module'](hd)
-		rq.app['active_module'] = module # may be redundant, if enter_module() did this already
+	name = hd.payload['task']
+	if module != hd.module and name != 'ping': # (don't switch module for mere (periodic and automatic) pings!)
+		# Call the exit/enter handlers, if switching (this connection's) modules:
+		if on_exit := ws._handlers.get((hd.module, 'exit_module')):
+			await on_exit(hd)
+		if on_enter := ws._handlers.get((module, 'enter_module')):
+			await on_enter(hd)
+		hd.module = module # may be redundant, if enter_module() did this already
 	# Now call the handler for the given task - functions decorated with @ws.handler are handlers; their (function) names are the task names
-	await ws._handlers[module][hd.payload['task']](hd)
+	await ws._handlers[(module, name)](hd)
 
 
 async def _handle_ws_binary(hd, data):
@@ -184,7 +301,7 @@ async def _handle_ws_binary(hd, data):
 	meta = json.loads(data[1:idx]) # '1' to get past the "magic byte" ('!')
 	meta['files'] = json.loads(meta['files'])
 	payload = data[idx+len(delimiter):]
-	await ws._handlers[hd.payload.get('module', 'app.messages')][meta['task']](hd, meta, payload)
+	await ws._handlers[(hd.payload.get('module', 'app.messages'), meta['task'])](hd, meta, payload)
 
 
 # -----------------------------------------------------------------------------
@@ -204,6 +321,8 @@ class Hd: # handler data class; for grouping stuff more convenient to pass aroun
 	payload: dict | None = None
 	task: Task | None = None
 	prior_tasks: list = dataclass_field(default_factory = list)
+	local_dates: dates.LocalDates = dataclass_field(default_factory = dates.default) # the user's timezone's (see _identified())
+	module: str = 'app.main' # the module this connection's client is "in" (see _handle_ws_text(), and the enter_module/exit_module handlers)
 
 @ws.handler
 async def enter_module(hd):
@@ -220,6 +339,15 @@ async def ping(hd):
 	pass # nothing to do
 
 
+async def _identified(hd):
+	'''
+	Set up for (newly identified) user hd.uid: load the user's principal (roles - hd.admin, hd.sub_manager - and settings; see shared.principal()),
+	and set hd.local_dates - the user's own timezone preference, if any, else the browser's.
+	'''
+	p = await shared.principal(hd)
+	hd.local_dates = dates.of((p and p.timezone) or hd.state.get('tz'))
+	dates.use(hd.local_dates) # (for the rest of this handler; _handle_ws_text() does this for later ones)
+
 async def handle_invalid(hd, message, banner):
 	await ws.send_content(hd, banner, html.error(message))
 
@@ -250,6 +378,9 @@ async def filtersearch(hd):
 @ws.handler
 async def identify(hd):
 	idid = hd.idid = hd.payload.get('idid')
+	hd.state['tz'] = hd.payload.get('tz') # the browser's timezone (see _identified())
+	hd.state['page_id'] = hd.payload.get('page_id') # (see sessions.py)
+	await messages.start_json_messages(hd)
 	if key := hd.payload.get('key'):
 		# new identity:
 		await db.add_idid_key(hd.dbc, idid, key)
@@ -257,7 +388,7 @@ async def identify(hd):
 		initial = hd.payload.get('initial')
 		if initial.startswith('code:'):
 			# invite code provided in url; process now:
-			await redeem_invite(hd, initial.split(':')[1])
+			await redeem_invite(hd, initial.split(':')[1][:db.k_reset_code_length])
 		else:
 			# normal login:
 			await login(hd) #await login_or_join(hd)
@@ -266,29 +397,10 @@ async def identify(hd):
 		user_id = await db.get_user_by_id_key(hd.dbc, idid, hd.payload['pub'], hd.payload['hsh']) # note that if user is inactive, this will return None!
 		if user_id: # "persistent session" all in order, "auto log-in"... go straight to it:
 			hd.uid = user_id
-			hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
-			hd.sub_manager = await db.authorized(hd.dbc, hd.uid, 'sub-manager')
-			app = hd.rq.app
-			if False: # idid in app['hd_backups'].keys():
-				#TEMPORARILY disabling, due to troubles (blank screen/no-load problems)
-				#l.debug('BACKUP exists; loading from it...')
-				backup = app['hd_backups'][idid]
-				assert(hd.uid == backup.uid) # TODO: more than assert, here!
-				hd.state = backup.state
-				hd.payload = backup.payload
-				hd.task = backup.task
-				hd.prior_tasks = backup.prior_tasks
-				app['hd_backups'][idid] = hd # re-assign to the new hd
-				if hd.task:
-					hd.task.restart = True
-					await hd.task.handler(hd) # show whatever page we were on last
-				else:
-					# TODO: DRY - these two lines are also below!
-					await ws.send(hd, 'set_topbar_color', color = await db.get_user_color(hd.dbc, hd.uid))
-					await messages.messages(hd) # show main messages page
+			await _identified(hd)
+			if hd.payload.get('resume') and await sessions.resume(hd): # the same page, reconnecting (see ws.js) - it still shows what it did, so just catch it up
+				await messages.catch_up(hd)
 			else:
-				#l.debug('NO backup; loading new hd...')
-				app['hd_backups'][idid] = hd
 				await ws.send(hd, 'set_topbar_color', color = await db.get_user_color(hd.dbc, hd.uid))
 				await messages.messages(hd) # show main messages page
 		else:
@@ -310,10 +422,14 @@ async def login(hd, reverting = False, username = None):
 		if await valid.invalids(hd, data, fields.LOGIN, handle_invalid, 'banner'):
 			return # if there WERE invalids, banner was already sent within
 		#else all good, move on!
-		uid = await db.login(hd.dbc, hd.idid, data['username'], data['password']) # Note that if user is inactive, this will return None!
+		try:
+			uid = await db.login(hd.dbc, hd.idid, data['username'], data['password']) # Note that if user is inactive, this will return None!
+		except ex.Throttled:
+			await ws.send_content(hd, 'banner', html.error(text.too_many_logins))
+			return
 		if uid:
 			hd.uid = uid
-			hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
+			await _identified(hd)
 			await ws.send(hd, 'set_topbar_color', color = await db.get_user_color(hd.dbc, hd.uid))
 			await messages.messages(hd)
 		else:
@@ -325,7 +441,7 @@ async def switch_login(hd):
 	uid = await db.get_user_id(hd.dbc, username)
 	if not hd.payload['require_password_on_switch']:
 		hd.uid = uid
-		hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
+		await _identified(hd)
 		await db.force_login(hd.dbc, hd.idid, hd.uid)
 		await ws.send(hd, 'set_topbar_color', color = await db.get_user_color(hd.dbc, hd.uid))
 		await messages.messages(hd)
@@ -347,9 +463,9 @@ async def redeem_invite(hd, code = None):
 		if password != data.get('password_confirmation'):
 			await ws.send_content(hd, 'banner', html.error(text.Valid.password_match))
 		else:
-			await db.reset_user_password(hd.dbc, hd.task.state['user_id'], password)
+			await db.reset_user_password(hd.dbc, hd.task.state['user_id'], password, hd.idid)
 			hd.uid = hd.task.state['user_id']
-			hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
+			await _identified(hd)
 			await db.force_login(hd.dbc, hd.idid, hd.uid)
 			await messages.messages(hd)
 
@@ -395,9 +511,9 @@ async def forgot_password(hd):
 			if password != data.get('password_confirmation'):
 				await ws.send_content(hd, 'banner', html.error(text.Valid.password_match))
 			else:
-				await db.reset_user_password(hd.dbc, hd.task.state['user_id'], password)
+				await db.reset_user_password(hd.dbc, hd.task.state['user_id'], password, hd.idid)
 				hd.uid = hd.task.state['user_id']
-				hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
+				await _identified(hd)
 				await db.force_login(hd.dbc, hd.idid, hd.uid)
 				await messages.messages(hd)
 
@@ -514,10 +630,10 @@ async def continue_join_or_invite(hd, send_username_fieldset):
 				await ws.send_content(hd, 'banner', html.error(text.Valid.password_match))
 				return # finished
 			#else all good, move on!
-			await db.reset_user_password(hd.dbc, hd.task.state['user_id'], data['password'])
+			await db.reset_user_password(hd.dbc, hd.task.state['user_id'], data['password'], hd.idid)
 			await db.commit(hd.dbc) # finally, commit it all
 			hd.uid = hd.task.state['user_id']
-			hd.admin = await db.authorized(hd.dbc, hd.uid, 'admin')
+			await _identified(hd)
 			await db.force_login(hd.dbc, hd.idid, hd.uid)
 			task.clear_all(hd) # a "join" results in a clean slate - no prior tasks (note that, above, the end of invite, after the db-commit, we DO finish() to revert to prior task, which may be administrative user-list management.....
 			await ws.send(hd, 'hide_dialog') # safe; no need to finish() task - we just logged in (force_login) and have a clean slate
@@ -541,6 +657,52 @@ def _not_yet(hd, required_action):
 	hd.task.state['action'] = required_action
 	return True # "true, NOT YET ready to move on!"
 
+@dataclass(slots = True)
+class Shell: # the main html document, rendered and compressed once (per host)
+	identity: bytes
+	gzip: bytes
+	br: bytes | None
+	digest: str # (of the identity body; see _shell_response() for the per-encoding ETags made from it)
+
+k_max_shells = 16 # (one per host name we're reached by, normally just one or two; this cap is for junk Host headers)
+
+def _make_shell(document):
+	body = document.encode()
+	return Shell(body, gzip.compress(body, 9), brotli.compress(body) if brotli else None, sha256(body).hexdigest()[:20])
+
+def _shell_response(rq):
+	shells = rq.app['shells']
+	if not (shell := shells.get(rq.host)):
+		if len(shells) >= k_max_shells:
+			shells.clear()
+		shell = shells[rq.host] = _make_shell(html.document(str(_ws_url(rq))).render())
+	accept = _accepted_encodings(rq.headers.get('Accept-Encoding', ''))
+	body, encoding = shell.identity, None
+	if shell.br and 'br' in accept:
+		body, encoding = shell.br, 'br'
+	elif 'gzip' in accept:
+		body, encoding = shell.gzip, 'gzip'
+	etag = f'"{shell.digest}-{encoding}"' if encoding else f'"{shell.digest}"' # a strong ETag names one exact body, so each encoding gets its own
+	headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'} # no-cache: revalidate every time (a cheap 304, usually), so a new deploy's document (and its cache_buster) is seen right away
+	if etag in rq.headers.get('If-None-Match', ''):
+		return web.Response(status = 304, headers = headers)
+	if encoding:
+		headers['Content-Encoding'] = encoding
+	return web.Response(body = body, content_type = 'text/html', charset = 'utf-8', headers = headers)
+
+def _accepted_encodings(header):
+	'''The codings an Accept-Encoding `header` accepts - all those listed, but for any given q=0 (refused).'''
+	result = set()
+	for each in header.lower().split(','):
+		coding, *params = [part.strip() for part in each.split(';')]
+		q = next((param.partition('=')[2].strip() for param in params if param.partition('=')[0].strip() == 'q'), '1')
+		try:
+			if float(q) > 0:
+				result.add(coding)
+		except ValueError:
+			pass # (malformed; as good as refused)
+	return result
+
 def _ws_url(rq):
 	host = rq.host.split(':')
 	port = int(host[1]) if len(host) > 1 else None
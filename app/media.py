@@ -0,0 +1,183 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import logging
+import os
+import shutil
+
+from collections import OrderedDict
+from functools import lru_cache, partial
+from urllib.parse import quote
+
+import imageio_ffmpeg # (installed with moviepy) provides an ffmpeg binary
+import pdf2image
+from PIL import Image # pip install Pillow
+
+from . import exception as ex
+from . import settings
+
+from .const import *
+
+l = logging.getLogger(__name__)
+
+
+k_derivative_formats = {'webp': 'WEBP', 'jpg': 'JPEG'}
+k_content_types = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+k_transient_errors = (pdf2image.exceptions.PDFPopplerTimeoutError, pdf2image.exceptions.PopplerNotInstalledError) # derivative generation failures worth retrying (others mean an unrenderable upload)
+
+_jobs = set() # strong references to background jobs (the event loop keeps only weak ones)
+_hls_slots = asyncio.Semaphore(settings.hls_jobs) # ffmpeg HLS packagings allowed at once (see package_hls()); a batch upload's others queue here
+
+url = lambda name, variant: f'/media/v{k_derivative_version}/{quote(name)}/{variant}'
+thumb_url = lambda name: f'/{k_upload_path}{name}{k_thumb_appendix}?v={k_thumb_version}'
+srcset = lambda name, fmt: ', '.join(f'{url(name, f"{w}w.{fmt}")} {w}w' for w in k_image_widths) # quote()ing matters here - srcset is whitespace-delimited, and filenames may have spaces
+
+
+def derivative(name, variant):
+	'''Return (cache key, generator, content type) for `variant` of upload `name` (like "640w.webp" for an image, or "p3.jpg" for a PDF), else None.'''
+	fp = k_upload_path + name
+	lilname = name.lower()
+	if lilname.endswith(k_image_formats):
+		width, _, fmt = variant.partition('w.')
+		if fmt in k_derivative_formats and width.isdigit() and int(width) in k_image_widths:
+			return f'{name}.v{k_derivative_version}.{variant}', partial(make_derivative, fp, int(width), fmt), k_content_types[fmt]
+	elif lilname.endswith(k_pdf_formats):
+		page = variant.removeprefix('p').removesuffix('.jpg')
+		if variant == f'p{page}.jpg' and page.isdigit() and int(page) > 0:
+			return f'{name}.v{k_derivative_version}.{variant}', partial(render_pdf_page, fp, int(page), k_pdf_page_width), 'image/jpeg'
+	return None
+
+
+def make_derivative(src_fp, width, fmt, dest_fp):
+	'''Write a `width`-wide `fmt` rendition of the image at `src_fp` to `dest_fp`; blocking, so run in an executor.'''
+	with Image.open(src_fp) as img:
+		img.draft('RGB', (width, img.height * width // img.width)) # for JPEG sources, lets the decoder do a (cheap) DCT-domain downscale first; a no-op for other formats
+		img = img.convert('RGB')
+		if width < img.width: # never upscale; a rung wider than the source is just the source size
+			img = img.resize((width, max(1, img.height * width // img.width)), Image.LANCZOS)
+		if fmt == 'webp':
+			img.save(dest_fp, 'WEBP', quality = k_webp_quality, method = 4)
+		else:
+			img.save(dest_fp, 'JPEG', quality = k_jpeg_quality, optimize = True, progressive = True)
+
+
+@lru_cache(maxsize = 256) # uploads never change (under a given name), so neither does this
+def pdf_info(fp):
+	'''Return (page count, page width in points) of the PDF at `fp` - the width is of the first page, which we take as representative.'''
+	info = pdf2image.pdfinfo_from_path(fp, poppler_path = '/usr/bin', timeout = k_pdf_timeout)
+	try: width = float(info['Page size'].split()[0]) # like "612 x 792 pts (letter)"
+	except (KeyError, IndexError, ValueError): width = 612 # US Letter, 8.5in
+	return info['Pages'], width
+
+def render_pdf_page(fp, page, width, dest_fp):
+	'''Rasterize just page `page` (1-based) of the PDF at `fp`, about `width` pixels wide, as a JPEG at `dest_fp`; blocking, so run in an executor.'''
+	pages, page_width = pdf_info(fp)
+	if page > pages:
+		raise ex.NotFound(f'{fp} has no page {page} (only {pages})')
+	dpi = min(k_pdf_max_dpi, width * 72 / page_width) # render right at the target size (rather than at full resolution, then reducing); the cap keeps tiny pages from becoming giant images
+	img = pdf2image.convert_from_path(fp, dpi = dpi, first_page = page, last_page = page, poppler_path = '/usr/bin', timeout = k_pdf_timeout)[0]
+	img.thumbnail((width, width * 4)) # in case this page is wider than the first (which set the dpi)
+	img.convert('RGB').save(dest_fp, 'JPEG', quality = k_jpeg_quality, optimize = True)
+
+def make_pdf_thumbnail(fp, dest_fp):
+	render_pdf_page(fp, 1, k_thumbnail_size, dest_fp)
+	with Image.open(dest_fp) as img:
+		if img.height > k_thumbnail_size: # (portrait pages, that is)
+			img.thumbnail((k_thumbnail_size, k_thumbnail_size))
+			img.save(dest_fp, 'JPEG', quality = k_jpeg_quality)
+
+
+class DerivativeCache:
+	'''
+	Size-capped, LRU-evicting disk cache of generated media derivatives.  Generation is single-flight:
+	concurrent first requests for the same derivative all await the one (executor-run) generation.
+	'''
+	def __init__(self, path, max_bytes):
+		self.path = path
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict() # filename -> size in bytes; least-recently-used first
+		self._bytes = 0
+		self._pending = {} # filename -> generation task
+		os.makedirs(path, exist_ok = True)
+		# Seed from whatever survived the last run, oldest first (recency isn't persisted, so mtime is the best guess we have):
+		with os.scandir(path) as it:
+			entries = [(e.stat().st_mtime, e.name, e.stat().st_size) for e in it if e.is_file() and not e.name.endswith('.tmp')]
+		for _, name, size in sorted(entries):
+			self._entries[name] = size
+			self._bytes += size
+		self._evict()
+
+	async def get(self, key, make):
+		'''Return the path of cached file `key`, first calling `make(dest_fp)` (in an executor) to generate it, if necessary.'''
+		if key in self._entries:
+			self._entries.move_to_end(key)
+			return self.path + key
+		if not (job := self._pending.get(key)):
+			job = self._pending[key] = asyncio.ensure_future(self._generate(key, make))
+			job.add_done_callback(lambda _: self._pending.pop(key, None))
+		return await asyncio.shield(job) # shield: one impatient (disconnecting) requester mustn't cancel generation for the others
+
+	async def _generate(self, key, make):
+		fp = self.path + key
+		tmp = fp + '.tmp'
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, make, tmp)
+			os.replace(tmp, fp) # atomic; nobody ever sees (or serves) a half-written file
+		except:
+			try: os.remove(tmp)
+			except FileNotFoundError: pass
+			raise
+		self._entries[key] = size = os.path.getsize(fp)
+		self._bytes += size
+		self._evict()
+		return fp
+
+	def _evict(self):
+		while self._bytes > self.max_bytes and len(self._entries) > 1: # never evict the newest (just-generated) entry
+			name, size = self._entries.popitem(last = False)
+			self._bytes -= size
+			try: os.remove(self.path + name)
+			except FileNotFoundError: pass
+			l.debug(f'media cache: evicted {name} ({size} bytes); {self._bytes} bytes remain cached')
+
+
+def package_hls_in_background(src_fp, has_audio):
+	job = asyncio.create_task(package_hls(src_fp, src_fp + k_hls_appendix, has_audio))
+	_jobs.add(job)
+	job.add_done_callback(_jobs.discard)
+
+async def package_hls(src_fp, dest_dir, has_audio):
+	'''
+	Package the video at `src_fp` as fMP4 HLS, in k_hls_renditions, into `dest_dir` (with a master.m3u8); returns True on success.  Each packaging
+	saturates CPU, on the same host as the event loop, so only settings.hls_jobs run at once; others wait their turn.
+	'''
+	tmp_dir = dest_dir + '.tmp'
+	shutil.rmtree(tmp_dir, ignore_errors = True)
+	n = len(k_hls_renditions)
+	scales = ';'.join(f'[v{i}]scale={size}:{size}:force_original_aspect_ratio=decrease:force_divisible_by=2,format=yuv420p[v{i}o]' for i, (size, _, _) in enumerate(k_hls_renditions))
+	args = [imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-loglevel', 'error', '-y', '-i', src_fp,
+		'-filter_complex', f'[0:v]split={n}' + ''.join(f'[v{i}]' for i in range(n)) + ';' + scales]
+	for i, (_, video_bitrate, audio_bitrate) in enumerate(k_hls_renditions):
+		args += ['-map', f'[v{i}o]', f'-b:v:{i}', video_bitrate, f'-maxrate:v:{i}', video_bitrate, f'-bufsize:v:{i}', video_bitrate]
+		if has_audio:
+			args += ['-map', '0:a', f'-b:a:{i}', audio_bitrate]
+	args += ['-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-sc_threshold', '0',
+		'-force_key_frames', f'expr:gte(t,n_forced*{k_hls_segment_seconds})', # keyframe at every segment boundary, in every rendition, so that renditions switch (and seeks land) cleanly
+		'-c:a', 'aac',
+		'-f', 'hls', '-hls_time', str(k_hls_segment_seconds), '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4', '-hls_flags', 'independent_segments',
+		'-master_pl_name', 'master.m3u8', '-hls_segment_filename', f'{tmp_dir}/%v/%d.m4s',
+		'-var_stream_map', ' '.join(f'v:{i},a:{i}' if has_audio else f'v:{i}' for i in range(n)),
+		f'{tmp_dir}/%v/index.m3u8']
+	async with _hls_slots:
+		proc = await asyncio.create_subprocess_exec(*args, stdout = asyncio.subprocess.DEVNULL, stderr = asyncio.subprocess.PIPE) # a separate process; the event loop just awaits it
+		_, err = await proc.communicate()
+	if proc.returncode != 0:
+		l.error(f'HLS packaging of {src_fp} FAILED: {err.decode(errors = "replace")}')
+		shutil.rmtree(tmp_dir, ignore_errors = True)
+		return False
+	shutil.rmtree(dest_dir, ignore_errors = True)
+	os.rename(tmp_dir, dest_dir) # atomic; the player never sees a half-packaged directory (it falls back to the progressive file until then)
+	return True
@@ -0,0 +1,162 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import logging
+import sys
+import tracemalloc
+import unittest
+
+from collections import Counter
+from types import SimpleNamespace
+
+from . import cache
+from . import exception as ex
+from . import settings
+
+l = logging.getLogger(__name__)
+
+# Memory diagnostics, for the running server (see main's /memory route and admin.memory()): accounting() estimates the bytes retained
+# by connection state - each Hd's state, payload and task stack (task states, like 'loaded_msg_ids') - per connection, per task handler
+# and per state key, along with what the caches hold; trace() takes tracemalloc snapshots, on demand, and reports the growth since the
+# last one, by allocating line - so that a slow leak can be found (and capped) without a restart.
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+#Note the '__main__' at end of this file, which can be used to run from parent dir as:
+#   python -m app.memory
+
+# -----------------------------------------------------------------------------
+
+k_top = 25 # lines per section, in reports
+
+_baseline = None # the last trace() snapshot
+
+
+def sizeof(value, seen):
+	'''Approximate bytes retained by `value` - it and the containers' contents within it - not counting objects in `seen` (ids), already counted.'''
+	if id(value) in seen:
+		return 0
+	seen.add(id(value))
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in value.items())
+	elif isinstance(value, (list, tuple, set, frozenset)):
+		size += sum(sizeof(each, seen) for each in value)
+	return size
+
+
+def accounting(hds):
+	'''A (text) report of the bytes retained by connections' state (`hds` - main.Hd's), and by the caches.'''
+	per_hd, per_handler, per_key = [], Counter(), Counter()
+	for hd in hds:
+		seen = set() # (per hd - what hds share, like cached rows, counts toward each)
+		total = sizeof(hd.payload, seen)
+		for key, value in hd.state.items():
+			size = sizeof(value, seen)
+			per_key[f'state.{key}'] += size
+			total += size
+		for t in hd.prior_tasks + ([hd.task] if hd.task else []):
+			name = f'{t.handler.__module__}.{t.handler.__name__}'
+			task_total = 0
+			for key, value in t.state.items():
+				size = sizeof(value, seen)
+				per_key[f'{name}.{key}'] += size
+				task_total += size
+			per_handler[name] += task_total
+			total += task_total
+		per_hd.append((total, hd.uid, hd.idid, len(hd.prior_tasks)))
+	per_hd.sort(key = lambda each: each[0], reverse = True) # (by bytes alone - uid and idid may be None, for a connection not logged in (or identified) yet)
+	lines = [f'{len(per_hd)} connections; {sum(each[0] for each in per_hd)} bytes of state', '', 'Per connection (bytes, uid, idid, prior tasks):']
+	lines.extend(f'{total:>12} {uid} {idid} {n}' for total, uid, idid, n in per_hd[:k_top])
+	lines.extend(['', 'Per task handler (bytes of task state, all connections):'])
+	lines.extend(f'{size:>12} {name}' for name, size in per_handler.most_common(k_top))
+	lines.extend(['', 'Per state key (bytes, all connections):'])
+	lines.extend(f'{size:>12} {key}' for key, size in per_key.most_common(k_top))
+	lines.extend(['', 'Caches (bytes, entries):'])
+	lines.extend(f"{s['bytes']:>12} {s['entries']} {name}" for name, s in cache.stats().items())
+	return '\n'.join(lines) + '\n'
+
+
+async def trace(command = 'snapshot'):
+	'''
+	tracemalloc control: 'start' tracing (a baseline snapshot is taken), 'snapshot' (starting, if need be) - the growth since the last
+	snapshot, by allocating line - or 'stop'.  Returns a (text) report.  Tracing costs memory and speed, so stop when done.
+	Raises ex.InvalidInput for any other command.
+	'''
+	global _baseline
+	match command:
+		case 'stop':
+			tracemalloc.stop()
+			_baseline = None
+			return 'tracemalloc stopped\n'
+		case 'start' | 'snapshot':
+			if not tracemalloc.is_tracing():
+				tracemalloc.start(settings.tracemalloc_frames)
+				_baseline = None
+			snapshot = await asyncio.to_thread(_snapshot) # (slow, for a big heap)
+			if command == 'start' or not _baseline:
+				_baseline = snapshot
+				return f'tracemalloc tracing; baseline taken ({tracemalloc.get_traced_memory()[0]} bytes traced)\n'
+			stats = await asyncio.to_thread(snapshot.compare_to, _baseline, 'lineno')
+			_baseline = snapshot
+			lines = [f'{tracemalloc.get_traced_memory()[0]} bytes traced; growth since the last snapshot, by line:']
+			lines.extend(str(each) for each in stats[:k_top])
+			return '\n'.join(lines) + '\n'
+	raise ex.InvalidInput(command)
+
+def _snapshot():
+	return tracemalloc.take_snapshot().filter_traces((
+		tracemalloc.Filter(False, tracemalloc.__file__),
+		tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+	))
+
+
+# Tests -----------------------------------------------------------------------
+
+@addtest()
+def test_sizeof(self):
+	shared = 'x' * 1000
+	self.assertGreater(sizeof([shared], set()), 1000)
+	seen = set()
+	sizeof(shared, seen)
+	self.assertLess(sizeof([shared], seen), 1000) # (counted already)
+	self.assertLess(sizeof([shared, shared], set()), 2000) # (counted once)
+
+@addtest()
+def test_accounting(self):
+	def handler(): pass
+	task = lambda state: SimpleNamespace(handler = handler, state = state)
+	hds = [
+		SimpleNamespace(uid = 1, idid = 'a', payload = None, state = dict(message_notify = 'inject'), task = task(dict(loaded_msg_ids = set(range(1000)))), prior_tasks = []),
+		SimpleNamespace(uid = 2, idid = 'b', payload = {}, state = {}, task = None, prior_tasks = [task(dict(filt = 'new'))]),
+	]
+	report = accounting(hds)
+	self.assertIn('2 connections', report)
+	self.assertIn(f'{__name__}.handler.loaded_msg_ids', report)
+	self.assertIn('state.message_notify', report)
+	self.assertLess(report.index(' 1 a 0'), report.index(' 2 b 1')) # (biggest first)
+	anonymous = lambda uid, idid: SimpleNamespace(uid = uid, idid = idid, payload = None, state = {}, task = None, prior_tasks = []) # (same totals)
+	self.assertIn('2 connections', accounting([anonymous(1, 'a'), anonymous(None, None)]))
+
+@addtest()
+def test_trace(self):
+	with self.assertRaises(ex.InvalidInput):
+		asyncio.run(trace('bogus'))
+	self.assertFalse(tracemalloc.is_tracing())
+	self.assertIn('baseline taken', asyncio.run(trace('start')))
+	self.assertIn('growth since the last snapshot', asyncio.run(trace('snapshot')))
+	self.assertIn('stopped', asyncio.run(trace('stop')))
+
+
+if __name__ == '__main__':
+	unittests()
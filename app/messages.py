@@ -3,6 +3,7 @@ __copyright__ = '2024'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+import asyncio
 import io
 import logging
 import random
@@ -16,10 +17,12 @@ from dataclasses import dataclass, field as dataclass_field
 from moviepy import VideoFileClip, ImageClip, CompositeVideoClip # pip install moviepy
 from moviepy.video.fx.Resize import Resize as mp_resize
 from PIL import Image # pip install Pillow
-import pdf2image
 
+from . import dates
 from . import db
+from . import fast_html
 from . import html
+from . import media
 from . import settings
 from . import task
 from . import text
@@ -36,7 +39,7 @@ l = logging.getLogger(__name__)
 
 @ws.handler
 async def enter_module(hd):
-	hd.rq.app['active_module'] = 'app.messages'
+	hd.module = 'app.messages'
 	hd.state['message_notify'] = NewMessageNotify.inject
 
 @ws.handler
@@ -45,7 +48,7 @@ async def exit_module(hd):
 
 @ws.handler
 async def messages(hd, reverting = False):
-	if hd.rq.app['active_module'] != 'messages': # frequently, messages() is called from elsewhere (other than user request), e.g., as a default startup.  In this case, the normal framework caller of our enter_module() doesn't get called, so we need to call it; this is the exception, and is because this method is a little special
+	if hd.module != 'app.messages': # frequently, messages() is called from elsewhere (other than user request), e.g., as a default startup.  In this case, the normal framework caller of our enter_module() doesn't get called, so we need to call it; this is the exception, and is because this method is a little special
 		await enter_module(hd)
 	if reverting and hd.state['message_notify'] != NewMessageNotify.reload: # TODO: DEPRECATE NewMessageNotify.reload
 		return # nothing to do here - don't reload messages if reverting, unless NewMessageNotify.reload
@@ -64,7 +67,7 @@ async def messages(hd, reverting = False):
 	news = filt == Filter.new
 	stashable = filt == Filter.new or filt == Filter.deferred
 	if ms:
-		await ws.send_content(hd, 'messages', html.messages(ms, hd.uid, hd.admin, stashable, news, None, news, searchtext = searchtext), scroll_to_bottom = 0 if news else 1)
+		await _send_messages(hd, 'messages', ms, stashable, news, None, news, searchtext, scroll_to_bottom = 0 if news else 1)
 	else:
 		await ws.send_content(hd, 'messages', html.no_messages(searchtext))
 
@@ -79,11 +82,16 @@ async def more_new_messages(hd): # inspired by "down-scroll" below "bottom", or
 	#else:
 	searchtext, ms = await _get_messages(hd)
 	if len(ms) > 0:
-		await ws.send_content(hd, 'show_more_new_messages', html.messages(ms, hd.uid, hd.admin, True, True, hd.task.state['last_thread_patriarch'], searchtext = searchtext))
+		await _send_messages(hd, 'show_more_new_messages', ms, True, True, hd.task.state['last_thread_patriarch'], searchtext = searchtext)
 		hd.task.state['last_thread_patriarch'] = ms[-1]['reply_chain_patriarch']
 	else:
 		await ws.send(hd, 'no_more_new_messages')
 
+async def catch_up(hd):
+	'''After a resume (see sessions.resume()), send whatever new messages came in while the client was disconnected (and so weren't delivered).'''
+	if hd.task.handler == messages and hd.task.state.get('filt') == Filter.new:
+		await more_new_messages(hd)
+
 @ws.handler
 async def more_old_messages(hd): # inspired by "up-scroll" above "top"
 	if hd.task.handler != messages:
@@ -95,7 +103,7 @@ async def more_old_messages(hd): # inspired by "up-scroll" above "top"
 	#else:
 	searchtext, ms = await _get_messages(hd)
 	if len(ms) > 0:
-		await ws.send_content(hd, 'show_more_old_messages', html.messages(ms, hd.uid, hd.admin, filt == Filter.deferred, False, hd.task.state['last_thread_patriarch'], searchtext = searchtext))
+		await _send_messages(hd, 'show_more_old_messages', ms, filt == Filter.deferred, False, hd.task.state['last_thread_patriarch'], searchtext = searchtext)
 		hd.task.state['last_thread_patriarch'] = ms[0]['reply_chain_patriarch']
 	#else: nothing more to do - don't ws.send() anything or update anything!  User has scrolled to the very top of the available messages for the given filter
 
@@ -111,6 +119,18 @@ async def _get_messages(hd):
 	hd.task.state['loaded_msg_ids'].update([m['id'] for m in ms])
 	return searchtext, ms
 
+async def _send_messages(hd, task, ms, stashable, deferrable, last_thread_patriarch = None, skip_first_hr = False, searchtext = None, whole_thread = False, **kwargs):
+	if hd.state.get('json_messages'): # records, with the rendering context; messages.js does the rendering (see start_json_messages())
+		await ws.send(hd, task, records = fast_html.records(ms, hd.uid), context = dict(uid = hd.uid, admin = hd.admin, stashable = stashable, deferrable = deferrable, patriarch = last_thread_patriarch, skip_first_hr = skip_first_hr, whole_thread = whole_thread), **kwargs) # (searchtext highlighting is already in the records' message content, from the db)
+	else:
+		await ws.send_content(hd, task, fast_html.messages(ms, hd.uid, hd.admin, stashable, deferrable, last_thread_patriarch, skip_first_hr, searchtext, whole_thread), **kwargs)
+
+async def start_json_messages(hd):
+	'''Switch `hd` to client-side message rendering, if the client asked for it (and settings allow).'''
+	hd.state['json_messages'] = settings.json_messages and hd.payload.get('json_messages', False)
+	if hd.state['json_messages']:
+		await ws.send(hd, 'render_config', config = fast_html.k_render_config) # once per connection, rather than in every payload
+
 
 @ws.handler
 async def new_message(hd, reverting = False):
@@ -153,11 +173,13 @@ _strip_trailing_br = lambda content: content.rstrip('<br>') # TODO: make use of
 @ws.handler
 async def save_wip(hd):
 	await db.save_message(hd.dbc, hd.payload['message_id'], hd.payload['content'])
+	fast_html.fragments.invalidate_message(hd.payload['message_id'])
 
 @ws.handler
 async def send_message(hd, message_id = None, banner = True):
 	mid = message_id or hd.payload.get('message_id')
 	message = await db.send_message(hd.dbc, hd.uid, mid)
+	fast_html.fragments.invalidate_message(mid)
 	match message:
 		case db.Send_Message_Result.NoTags:
 			await message_tags(hd, send_after = True) # 'send_after' causes this send_message() to be tried again immediately after tags are set (at end of message_tags processing)
@@ -180,6 +202,7 @@ async def send_reply(hd):
 	else: # replier wishes to send "to all original recipients", instead...
 		await db.set_reply_message_tags(hd.dbc, mid)
 	message = await db.send_message(hd.dbc, hd.uid, mid)
+	fast_html.fragments.invalidate_message(mid)
 	assert message != db.Send_Message_Result.NoTags, 'Should be impossible - a reply always inherits the tags of the parent message.'
 	if message == db.Send_Message_Result.EmptyMessage:
 		await ws.send(hd, 'remove_reply_container', message_id = mid)
@@ -187,7 +210,7 @@ async def send_reply(hd):
 		filt = hd.task.state.get('filt')
 		stashable = filt == Filter.new or filt == Filter.deferred
 		deferrable = filt == Filter.new
-		_, html_message = html.message(message, hd.uid, hd.admin, stashable, deferrable, message['reply_chain_patriarch'], injection = True)
+		_, html_message = fast_html.message(message, hd.uid, hd.admin, stashable, deferrable, message['reply_chain_patriarch'], injection = True)
 		await ws.send_content(hd, 'post_completed_reply', html_message, message_id = mid)
 		hd.state['active_reply'] = None # reset; no longer in active reply (until user starts or resumes another reply)
 		for each_hd in hd.rq.app['hds']:
@@ -210,7 +233,7 @@ async def compose_reply(hd):
 	hd.task.state['loaded_msg_ids'].add(new_mid) # this new_mid will already be in view, for author of the reply, and should not be loaded upon a scroll-down (incurring a new-message-load)
 	hd.state['active_reply'] = Active_Reply(new_mid, parent_mid, patriarch_id) # while replying, tell other replies-to-the-same-parent-or-grandparent-message to be injected ABOVE:
 	# load (empty) reply-box: (note that send_reply() handles the "send" ► action)
-	await ws.send_content(hd, 'inline_reply_box', html.inline_reply_box(new_mid, parent_mid), message_id = new_mid, parent_mid = parent_mid)
+	await ws.send_content(hd, 'inline_reply_box', fast_html.inline_reply_box(new_mid, parent_mid), message_id = new_mid, parent_mid = parent_mid)
 
 
 async def deliver_message(hd, message):
@@ -234,32 +257,36 @@ async def deliver_message(hd, message):
 	mid = message['id']
 	if await db.delivery_recipient(hd.dbc, hd.uid, mid):
 		placement = None
-		match hd.state.get('message_notify'):
-			case NewMessageNotify.tease:
-				if not message['deleted']:
-					await ws.send(hd, 'deliver_message_teaser', teaser = message['teaser'])
-			case NewMessageNotify.reload: # TODO: DEPRECATE!
-				l.warning(f'!!! RELOADING! (DEPRECATE ME!)')
-				await messages(hd)
-			case NewMessageNotify.inject:
-				# Default: place this new message at the end ('beforeend') of the parent, after all other replies (that have already come in)
-				reference_mid = message['reply_to'] # Note: could be None if message has no parent (is not a reply) (in this case, `placement` will be disregarded by inject_deliver_new_message)
-				placement = 'beforeend' # parent is a super-container, with all replies "within", so stick this within that container, before the end of it (after the previous last reply)
-				# BUT, if active reply is underway...
-				if active_reply := hd.state.get('active_reply'):
-					if active_reply.parent_mid == message['reply_to']: # message (to be delivered) shares the same parent...
-						reference_mid = active_reply.mid # place injection just above active reply (so that user can see it even while authoring active reply)
-						placement = 'beforebegin'
-					elif active_reply.patriarch_mid == message['reply_chain_patriarch']: # message (to be delivered) shares the same patriarch...
-						reference_mid = active_reply.parent_mid # place injection just above parent (so that user can see it even while authoring active reply)
-						placement = 'beforebegin'
-					#else: just take the defaults set above - the injection can go wherever it belongs, even if it's off screen
-				#NOTE: we DON'T add(mid) to state['loaded_msg_ids'] here, prematurely - within inject_deliver_new_message, client-side, decision may be made to NOT add the message to the DOM! (see injected_message() signal)
-				filt = hd.task.state.get('filt')
-				stashable = filt == Filter.new or filt == Filter.deferred
-				deferrable = filt == Filter.new
-				_, html_message = html.message(message, hd.uid, hd.admin, stashable, deferrable, injection = True) # NOTE: do NOT send message['reply_chain_patriarch'] as `thread_patriarch` arg - that would be a misunderstanding; that assignment will be made within html.message(), anyway, but the `thread_patriarch` arg is really for tracking a patriarch when painting message after message, not for injecting a message like this, right now, without any knowledge of the messages that are immediately above in the user's window'
-				await ws.send_content(hd, 'inject_deliver_new_message', html_message, new_mid = mid, reference_mid = reference_mid or 0, placement = placement)
+		with dates.using(hd.local_dates): # (hd is the recipient's, which may not be the connection being handled)
+			match hd.state.get('message_notify'):
+				case NewMessageNotify.tease:
+					if not message['deleted']:
+						await ws.send(hd, 'deliver_message_teaser', teaser = message['teaser'])
+				case NewMessageNotify.reload: # TODO: DEPRECATE!
+					l.warning(f'!!! RELOADING! (DEPRECATE ME!)')
+					await messages(hd)
+				case NewMessageNotify.inject:
+					# Default: place this new message at the end ('beforeend') of the parent, after all other replies (that have already come in)
+					reference_mid = message['reply_to'] # Note: could be None if message has no parent (is not a reply) (in this case, `placement` will be disregarded by inject_deliver_new_message)
+					placement = 'beforeend' # parent is a super-container, with all replies "within", so stick this within that container, before the end of it (after the previous last reply)
+					# BUT, if active reply is underway...
+					if active_reply := hd.state.get('active_reply'):
+						if active_reply.parent_mid == message['reply_to']: # message (to be delivered) shares the same parent...
+							reference_mid = active_reply.mid # place injection just above active reply (so that user can see it even while authoring active reply)
+							placement = 'beforebegin'
+						elif active_reply.patriarch_mid == message['reply_chain_patriarch']: # message (to be delivered) shares the same patriarch...
+							reference_mid = active_reply.parent_mid # place injection just above parent (so that user can see it even while authoring active reply)
+							placement = 'beforebegin'
+						#else: just take the defaults set above - the injection can go wherever it belongs, even if it's off screen
+					#NOTE: we DON'T add(mid) to state['loaded_msg_ids'] here, prematurely - within inject_deliver_new_message, client-side, decision may be made to NOT add the message to the DOM! (see injected_message() signal)
+					filt = hd.task.state.get('filt')
+					stashable = filt == Filter.new or filt == Filter.deferred
+					deferrable = filt == Filter.new
+					if hd.state.get('json_messages'):
+						await ws.send(hd, 'inject_deliver_new_message', records = fast_html.records([message], hd.uid), context = dict(uid = hd.uid, admin = hd.admin, stashable = stashable, deferrable = deferrable, injection = True), new_mid = mid, reference_mid = reference_mid or 0, placement = placement) # (no thread_patriarch in the context, for the same reason as noted just below)
+					else:
+						_, html_message = fast_html.message(message, hd.uid, hd.admin, stashable, deferrable, injection = True) # NOTE: do NOT send message['reply_chain_patriarch'] as `thread_patriarch` arg - that would be a misunderstanding; that assignment will be made within html.message(), anyway, but the `thread_patriarch` arg is really for tracking a patriarch when painting message after message, not for injecting a message like this, right now, without any knowledge of the messages that are immediately above in the user's window'
+						await ws.send_content(hd, 'inject_deliver_new_message', html_message, new_mid = mid, reference_mid = reference_mid or 0, placement = placement)
 
 @ws.handler
 async def injected_message(hd):
@@ -289,6 +316,7 @@ async def delete_draft(hd):
 async def delete_message(hd):
 	mid = hd.payload['message_id']
 	await db.delete_message(hd.dbc, mid)
+	fast_html.fragments.invalidate_message(mid)
 	# "deliver" the deleted message - its "deleted" state will result in inline removal of the message in real-time
 	for each_hd in hd.rq.app['hds']: # including delivery to self
 		await ws.send(each_hd, 'remove_message', message_id = mid)
@@ -344,15 +372,25 @@ async def defer(hd):
 @ws.handler # TODO: also confirm user is owner of this message (or admin)!
 async def pin(hd):
 	await db.pin_message(hd.dbc, hd.payload['message_id'], hd.uid)
+	fast_html.fragments.invalidate_message(hd.payload['message_id']) # (pinned is per-user, and part of the fragment key, but this frees the now-unneeded variant)
+	await _patch_message_elsewhere(hd, hd.payload['message_id'], pinned = True)
 
 @ws.handler # TODO: also confirm user is owner of this message (or admin)!
 async def unpin(hd):
 	await db.unpin_message(hd.dbc, hd.payload['message_id'], hd.uid)
+	fast_html.fragments.invalidate_message(hd.payload['message_id'])
+	await _patch_message_elsewhere(hd, hd.payload['message_id'], pinned = False)
+
+async def _patch_message_elsewhere(hd, mid, **fields):
+	# The user's OTHER connections (devices, tabs) get just the changed field(s), rather than a reload; this one already updated its own DOM
+	for each_hd in hd.rq.app['hds']:
+		if each_hd is not hd and each_hd.uid == hd.uid:
+			await ws.send(each_hd, 'patch_message', message_id = mid, fields = fields)
 
 @ws.handler
 async def show_whole_thread(hd):
 	ms = await db.get_whole_thread(hd.dbc, hd.uid, hd.payload['patriarch_id'])
-	await ws.send_content(hd, 'show_whole_thread', html.messages(ms, hd.uid, hd.admin, False, False, None, False, whole_thread = True), message_id = hd.payload['message_id'])
+	await _send_messages(hd, 'show_whole_thread', ms, False, False, None, False, whole_thread = True, message_id = hd.payload['message_id'])
 
 
 @ws.handler # TODO: also confirm user is owner of this message (or admin)!
@@ -393,32 +431,28 @@ async def upload_files(hd, meta, payload):
 			overlay = Image.open(k_video_overlay).convert("RGBA")
 			thumbnail.paste(overlay, ((thumbnail.width - overlay.width) // 2, (thumbnail.height - overlay.height) // 2), overlay)
 			thumbnail.convert("RGB").save(fp + k_thumb_appendix)
+			if settings.hls_videos:
+				media.package_hls_in_background(fp, resized.audio is not None) # players fall back to the progressive `fp` until this is done
 
 		elif lilname.endswith(k_image_formats):
+			with open(fp + k_orig_appendix + suffix, "wb") as file:
+				file.write(payload[pos:pos+size]) # a copy of the original full-sized image, byte-for-byte (no need to spend a re-encode on it)... in case it's needed later TODO: make a script that deprecates these old big files....
 			img = Image.open(io.BytesIO(payload[pos:pos+size])).convert("RGB")
-			img.save(fp + k_orig_appendix + suffix) # a copy of the original full-sized image... in case it's needed later TODO: make a script that deprecates these old big files....
 			# Make reduced-size version for normal use:
 			ow, oh = img.size
 			nw, nh = nwnh(ow, oh)
 			resized = img.resize((nw, nh))
-			resized.save(fp) # the new "stock" version of this image (downsized)
+			resized.save(fp) # the new "stock" version of this image (downsized); srcset derivatives are made from this, on demand (see main.media())
 			# Make thumbnail:
 			resized.thumbnail((k_thumbnail_size, k_thumbnail_size)) # modifies resized in-place
 			resized.save(fp + k_thumb_appendix)
 			filenames.append(name)
 
 		elif lilname.endswith(k_pdf_formats):
-			bio = io.BytesIO(payload[pos:pos+size])
 			with open(fp, "wb") as file:
-				file.write(bio.getvalue())
-			images = pdf2image.convert_from_bytes(payload[pos:pos+size], poppler_path = '/usr/bin')
-			img = images[0]
-			ow, oh = img.size
-			nw, nh = nwnh(ow, oh)
-			resized = img.resize((nw, nh))
-			# Make thumbnail:
-			resized.thumbnail((k_thumbnail_size, k_thumbnail_size)) # modifies resized in-place
-			resized.save(fp + k_thumb_appendix)
+				file.write(payload[pos:pos+size])
+			# Make thumbnail (rasterizing only page 1, only at thumbnail size; page-viewer previews are made on demand - see main.media()):
+			await asyncio.get_running_loop().run_in_executor(None, media.make_pdf_thumbnail, fp, fp + k_thumb_appendix)
 			filenames.append(name)
 
 
@@ -430,9 +464,10 @@ async def upload_files(hd, meta, payload):
 		pos += size
 	if filenames: # indicating files were actually uploaded and processed
 		await db.add_message_attachments(hd.dbc, message_id, filenames)
-		# NOTE - this is not atomic, and we're not revisiting and deleting files just written to file, above; so, rather, run a periodic script that deletes media that is not referenced in DB!  This will also allow for quick "deletion" (by removal of file reference in DB), that can be followed later by actual file removal (possibly also handy for "undo"ability, if don't wait too long.)
+		fast_html.fragments.invalidate_message(message_id)
+		# NOTE - this is not atomic, and we're not revisiting and deleting files just written to file, above; so, rather, run a periodic script (periodic_media_deleter.py) that deletes media that is not referenced in DB!  This will also allow for quick "deletion" (by removal of file reference in DB), that can be followed later by actual file removal (possibly also handy for "undo"ability, if don't wait too long.)
 
-	content = html.thumbnail_strip(filenames)
+	content = fast_html.thumbnail_strip(filenames)
 	await ws.send_content(hd, 'files_uploaded', content, message_id = message_id)
 
 async def sms(rq, fro, message, timestamp):
@@ -455,6 +490,7 @@ async def _remove_or_add_tag_to_message(hd, db_func, banner_text):
 	tid = int(hd.payload['tag_id'])
 	mid = int(hd.payload['message_id'])
 	await db_func(hd.dbc, mid, tid, hd.uid)
+	fast_html.fragments.invalidate_message(mid)
 	await ws.send_content(hd, 'sub_content', await message_tags_table(hd, mid), container = 'message_tags_table_container')
 	tag = await db.get_tag(hd.dbc, tid, 'name')
 	await ws.send_content(hd, 'detail_banner', html.info(banner_text.format(name = tag['name'])))
@@ -0,0 +1,166 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import logging
+import time
+import unittest
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+l = logging.getLogger(__name__)
+
+# Metrics, in Prometheus text format (see render(), and main's /metrics route).  Every ws.handler invocation is timed (see invocation()),
+# by module and task, along with the time it spent in the db (see db._TimedCursor) and sending (see ws.send()) - each into a fixed-bucket
+# histogram, so that memory stays constant however many invocations there are.  Handlers invoked by handlers (e.g., login() calling
+# messages.messages()) count toward the outermost invocation, only.
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+#Note the '__main__' at end of this file, which can be used to run from parent dir as:
+#   python -m app.metrics
+
+# -----------------------------------------------------------------------------
+
+k_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+histograms = {} # name -> Histogram; every Histogram registers itself
+
+
+class Histogram:
+	def __init__(self, name, help, label_names, buckets = k_buckets):
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self.buckets = buckets
+		self._series = {} # label values (tuple) -> [count per bucket (not cumulative; the last is +Inf's)..., sum]
+		histograms[name] = self
+
+	def observe(self, labels, value):
+		if (series := self._series.get(labels)) is None:
+			series = self._series[labels] = [0] * (len(self.buckets) + 2)
+		series[bisect_left(self.buckets, value)] += 1
+		series[-1] += value
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+		for labels, series in self._series.items():
+			labels = list(zip(self.label_names, labels))
+			count = 0
+			for le, n in zip((*self.buckets, '+Inf'), series):
+				count += n
+				lines.append(f'{self.name}_bucket{_braced(labels + [("le", le)])} {count}')
+			lines.append(f'{self.name}_sum{_braced(labels)} {series[-1]}')
+			lines.append(f'{self.name}_count{_braced(labels)} {count}')
+		return lines
+
+
+task_seconds = Histogram('um_task_seconds', 'Time to handle a websocket task', ('module', 'task'))
+task_db_seconds = Histogram('um_task_db_seconds', 'Time a websocket task spent in the db', ('module', 'task'))
+task_send_seconds = Histogram('um_task_send_seconds', 'Time a websocket task spent sending', ('module', 'task'))
+loop_lag_seconds = Histogram('um_loop_lag_seconds', 'Event loop lag - how late the watchdog heartbeat ran', ()) # (see watchdog.py)
+
+_spent = ContextVar('spent', default = None) # the current invocation's {'db': seconds, 'send': seconds}
+
+
+@contextmanager
+def invocation(module, task):
+	'''Time the (outermost) handler invocation within, and the db and send time it spends (see spending()).'''
+	if _spent.get() is not None: # nested - part of the outer invocation
+		yield
+		return
+	spent = dict(db = 0.0, send = 0.0)
+	token = _spent.set(spent)
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		task_seconds.observe((module, task), time.perf_counter() - start)
+		task_db_seconds.observe((module, task), spent['db'])
+		task_send_seconds.observe((module, task), spent['send'])
+		_spent.reset(token)
+
+def spend(kind, seconds):
+	if (spent := _spent.get()) is not None:
+		spent[kind] += seconds
+
+@contextmanager
+def spending(kind):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		spend(kind, time.perf_counter() - start)
+
+
+def gauge(name, help, values):
+	'''A gauge's lines; `values` is a number, or a dict of ((label name, value) pairs) -> number.'''
+	lines = [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+	if isinstance(values, dict):
+		lines.extend(f'{name}{_braced(labels)} {value}' for labels, value in values.items())
+	else:
+		lines.append(f'{name} {values}')
+	return lines
+
+def render(*gauges):
+	'''All histograms, and `gauges` (see gauge()), as a Prometheus text-format document.'''
+	lines = []
+	for histogram in histograms.values():
+		lines.extend(histogram.render())
+	for each in gauges:
+		lines.extend(each)
+	return '\n'.join(lines) + '\n'
+
+def _braced(labels):
+	return '{' + ','.join(f'{name}="{_escaped(value)}"' for name, value in labels) + '}' if labels else ''
+
+def _escaped(value):
+	return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+# Tests -----------------------------------------------------------------------
+
+@addtest()
+def test_histogram(self):
+	h = Histogram('_test', 'Test', ('task',), buckets = (0.1, 1))
+	del histograms['_test']
+	for value in (0.05, 0.1, 0.5, 5):
+		h.observe(('x',), value)
+	self.assertEqual(h.render()[2:], [
+		'_test_bucket{task="x",le="0.1"} 2',
+		'_test_bucket{task="x",le="1"} 3',
+		'_test_bucket{task="x",le="+Inf"} 4',
+		'_test_sum{task="x"} 5.65',
+		'_test_count{task="x"} 4',
+	])
+	self.assertEqual(gauge('_g', 'G', {(('cache', 'a"b'),): 3}), ['# HELP _g G', '# TYPE _g gauge', '_g{cache="a\\"b"} 3'])
+
+@addtest()
+def test_invocation(self):
+	with invocation('_test', 'outer'):
+		spend('db', 0.25)
+		with invocation('_test', 'inner'): # (nested - counts toward 'outer')
+			spend('db', 0.5)
+			with spending('send'):
+				pass
+	self.assertIsNone(_spent.get())
+	self.assertNotIn(('_test', 'inner'), task_seconds._series)
+	self.assertEqual(sum(task_seconds._series[('_test', 'outer')][:-1]), 1)
+	self.assertEqual(task_db_seconds._series[('_test', 'outer')][-1], 0.75)
+	spend('db', 1) # (outside of any invocation - ignored)
+	for h in (task_seconds, task_db_seconds, task_send_seconds):
+		del h._series[('_test', 'outer')]
+
+
+if __name__ == '__main__':
+	unittests()
@@ -0,0 +1,113 @@
+
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+import unittest
+
+from .const import *
+
+# Deletes (or quarantines) files in k_upload_path that no attachment row references - the leftovers of non-atomic uploads (see messages.upload_files()) and of "deleted" attachments.
+# Run from the root directory (containing 'app'), like: python -m app.periodic_media_deleter [--dry-run] [--quarantine <dir>]
+# Note that k_media_cache_path (a subdirectory) is left alone; it's size-bounded already, and the running server owns its accounting.
+
+dbc = sqlite3.connect('um.db', isolation_level = None)
+
+k_batch_size = 500
+k_grace_hours = 24 # leave young files alone - an upload writes its files BEFORE it adds its attachment rows
+
+unreferenced_sql = '''
+	select name, size from media_file
+	where not exists (select 1 from attachment where attachment.filename in (media_file.name, media_file.owner, media_file.owner || '.mp4'))
+''' # (media_file.name, too: owner() is a guess, by appendix, and an upload's own name might happen to look like a derivative's - e.g., 'x.orig.png' - so a file is referenced if it IS an attachment, whatever its "owner")
+
+
+def owner(filename):
+	# Map a file to the attachment filename it (probably) belongs to; e.g., 'abcde_x.jpg.small.jpg' and 'abcde_x.jpg.orig.jpg' belong to 'abcde_x.jpg', 'abcde_y.mp4.hls' (a directory) belongs to 'abcde_y.mp4', and a converted video's 'abcde_x.mov.orig.mov' belongs to 'abcde_x.mov' (its attachment is 'abcde_x.mov.mp4', which unreferenced_sql also checks)
+	for appendix in (k_thumb_appendix, k_hls_appendix):
+		if filename.endswith(appendix):
+			return filename[:-len(appendix)]
+	base, sep, suffix = filename.rpartition(k_orig_appendix)
+	if sep and '.' not in suffix:
+		return base
+	return filename
+
+def _tree_size(path):
+	return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+def _batches(path, cutoff, batch_size):
+	batch = []
+	with os.scandir(path) as it: # scandir streams entries, and its DirEntry.stat() is usually free (cached from the directory read)
+		for entry in it:
+			hls = entry.is_dir(follow_symlinks = False) and entry.name.endswith(k_hls_appendix)
+			if not hls and not entry.is_file(follow_symlinks = False):
+				continue # e.g., k_media_cache_path, or a quarantine directory
+			st = entry.stat(follow_symlinks = False)
+			if st.st_mtime < cutoff:
+				batch.append((entry.name, owner(entry.name), _tree_size(entry.path) if hls else st.st_size))
+				if len(batch) >= batch_size:
+					yield batch
+					batch = []
+	if batch:
+		yield batch
+
+def run(grace_hours = k_grace_hours, quarantine = None, dry_run = False, batch_size = k_batch_size):
+	dbc.execute('create index if not exists attachment_filename on attachment (filename)') # (also in um.sql) - this job's only query depends on it
+	dbc.execute('create temp table if not exists media_file (name TEXT PRIMARY KEY, owner TEXT NOT NULL, size INTEGER NOT NULL)')
+	if quarantine:
+		os.makedirs(quarantine, exist_ok = True)
+	cutoff = time.time() - grace_hours * 3600
+	count = reclaimed = 0
+	for batch in _batches(k_upload_path, cutoff, batch_size):
+		dbc.execute('delete from media_file')
+		dbc.executemany('insert into media_file (name, owner, size) values (?, ?, ?)', batch)
+		for name, size in dbc.execute(unreferenced_sql).fetchall(): # fetchall() (of just this batch) so that we're not mid-query while the directory changes underneath
+			fp = k_upload_path + name
+			print(f"{'(dry run) ' if dry_run else ''}{'quarantining' if quarantine else 'deleting'} {fp} ({size} bytes)")
+			if not dry_run:
+				try:
+					if quarantine:
+						os.replace(fp, os.path.join(quarantine, name))
+					elif os.path.isdir(fp):
+						shutil.rmtree(fp)
+					else:
+						os.remove(fp)
+				except FileNotFoundError:
+					continue # already gone
+			count += 1
+			reclaimed += size
+	dbc.execute('drop table media_file')
+	print(f"{'(dry run) ' if dry_run else ''}{count} unreferenced files; {reclaimed} bytes ({reclaimed / 1024**2:.1f} MB) reclaimed")
+	return count, reclaimed
+
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+#Note: run from parent dir as (the '__main__' at end of this file runs the job, instead):
+#   python -m unittest app.periodic_media_deleter
+
+@addtest()
+def test_unreferenced(self):
+	c = sqlite3.connect(':memory:')
+	c.execute('create table attachment (filename TEXT)')
+	c.executemany('insert into attachment (filename) values (?)', [(f,) for f in ('a_x.jpg', 'a_y.mov.mp4', 'a_z.orig.png', 'a_w.small.jpg')])
+	c.execute('create temp table media_file (name TEXT PRIMARY KEY, owner TEXT NOT NULL, size INTEGER NOT NULL)')
+	names = ('a_x.jpg', 'a_x.jpg.small.jpg', 'a_y.mov', 'a_y.mov.orig.mov', 'a_z.orig.png', 'a_w.small.jpg', 'a_gone.jpg', 'a_gone.jpg.small.jpg')
+	c.executemany('insert into media_file (name, owner, size) values (?, ?, 1)', [(name, owner(name)) for name in names])
+	self.assertEqual(sorted(name for name, _ in c.execute(unreferenced_sql)), ['a_gone.jpg', 'a_gone.jpg.small.jpg']) # (not 'a_z.orig.png' or 'a_w.small.jpg', though owner() maps them elsewhere)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Delete (or quarantine) uploaded media that no attachment references.')
+	parser.add_argument('--grace-hours', type = float, default = k_grace_hours, help = 'ignore files modified more recently than this')
+	parser.add_argument('--quarantine', metavar = 'DIR', help = 'move files into DIR rather than deleting them')
+	parser.add_argument('--dry-run', action = 'store_true', help = 'report, but change nothing')
+	parser.add_argument('--batch-size', type = int, default = k_batch_size)
+	args = parser.parse_args()
+	run(args.grace_hours, args.quarantine, args.dry_run, args.batch_size)
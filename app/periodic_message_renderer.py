@@ -0,0 +1,39 @@
+
+import argparse
+import sqlite3
+
+from . import db
+
+# Stores message renderings (see db.render_message()) that are missing, or older than db.k_render_version - to backfill a database from before the
+# `rendered` column (which this adds, if it's missing), or after a deploy that bumps k_render_version.  Readers re-render stale messages lazily anyway
+# (see db._render_stale()); this just takes that work off of the live server, ahead of time.
+# Run from the root directory (containing 'app'), like: python -m app.periodic_message_renderer
+
+dbc = sqlite3.connect('um.db', isolation_level = None)
+
+k_batch_size = 500
+
+
+def run(batch_size = k_batch_size):
+	columns = [row[1] for row in dbc.execute('pragma table_info(message)')]
+	if 'rendered' not in columns:
+		dbc.execute('alter table message add column rendered TEXT')
+	if 'rendered_version' not in columns:
+		dbc.execute('alter table message add column rendered_version INTEGER')
+	count = last_id = 0
+	while rows := dbc.execute('select id, message from message where id > ? and sent is not null and (rendered_version is null or rendered_version != ?) order by id limit ?', (last_id, db.k_render_version, batch_size)).fetchall():
+		dbc.execute('begin')
+		dbc.executemany(f'update message set rendered = ?, rendered_version = {db.k_render_version} where id = ? and message is ?', # "and message is ?" - skip any message edited since we read it (its autosave left it stale again, to be re-rendered lazily)
+			[(db.render_message(message or ''), mid, message) for mid, message in rows])
+		dbc.execute('commit')
+		last_id = rows[-1][0]
+		count += len(rows)
+	print(f'{count} messages rendered (at version {db.k_render_version})')
+	return count
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Store (re-)rendered message content, for messages whose stored rendering is missing or stale.')
+	parser.add_argument('--batch-size', type = int, default = k_batch_size)
+	args = parser.parse_args()
+	run(args.batch_size)
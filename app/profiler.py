@@ -0,0 +1,96 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+from collections import Counter
+
+from . import settings
+from . import ws
+
+l = logging.getLogger(__name__)
+
+# On-demand sampling profiler, for the running server (see main's /profile route and admin.profile()): a helper thread samples the event
+# loop thread's stack every settings.profile_interval seconds, for a while, and the result is "collapsed stacks" - one line per distinct
+# stack, root first, with its sample count - as flamegraph.pl, speedscope and the like take.  Each stack is rooted at the ws task that was
+# running (see ws.task_of()), so that time is attributed to tasks.  The loop itself isn't slowed, beyond the sampling thread's GIL share.
+
+class Tests(unittest.TestCase):
+	pass
+def addtest():
+	def decorator(func):
+		setattr(Tests, func.__name__, func)
+		return func
+	return decorator
+def unittests():
+	unittest.main()
+#Note the '__main__' at end of this file, which can be used to run from parent dir as:
+#   python -m app.profiler
+
+# -----------------------------------------------------------------------------
+
+k_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep # (stripped from filenames, for brevity)
+
+_lock = asyncio.Lock() # one profile at a time; others wait their turn
+
+
+async def profile(seconds):
+	'''Sample the event loop thread for `seconds` (capped at settings.profile_max_seconds); returns collapsed stacks (text).'''
+	seconds = max(0, min(seconds, settings.profile_max_seconds))
+	async with _lock:
+		stacks = await asyncio.to_thread(_sample, threading.get_ident(), seconds, settings.profile_interval)
+	return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+def _sample(thread_id, seconds, interval):
+	stacks = Counter()
+	end = time.monotonic() + seconds
+	while time.monotonic() < end:
+		if frame := sys._current_frames().get(thread_id):
+			stacks[_collapsed(frame)] += 1
+		del frame
+		time.sleep(interval)
+	return stacks
+
+def _collapsed(frame):
+	names = []
+	task = ws.task_of(frame) or '(no task)'
+	while frame:
+		code = frame.f_code
+		names.append(f'{code.co_qualname} ({code.co_filename.removeprefix(k_root)}:{code.co_firstlineno})')
+		frame = frame.f_back
+	names.append(task)
+	return ';'.join(reversed(names)).replace(' ', '_') # (no spaces within a stack - the count follows the last)
+
+
+# Tests -----------------------------------------------------------------------
+
+@addtest()
+def test_profile(self):
+	def busy():
+		end = time.monotonic() + 0.2
+		while time.monotonic() < end:
+			pass
+	async def run():
+		job = asyncio.ensure_future(profile(0.3))
+		await asyncio.sleep(0.05) # (let the sampler start)
+		busy()
+		return await job
+	lines = asyncio.run(run()).splitlines()
+	self.assertTrue(lines)
+	for line in lines:
+		stack, count = line.rsplit(' ', 1)
+		self.assertTrue(stack.startswith('(no_task);'))
+		self.assertGreater(int(count), 0)
+	self.assertTrue(any('test_profile.<locals>.busy' in line for line in lines))
+
+
+if __name__ == '__main__':
+	unittests()
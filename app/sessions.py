@@ -0,0 +1,158 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import json
+import logging
+import traceback
+
+from . import cache
+from . import db
+from . import settings
+from . import ws
+
+from .task import Task
+
+l = logging.getLogger(__name__)
+
+# Resumable sessions: when a connection goes, a small, serializable snapshot of it - its user, its task stack (handler names and task states),
+# and the bits of hd.state worth keeping - is kept (bounded; see settings.session_*) under the client's idid and page_id (see persistence.js),
+# so that the same page, reconnecting (see ws.js), carries on where it was, rather than starting over at a fresh messages page.
+# Live objects (the request, the websocket, the db connection) are never kept, and neither is any state value that doesn't serialize.
+# Snapshots are also written to the db (the session table) - of live connections, too, every settings.session_flush_seconds, if changed,
+# and of all of them at shutdown - so that a restart or deploy doesn't send every client back to a fresh messages page at the same moment.
+
+k_state_keys = ('message_notify',) # hd.state worth keeping; the rest is re-established by main.identify(), or is moot
+k_set = '__set__' # (JSON has no sets; task states have a few, like 'loaded_msg_ids')
+
+_snapshots = cache.Cache('sessions', max_entries = settings.session_snapshots, max_bytes = settings.session_snapshot_bytes, ttl = settings.session_snapshot_ttl, sizeof = len)
+_dirty = {} # key -> snapshot (or None, to delete) to write, at the next flush()
+_written = {} # key (of a live connection) -> hash of the snapshot last written for it
+
+
+async def start(app):
+	await db.init_sessions(app['background_db'])
+	app['session_flusher'] = asyncio.create_task(_flush_periodically(app))
+
+async def stop(app):
+	'''Write everything - live connections, too - before the connections are closed (and it's too late).'''
+	app['session_flusher'].cancel()
+	await flush(app)
+
+async def flush(app):
+	'''Write snapshots of connections that have changed since last written, and of those that have closed (or been resumed).'''
+	rows = dict(_dirty)
+	_dirty.clear()
+	live = set()
+	for hd in app['hds']:
+		if key := _key(hd):
+			live.add(key)
+			if (s := snapshot(hd)) and hash(s) != _written.get(key):
+				rows[key] = s
+	for key in [key for key in _written if key not in live]:
+		del _written[key]
+	if rows:
+		try:
+			async with app['background_lock']: # (see main._init_db())
+				await db.save_sessions(app['background_db'], rows, settings.session_snapshot_ttl)
+		except:
+			for key, s in rows.items():
+				_dirty.setdefault(key, s) # (try again next time)
+			raise
+		for key, s in rows.items():
+			if s and key in live:
+				_written[key] = hash(s)
+
+async def _flush_periodically(app):
+	while True:
+		await asyncio.sleep(settings.session_flush_seconds)
+		try:
+			await flush(app)
+		except Exception:
+			l.error(traceback.format_exc())
+
+
+def snapshot(hd):
+	'''hd's resumable state, as JSON text; None if there's nothing to resume.'''
+	if not hd.uid or not hd.task:
+		return None
+	return json.dumps(dict(
+		uid = hd.uid,
+		tasks = [(f'{t.handler.__module__}.{t.handler.__name__}', _portable(t.state)) for t in hd.prior_tasks + [hd.task]],
+		state = _portable(dict((key, hd.state[key]) for key in k_state_keys if key in hd.state)),
+	), separators = (',', ':'))
+
+def save(hd):
+	if (key := _key(hd)) and (s := snapshot(hd)):
+		_snapshots.put(key, s)
+		_dirty[key] = s
+
+async def take(hd):
+	'''Remove and return (as a dict) the snapshot that hd (a new connection) can resume; None if there's none.'''
+	if not (key := _key(hd)):
+		return None
+	hds = hd.rq.app['hds']
+	for old in hds:
+		if old is not hd and _key(old) == key: # the page's old connection is still "live" - its loss just hasn't been noticed yet...
+			hds.remove(old) # ...so supersede it (which also keeps main._ws() from save()ing it, later)
+			save(old)
+			break
+	s = _snapshots.get(key)
+	_snapshots.invalidate(key)
+	_written.pop(key, None)
+	if s:
+		_dirty[key] = None # (its row, too, if it has one yet)
+	else: # (a restart, since?)
+		async with hd.rq.app['background_lock']:
+			s = await db.take_session(hd.rq.app['background_db'], *key, settings.session_snapshot_ttl)
+	return json.loads(s) if s else None
+
+async def resume(hd):
+	'''Put hd back where its page's previous connection left off; False if there's nothing (valid) to resume, for this user.'''
+	s = await take(hd)
+	if not s or s['uid'] != hd.uid:
+		return False
+	tasks = []
+	for name, state in s['tasks']:
+		module, _, name = name.rpartition('.')
+		if not (handler := ws._handlers.get((module, name))):
+			l.warning(f'Not resuming session of user {hd.uid}; no such handler: {module}.{name}')
+			return False
+		tasks.append(Task(handler, _restored(state)))
+	*hd.prior_tasks, hd.task = tasks
+	hd.state.update(_restored(s['state']))
+	return True
+
+
+def _key(hd):
+	return (hd.idid, page_id) if hd.idid and (page_id := hd.state.get('page_id')) else None
+
+class _Unportable(Exception):
+	pass
+
+def _portable(value):
+	match value:
+		case None | bool() | int() | float() | str(): # (including StrEnums, like messages_const.Filter, which come back as plain (but equal) strs)
+			return value
+		case set() | frozenset():
+			return {k_set: [_portable(each) for each in value]}
+		case list() | tuple():
+			return [_portable(each) for each in value]
+		case dict():
+			result = {}
+			for key, each in value.items():
+				try: result[key] = _portable(each)
+				except _Unportable: pass # just left out
+			return result
+	raise _Unportable()
+
+def _restored(value):
+	if isinstance(value, dict):
+		if k_set in value:
+			return set(value[k_set])
+		return dict((key, _restored(each)) for key, each in value.items())
+	if isinstance(value, list):
+		return [_restored(each) for each in value]
+	return value
@@ -1,7 +1,9 @@
 
 debug = True
 
-cache_buster = 'v=5'
+cache_buster = 'v=5' # for unbundled static files, only (see assets.urls())
+
+bundle_assets = True # build (concatenated, minified, content-hashed, precompressed) asset bundles at startup; see assets.build()
 
 messages_per_load = 10
 
@@ -9,3 +11,29 @@ db_filename = 'um.db'
 
 debug_static = './static'
 
+media_cache_bytes = 2 * 1024**3 # cap on disk used by on-demand media derivatives (LRU-evicted beyond this)
+
+
+fragment_cache_bytes = 16 * 1024**2 # cap on rendered message fragments held in memory (see fast_html.FragmentCache)
+fragment_cache_versions = 10000 # cap on the (recently changed) messages whose content versions fast_html.FragmentCache keeps
+
+session_snapshots = 10000 # cap on resumable session snapshots held in memory (see sessions.py)
+session_snapshot_bytes = 16 * 1024**2 # ...and on their total size
+session_snapshot_ttl = 3600 # seconds a dropped connection's session stays resumable
+session_flush_seconds = 5 # how often changed session snapshots are written to the db (so, at most this much is lost in a crash; shutdowns write everything)
+
+touch_flush_seconds = 30 # how often id_key touch_timestamps, noted at each (re)connect, are written to the db, in one batch (see db.flush_touches())
+
+hls_videos = False # also package uploaded videos as multi-bitrate HLS (see media.package_hls()), for quick-starting, partial-bandwidth playback
+hls_jobs = 1 # cap on HLS packagings (ffmpeg processes) running at once; more wait their turn
+
+json_messages = False # send message lists (to clients that can take them) as JSON records, rendered client-side (see messages._send_messages()), rather than as server-rendered html
+
+diagnostics_token = None # secret that requests to /metrics, /profile and /memory must bear (see main._authorize_diagnostics()); None disables the routes
+
+loop_lag_interval = 0.1 # seconds between watchdog heartbeats (see watchdog.py)
+loop_lag_threshold = 0.25 # seconds the event loop may be blocked before the watchdog logs the blocking stack
+
+profile_interval = 0.005 # seconds between stack samples, while profiling (see profiler.py)
+profile_max_seconds = 120 # cap on any one profile's duration
+tracemalloc_frames = 1 # frames kept per traced allocation, once memory tracing is started (see memory.trace()); more tell more, at more cost
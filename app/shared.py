@@ -3,12 +3,24 @@ __copyright__ = '2024'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+from . import db
 from . import html
 from . import task
 from . import valid
 from . import ws
 
 
+async def principal(hd):
+	'''
+	hd's user's db.Principal (cached; see db.get_principal()), or None if not logged in; also (re)sets hd.admin and hd.sub_manager from it,
+	so that a role granted or revoked meanwhile takes effect at the user's next guarded task (see the auth_funcs in admin and assignments).
+	'''
+	p = await db.get_principal(hd.dbc, hd.uid) if hd.uid else None
+	hd.admin = bool(p and 'admin' in p.roles)
+	hd.sub_manager = bool(p and 'sub-manager' in p.roles)
+	return p
+
+
 async def handle_invalid(hd, message, banner):
 	await ws.send_content(hd, banner, html.error(message))
 
@@ -19,6 +19,7 @@ child = 'Child'
 username = 'Username'
 password = 'Password'
 user = 'User'
+timezone = 'Timezone (blank for the browser\'s own)'
 person = 'Person'
 
 # Button titles:
@@ -168,6 +169,9 @@ welcome = 'Welcome!  "Log in" or "Join" to get started... '
 change_detail_success = 'Successfully changed {change}'
 detail_for = 'detail for'
 invalid_login = 'Invalid username/login; please try again or click "reset password" below.'
+profiling = 'Profiling for {seconds} seconds; the result will download when done...'
+invalid_trace_command = 'Unknown memory trace command "{command}"; use start, snapshot or stop.'
+too_many_logins = 'Too many failed login attempts; please wait a few minutes and try again, or click "reset password" below.'
 forgot_password_prelude = "What's your email address?  We'll send a password reset link!"
 unknown_email = "That email address is not on record; please try another, or contact an administrator."
 enter_reset_code = "Paste or type the code you received over email..."
@@ -228,3 +232,4 @@ class Valid:
 	password_match = 'Password and confirmation must match'
 	tag_name = 'Tag name must be provided, and must be 2-32 characters in length'
 	code = 'Code must be copied or reproduced exactly as shown in the email.'
+	timezone = 'Timezone must be a timezone name, like "America/Los_Angeles", or blank (to use the browser\'s own).'
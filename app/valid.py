@@ -28,6 +28,7 @@ PHONE = Rex(r'^(\(?\+?\d{1,3}\)?)?[-.\s]?(\d{3}[-.\s]?){2}\d{4}$') # matches all
 SLUG = Rex(r'^[\w\-_]{2,32}$')
 INVITATION = Rex(r'^.{24,24}$')
 CODE = Rex(r'^[\w ]{1,10}$')
+TIMEZONE = Rex(r'^[\w\-+/]{1,64}$') # IANA names, like "America/Los_Angeles" (see dates.known(), for the real check)
 
 @dataclass(slots = True)
 class Validator:
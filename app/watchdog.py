@@ -0,0 +1,57 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2024'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+from . import settings
+from . import ws
+
+l = logging.getLogger(__name__)
+
+# Event loop watchdog: a heartbeat task measures loop lag (how late its sleeps wake - see metrics.loop_lag_seconds), continuously, and a
+# helper thread watches the heartbeat; when the loop is stuck - something blocking it, like a transcode, a bcrypt, an smtplib send or a
+# huge render - longer than settings.loop_lag_threshold, the thread captures the loop thread's stack, right then, mid-block, and logs it,
+# with the ws task (handler) running, so that offenders are named, not guessed.
+
+_beat = None # time.monotonic() of the heartbeat's last run
+_stopping = threading.Event()
+
+
+def start(app):
+	_stopping.clear()
+	app['watchdog_heartbeat'] = asyncio.create_task(_heartbeat())
+	app['watchdog'] = thread = threading.Thread(target = _watch, args = (threading.get_ident(),), name = 'watchdog', daemon = True)
+	thread.start()
+
+def stop(app):
+	_stopping.set()
+	app['watchdog_heartbeat'].cancel()
+	app['watchdog'].join()
+
+
+async def _heartbeat():
+	global _beat
+	while True:
+		_beat = time.monotonic()
+		await asyncio.sleep(settings.loop_lag_interval)
+		lag = max(0, time.monotonic() - _beat - settings.loop_lag_interval)
+		metrics.loop_lag_seconds.observe((), lag)
+		if lag > settings.loop_lag_threshold:
+			l.warning(f'Event loop blocked for {lag:.3f}s') # (the stack was logged by _watch(), during)
+
+def _watch(loop_thread_id):
+	reported = None # the heartbeat whose lateness has been reported already
+	while not _stopping.wait(settings.loop_lag_interval):
+		beat = _beat
+		if beat is not None and beat != reported and time.monotonic() - beat > settings.loop_lag_interval + settings.loop_lag_threshold:
+			reported = beat
+			if frame := sys._current_frames().get(loop_thread_id):
+				l.warning(f'Event loop blocked for over {settings.loop_lag_threshold}s, in task {ws.task_of(frame) or "(none)"}, at:\n' + ''.join(traceback.format_stack(frame)))
@@ -14,40 +14,50 @@ from random import choices as random_choices
 from . import db
 from . import html
 from . import decorators
+from . import metrics
 from . import text
 
 
 l = logging.getLogger(__name__)
 
-send = lambda hd, task, **kwargs: hd.wsr.send_json(dict({'task': task}, **kwargs))
+async def send(hd, task, **kwargs):
+	with metrics.spending('send'):
+		await hd.wsr.send_json(dict({'task': task}, **kwargs))
+
 send_content = lambda hd, task, content, **kwargs: send(hd, task, content = content.render(), **kwargs)
 send_sub_content = lambda hd, container, content, **kwargs: send_content(hd, 'sub_content', content, container = container, **kwargs)
 
-_handlers = {}
+_handlers = {} # (module, task name) -> handler (wrapped - auth_func and error handling included); see main._handle_ws_text()
 
 @decorators.doublewrap
 def handler(func, auth_func = None):
 	@wraps(func)
 	async def inner(hd, *args, **kwargs):
-		try:
-			if auth_func and not await auth_func(hd):
-				await send_content(hd, 'banner', html.error(text.auth_required)) # TODO - when viewing in a dialog, this results in a hidden banner BEHIND (mostly invisible) - needs to be smart enough to load the sub-banner....
-				return # done
-			#else:
-			#l.debug(f'**************** hd.task: {hd.task}; *args: {args}; *kwargs: {kwargs}')
-			await func(hd, *args, **kwargs)
-		except Exception as e:
-			try: await db.rollback(hd.dbc)
-			except: pass # move on, even if rollback failed (e.g., there might not even be an outstanding transaction)
-			reference = ''.join(random_choices(ascii_uppercase, k=6))
-			l.error(f'ERROR reference ID: {reference} for user: {hd.uid} ... task-handler: {hd.task.handler} ... details/traceback:')
-			l.error(traceback.format_exc())
-			await send_content(hd, 'banner', html.error(text.internal_error.format(reference = reference)))
-	module = func.__module__
-	global _handlers
-	if module not in _handlers:
-		_handlers[module] = {}
-	_handlers[module][func.__name__] = inner
+		with metrics.invocation(func.__module__, func.__name__):
+			try:
+				if auth_func and not await auth_func(hd):
+					await send_content(hd, 'banner', html.error(text.auth_required)) # TODO - when viewing in a dialog, this results in a hidden banner BEHIND (mostly invisible) - needs to be smart enough to load the sub-banner....
+					return # done
+				#else:
+				#l.debug(f'**************** hd.task: {hd.task}; *args: {args}; *kwargs: {kwargs}')
+				await func(hd, *args, **kwargs)
+			except Exception as e:
+				try: await db.rollback(hd.dbc)
+				except: pass # move on, even if rollback failed (e.g., there might not even be an outstanding transaction)
+				reference = ''.join(random_choices(ascii_uppercase, k=6))
+				l.error(f'ERROR reference ID: {reference} for user: {hd.uid} ... task-handler: {hd.task.handler} ... details/traceback:')
+				l.error(traceback.format_exc())
+				await send_content(hd, 'banner', html.error(text.internal_error.format(reference = reference)))
+	_handlers[(func.__module__, func.__name__)] = inner
 	return inner
 
+def task_of(frame):
+	'''The task (as 'module.name') of the innermost handler invocation in `frame`'s stack - e.g., a stack captured from another thread (see watchdog.py) - or None.'''
+	while frame:
+		if frame.f_code.co_name == 'inner' and frame.f_code.co_filename == __file__: # (handler()'s wrapper)
+			func = frame.f_locals['func']
+			return f'{func.__module__}.{func.__name__}'
+		frame = frame.f_back
+	return None
+
 
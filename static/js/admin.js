@@ -20,6 +20,14 @@ let admin = {
 		_delete_mpd("phone", phone_id);
 	},
 
+	profile: function(seconds) { // (from the console, for now: admin.profile(30))
+		admin.send_ws('profile', {seconds: seconds});
+	},
+
+	memory: function(trace) { // (from the console, for now: admin.memory(), or admin.memory('start'), admin.memory('snapshot')...)
+		admin.send_ws('memory', trace ? {trace: trace} : {});
+	},
+
 	orphan_child: function(child_person_id, guardian_person_id) {
 		if (window.confirm("Are you sure you want to delete that record?")) { // NOTE: duplicates window.confirm above; DRY consolidate?!
 			admin.send_ws('orphan_child', {child_person_id: child_person_id, guardian_person_id: guardian_person_id});
@@ -73,6 +73,10 @@ let assignments = {
 		document.body.innerHTML = content;
 	},
 
+	append_assignments_print: function(content) { // a week at a time (see assignments._stream_assignments_print(), server-side)
+		document.body.firstElementChild.insertAdjacentHTML('beforeend', content);
+	},
+
 	// From client side:
 
 	mark_complete: function(assignment_id, enrollment_id, checkbox) {
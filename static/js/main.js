@@ -11,6 +11,7 @@ if ("virtualKeyboard" in navigator) {
 $('dialog').addEventListener('close', () => {
 	const video = $('dialog_video');
 	if (video) {
+		player.stop();
 		video.pause();
 	}
 });
@@ -82,3 +83,11 @@ function clear_filtersearch() {
 function set_topbar_color(color) {
 	$('topbar_container').style.backgroundColor = color;
 }
+
+function download(filename, text) {
+	const a = document.createElement('a');
+	a.href = URL.createObjectURL(new Blob([text], {type: 'text/plain'}));
+	a.download = filename;
+	a.click();
+	setTimeout(() => URL.revokeObjectURL(a.href), 1000); // (after the download has started)
+}
@@ -6,12 +6,15 @@ const t_message_deferred = 'Message marked "UNREAD" (and moved to "Unread")';
 const t_message_pinned = 'Message PINNED (find in "Pins" now)';
 const t_pin = 'Pin this message' // TODO: this has a duplicate in text.py
 const t_unpin = 'UNpin this message' // TODO: this has a duplicate in text.py
+const t_open_pdf = 'Open the whole PDF'
+const t_pdf_unavailable = 'Sorry, this PDF can\'t be shown here right now; try opening the whole PDF, instead.'
 
 const h_message_stashed = '<div class="info fadeout_short">' + t_message_stashed + '</div>';
 const h_message_deferred = '<div class="info fadeout_short">' + t_message_deferred + '</div>';
 const h_message_pinned = '<div class="info fadeout_short">' + t_message_pinned + '</div>';
 
 let g_playing = null;
+let g_render = {text: {}}; // texts and media details for render_messages(), et al. (sent once, by the server - see fast_html.k_render_config)
 
 let g_accept_injected_messages_at_bottom = false;
 let g_forced_scroll = false;
@@ -209,7 +212,13 @@ let messages = {
 		messages.send_ws('unpin', {message_id: message_id});
 		button.classList.remove('selected');
 		button.setAttribute('title', t_pin);
-		button.setAttribute('onclick', "messages.pin(" + message_id + ", this)");
+		button.setAttribute('onclick', messages._pin_onclick(message_id, button));
+	},
+
+	_pin_onclick: function(message_id, button) {
+		// The same as the initial render's (see _render_message(), and fast_html/html.message()): stashable iff the message has a stash button
+		const stashable = button.parentElement.querySelector('button[onclick^="messages.stash("]') != null;
+		return 'messages.pin(' + message_id + ', this, ' + (stashable ? 'true' : 'false') + ')';
 	},
 
 
@@ -351,6 +360,183 @@ let messages = {
 		messages.time_updater ??= setInterval(messages._update_times, 10000); // AND, if not already set for 10-second intervals, do so...
 	},
 
+	// Client-side rendering, of JSON records (see messages._send_messages(), server-side); these mirror fast_html's message and inline-reply-box templates
+	set_render_config: function(config) {
+		g_render = config;
+	},
+
+	render_messages: function(records, context) {
+		let top = [];
+		let nodes = {}; // message id -> node
+		let patriarch = context.patriarch;
+		for (const r of records) {
+			let node;
+			if (Object.hasOwn(r, 'draft')) {
+				patriarch = r.patriarch;
+				node = {head: messages._reply_box_head(r), replies: []};
+			}
+			else {
+				[patriarch, node] = messages._render_message(r, context, patriarch);
+			}
+			const parent = nodes[r.reply_to];
+			(parent ? parent.replies : top).push(node);
+			nodes[r.id] = node;
+		}
+		return '<div class="container">' + top.map(messages._join).join('') + '</div>';
+	},
+
+	render_message: function(record, context) {
+		return messages._join(messages._render_message(record, context, context.patriarch)[1]);
+	},
+
+	_join: node => node.head + node.replies.map(messages._join).join('') + '</div>',
+
+	_esc: s => String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;'),
+
+	_button: function(icon, title, onclick, attrs = '') {
+		return '<button' + attrs + ' onclick="' + messages._esc(onclick) + '" title="' + messages._esc(title) + '"><i class="i ' + icon + '"></i></button>';
+	},
+
+	_render_message: function(r, c, patriarch) {
+		const t = g_render.text;
+		const b = messages._button;
+		const bumper = '<div class="bumper"></div>';
+		const mid = r.id;
+		const editable = r.sender_id == c.uid || c.admin;
+		let hr = null;
+		if (c.skip_first_hr && patriarch == null) {
+			patriarch = r.patriarch;
+		}
+		else if (r.patriarch == patriarch) {
+			hr = '<hr class="gray">';
+		}
+		else {
+			hr = '<hr>';
+			patriarch = r.patriarch;
+		}
+		const continuation = hr == '<hr class="gray">';
+		let h = '<div class="container' + (c.injection ? ' injection' : '') + (c.whole_thread ? ' bluish' : '') + '" id="message_' + mid + '">';
+		h += hr || '';
+		if (r.reply_to && !continuation) {
+			h += '<div class="italic">Reply to &quot;' + messages._esc(r.teaser) + '...&quot;:</div>';
+		}
+		if (r.edited) {
+			h += '<div class="italic bold">' + messages._esc(t.edited) + ':</div>';
+		}
+		h += '<div>' + r.message + '</div>'; // (already html - link-substituted, server-side)
+		if (r.attachments) {
+			h += '<div id="attachments_for_message_' + mid + '">' + messages._thumbnail_strip(r.attachments) + '</div>';
+		}
+		h += '<div class="buttonbar">';
+		if (c.stashable) {
+			h += b('i-ok', t.stash, 'messages.stash(' + mid + ')') + bumper;
+		}
+		if (c.deferrable) {
+			h += b('i-defer', t.defer, 'messages.defer(' + mid + ')') + bumper;
+		}
+		h += (r.pinned ? b('i-pin', t.unpin, 'messages.unpin(' + mid + ', this)', ' class="selected"') : b('i-pin', t.pin, 'messages.pin(' + mid + ', this, ' + (c.stashable ? 'true' : 'false') + ')')) + bumper;
+		if (editable) {
+			h += b('i-edit', t.edit_message, "messages.send_ws('edit_message', { message_id: " + mid + " })") + bumper;
+		}
+		h += '<div class="spacer"></div><div><span><b>by </b>' + messages._esc(r.sender) + '</span></div></div>';
+		const tags = r.tags || [];
+		let recipients = tags.slice(0, 3).join(', ') + (tags.length > 3 ? ', ...' : ''); // (see fast_html.k_max_recipients)
+		h += '<div class="buttonbar"><div class="spacer"></div>' + b('i-reply', t.reply, "messages.send_ws('compose_reply', { message_id: " + mid + " })");
+		h += '<span><b> to </b>' + (editable ? b('i-all', t.recipients, 'messages.change_recipients(' + mid + ')') : '') + messages._esc(recipients);
+		if (!c.whole_thread) {
+			h += b('i-thread', t.thread, "messages.send_ws('show_whole_thread', { message_id: " + mid + ", patriarch_id: " + r.patriarch + " })");
+		}
+		h += ' · </span><span class="time_updater" data-isodate="' + r.sent + '">' + (c.injection ? messages._esc(t.just_now) : '...') + '</span>';
+		if (editable) {
+			h += b('i-trash', t.delete_message, 'messages.delete_message(' + mid + ', false)');
+		}
+		h += '</div>';
+		return [patriarch, {head: h, replies: []}];
+	},
+
+	_reply_box_head: function(r) {
+		const t = g_render.text;
+		const b = messages._button;
+		const bumper = '<div class="bumper"></div>';
+		const mid = r.id;
+		return '<div class="container yellow_border" id="message_' + mid + '">' +
+			'<div class="edit_message_content" contenteditable="true" id="edit_message_content_' + mid + '" onblur="messages.stop_saving(' + mid + ')" onfocus="messages.start_saving(this, ' + mid + ')">' + r.draft + '</div>' +
+			'<div id="attachments_for_message_' + mid + '"></div>' +
+			'<div class="buttonbar">' +
+				b('i-attach', t.attach, 'messages.attach_upload(' + mid + ')') + bumper +
+				b('i-all', t.reply_all, 'messages.reply_recipient_one(' + mid + ')', ' id="rr_all_' + mid + '"') + bumper +
+				b('i-one', t.reply_one, 'messages.reply_recipient_all(' + mid + ')', ' class="hide" id="rr_one_' + mid + '"') + bumper +
+				b('i-send', t.send_message, 'messages.send_reply(' + mid + ', ' + r.reply_to + ", $('reply_recipient_" + mid + "').dataset.replyrecipient)") +
+				'<div class="spacer"></div>' +
+				b('i-trash', t.delete, 'messages.delete_unsent_reply_draft(' + mid + ', "' + t.delete_confirmation + '")') +
+				'<div class="hide" data-replyrecipient="A" id="reply_recipient_' + mid + '"></div>' +
+			'</div>';
+	},
+
+	_media_url: (name, variant) => '/media/v' + g_render.derivative_version + '/' + encodeURIComponent(name).replace(/[!'()*]/g, c => '%' + c.charCodeAt(0).toString(16).toUpperCase()) + '/' + variant, // (as media.url() quote()s)
+
+	_srcset: (name, fmt) => g_render.image_widths.map(w => messages._media_url(name, w + 'w.' + fmt) + ' ' + w + 'w').join(', '),
+
+	_thumbnail_strip: function(filenames) {
+		// (see fast_html._thumbnail_strip())
+		const g = g_render;
+		const esc = messages._esc;
+		let h = '<div class="thumbnail_strip">';
+		for (const name of filenames) {
+			const path = '/' + g.upload_path + name;
+			const lilname = name.toLowerCase();
+			const poster_path = path + g.thumb_appendix;
+			const thumb_url = poster_path + '?v=' + g.thumb_version; // (see media.thumb_url())
+			const img = '<img alt="' + esc(name) + '" src="' + esc(thumb_url) + '">';
+			let onclick = null;
+			if (g.video_formats.some(f => lilname.endsWith(f))) {
+				onclick = 'messages.play_video("' + path + '", "' + poster_path + (g.hls_videos ? '", "' + path + g.hls_appendix + '/master.m3u8")' : '")');
+			}
+			else if (g.image_formats.some(f => lilname.endsWith(f))) {
+				onclick = 'messages.play_image("' + path + '", "' + messages._srcset(name, 'webp') + '", "' + messages._srcset(name, 'jpg') + '")';
+				h += '<span onclick="' + esc(onclick) + '"><picture>' +
+					'<source sizes="' + esc(g.thumbnail_sizes) + '" srcset="' + esc(messages._srcset(name, 'webp')) + '" type="image/webp">' +
+					'<img alt="' + esc(name) + '" sizes="' + esc(g.thumbnail_sizes) + '" src="' + esc(thumb_url) + '" srcset="' + esc(messages._srcset(name, 'jpg')) + '">' +
+					'</picture></span>';
+				continue;
+			}
+			else if (g.pdf_formats.some(f => lilname.endsWith(f))) {
+				onclick = 'messages.play_pdf("' + path + '", "' + messages._media_url(name, '') + '")';
+			}
+			h += (onclick ? '<span onclick="' + esc(onclick) + '">' : '<span>') + img + '</span>';
+		}
+		return h + '</div>';
+	},
+
+	patch_message: function(message_id, fields) {
+		// Live update of single fields of a message already on screen (e.g., pinned on another of this user's devices)
+		if (Object.hasOwn(fields, 'pinned')) {
+			let button = document.querySelector('#message_' + message_id + ' > div.buttonbar > button[title="' + (fields.pinned ? t_pin : t_unpin) + '"]');
+			if (button) {
+				if (fields.pinned) {
+					button.classList.add('selected');
+					button.setAttribute('title', t_unpin);
+					button.setAttribute('onclick', "messages.unpin(" + message_id + ", this)");
+				}
+				else {
+					button.classList.remove('selected');
+					button.setAttribute('title', t_pin);
+					button.setAttribute('onclick', messages._pin_onclick(message_id, button));
+				}
+			}
+		}
+		if (Object.hasOwn(fields, 'edited')) {
+			const message = $('message_' + message_id);
+			const edited = message && message.querySelector(':scope > div.italic.bold');
+			if (fields.edited && message && !edited) {
+				message.querySelector(':scope > div:not(.italic)').insertAdjacentHTML('beforebegin', '<div class="italic bold">' + messages._esc(g_render.text.edited || 'Edited') + ':</div>'); // (just above the content)
+			}
+			else if (!fields.edited && edited) {
+				edited.remove();
+			}
+		}
+	},
+
 	_update_times: function() {
 		let elements = document.querySelectorAll('.time_updater');
 		elements.forEach(function(element) {
@@ -392,27 +578,56 @@ let messages = {
 		$('attachments_for_message_' + message_id).insertAdjacentHTML("beforeend", content);
 	},
 
-	play_video: function(path, poster_path) {
+	play_video: function(path, poster_path, hls_url = null) {
 		g_playing = path;
+		if (hls_url) {
+			$('dialog_contents').innerHTML = '<video controls id="dialog_video" class="media_container" poster="' + poster_path + '" width="' + Math.floor(parent.innerWidth*8/9) + '"></video>';
+			$('dialog').showModal();
+			player.play($('dialog_video'), hls_url, path); // falls back to `path` (progressive) if there's no HLS packaging (yet)
+			return;
+		}
 		$('dialog_contents').innerHTML = '<video controls id="dialog_video" class="media_container" poster="' + poster_path + '" width="' + Math.floor(parent.innerWidth*8/9) + '"><source src="' + path + '" type="video/mp4" /></video>';
 		$('dialog').showModal();
 	},
 
-	play_image: function(path) {
+	play_image: function(path, webp_srcset, jpg_srcset) {
 		g_playing = path;
-		$('dialog_contents').innerHTML = '<img src="' + path + '" width ="' + Math.floor(parent.innerWidth*8/9) + '" />';
+		const sizes = '89vw'; // keep in sync with width, below
+		$('dialog_contents').innerHTML = '<picture><source type="image/webp" srcset="' + webp_srcset + '" sizes="' + sizes + '" /><img src="' + path + '" srcset="' + jpg_srcset + '" sizes="' + sizes + '" width ="' + Math.floor(parent.innerWidth*8/9) + '" /></picture>';
 		$('dialog').showModal();
 	},
 
-	play_pdf: function(path) {
+	play_pdf: function(path, pages_url) {
+		// Page-at-a-time viewer, of (server-rendered, cached) page images; the whole PDF is just a link (or the download button) away
 		g_playing = path;
 		const width = Math.floor(parent.innerWidth*8/9);
-		const height = Math.floor(parent.innerHeight*8/9);
-		$('dialog_contents').innerHTML = '<object data="' + path + '" type="application/pdf" width="' + width + '" height="' + height + '"><embed src="' + path + '" width ="' + width + '" height = "' + height + '" /> <p>This browser does not support PDFs. Please download the PDF to view it: <a href="' + path + '">Download (click) here</a></p></object>';
-		// thanks http://jsgyan.blogspot.com/2017/12/how-to-display-pdf-in-html-web-page.html
+		$('dialog_contents').innerHTML = '<div><button id="pdf_prev" onclick="messages.pdf_page(-1)">&lt;</button> <span id="pdf_page_number"></span> <button id="pdf_next" onclick="messages.pdf_page(1)">&gt;</button> <a target="_blank" rel="noopener noreferrer" href="' + path + '">' + t_open_pdf + '</a></div><img id="pdf_page" class="media_container" width="' + width + '" />';
+		const img = $('pdf_page');
+		img.dataset.pages_url = pages_url;
+		img.onerror = () => { // (past the last page, the server 404s - or it couldn't render this page)
+			const page = parseInt(img.dataset.page);
+			if (page == 1) { // nothing to fall back to (and retrying would just fail again) - show the error, instead
+				img.replaceWith(Object.assign(document.createElement('div'), {className: 'error', innerText: t_pdf_unavailable}));
+				$('pdf_prev').disabled = $('pdf_next').disabled = true;
+				return;
+			}
+			img.dataset.end = page; // (so that next stays disabled from here on)
+			messages.pdf_page(-1);
+		};
+		messages.pdf_page(0, 1);
 		$('dialog').showModal();
 	},
 
+	pdf_page: function(delta, page = null) {
+		const img = $('pdf_page');
+		page = page || Math.max(1, parseInt(img.dataset.page) + delta);
+		img.dataset.page = page;
+		img.src = img.dataset.pages_url + 'p' + page + '.jpg';
+		$('pdf_page_number').innerText = page;
+		$('pdf_prev').disabled = page == 1;
+		$('pdf_next').disabled = img.dataset.end && page + 1 >= parseInt(img.dataset.end);
+	},
+
 	download: function() {
 		if (g_playing != null) {
 			const anchor = document.createElement('a');
@@ -1,18 +1,25 @@
 
+const k_page_id = crypto.randomUUID(); // this page (load); a reconnection (see ws.js) keeps it, so that the server can resume the page's session
+
 ws.onopen = function(event) {
 	identify();
+	ws_resumed();
 }
 
 function identify(force = false) {
 	let task = {
 		task: "identify",
-		idid: localStorage.getItem("idid")
+		idid: localStorage.getItem("idid"),
+		json_messages: true, // we can render messages from JSON records (see messages.render_messages()), if the server cares to send them that way
+		tz: Intl.DateTimeFormat().resolvedOptions().timeZone, // (the server renders dates in this, unless the user has a preference)
+		page_id: k_page_id
 	};
 	const key = localStorage.getItem("key");
 	if (task.idid && key && !force && initial == '') { // `initial` is a global const assigned at top, with ws itself; normally '' (empty string)
 		// existing identity:
 		task.pub = crypto.randomUUID();
 		task.hsh = sha256(key + task.pub);
+		task.resume = g_ws_resuming; // (a reconnection - we still show what we did; see sessions.resume())
 	}
 	else {
 		// new identity:
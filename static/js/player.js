@@ -0,0 +1,174 @@
+// Minimal HLS (fMP4, VOD) player, over Media Source Extensions - just enough for the playlists that media.package_hls() makes.
+// Safari (and iOS) play HLS natively; browsers with neither get the progressive mp4.
+
+const k_player_buffer_ahead = 30; // seconds to keep buffered ahead of the playhead
+
+let g_player = null; // the one active playback (there's only one dialog)
+
+let player = {
+	play: async function(video, hls_url, fallback_url) {
+		player.stop();
+		if (video.canPlayType('application/vnd.apple.mpegurl')) {
+			video.src = hls_url;
+			return video.play();
+		}
+		if (!window.MediaSource) {
+			return player._fallback(video, fallback_url);
+		}
+		const p = g_player = {video: video, segments: [], next: 0, busy: false, stopped: false};
+		try {
+			const rendition = player._choose(await player._fetch_text(hls_url), hls_url);
+			const playlist = player._parse(await player._fetch_text(rendition.url), rendition.url);
+			if (!MediaSource.isTypeSupported(rendition.type)) {
+				throw 'unsupported type: ' + rendition.type;
+			}
+			p.segments = playlist.segments;
+			p.ms = new MediaSource();
+			video.src = URL.createObjectURL(p.ms);
+			await new Promise(resolve => p.ms.addEventListener('sourceopen', resolve, {once: true}));
+			p.sb = p.ms.addSourceBuffer(rendition.type);
+			p.ms.duration = playlist.duration;
+			await player._append(p, await player._fetch_bytes(playlist.init));
+			p.feed = () => player._feed(p);
+			video.addEventListener('timeupdate', p.feed);
+			video.addEventListener('seeking', p.seek = () => {
+				p.next = player._segment_at(p, video.currentTime);
+				p.feed();
+			});
+			await player._feed(p); // first segment...
+			video.play(); // ...and go; the rest streams in behind the playhead, k_player_buffer_ahead at a time
+		}
+		catch (error) {
+			console.log('HLS playback failed (' + error + '); falling back to ' + fallback_url);
+			if (!p.stopped) {
+				player.stop();
+				player._fallback(video, fallback_url);
+			}
+		}
+	},
+
+	stop: function() {
+		const p = g_player;
+		if (p) {
+			p.stopped = true;
+			if (p.feed) {
+				p.video.removeEventListener('timeupdate', p.feed);
+				p.video.removeEventListener('seeking', p.seek);
+			}
+			g_player = null;
+		}
+	},
+
+	_fallback: function(video, url) {
+		video.src = url;
+		return video.play();
+	},
+
+	_choose: function(master, base) {
+		// Pick the smallest rendition at least as wide as the (physical) screen, else the largest there is:
+		let renditions = [];
+		const lines = master.split('\n');
+		for (let i = 0; i < lines.length; i++) {
+			if (lines[i].startsWith('#EXT-X-STREAM-INF:')) {
+				const resolution = lines[i].match(/RESOLUTION=(\d+)x(\d+)/);
+				const codecs = lines[i].match(/CODECS="([^"]+)"/);
+				renditions.push({
+					width: resolution ? parseInt(resolution[1]) : 0,
+					type: 'video/mp4; codecs="' + (codecs ? codecs[1] : 'avc1.4d401f,mp4a.40.2') + '"',
+					url: new URL(lines[++i].trim(), base).href,
+				});
+			}
+		}
+		renditions.sort((a, b) => a.width - b.width);
+		const want = screen.width * (window.devicePixelRatio || 1);
+		return renditions.find(r => r.width >= want) || renditions[renditions.length - 1];
+	},
+
+	_parse: function(playlist, base) {
+		let result = {init: null, segments: [], duration: 0};
+		let duration = 0;
+		for (const line of playlist.split('\n')) {
+			if (line.startsWith('#EXT-X-MAP:')) {
+				result.init = new URL(line.match(/URI="([^"]+)"/)[1], base).href;
+			}
+			else if (line.startsWith('#EXTINF:')) {
+				duration = parseFloat(line.substring(8));
+			}
+			else if (line && !line.startsWith('#')) {
+				result.segments.push({url: new URL(line.trim(), base).href, start: result.duration, end: result.duration + duration});
+				result.duration += duration;
+			}
+		}
+		return result;
+	},
+
+	_segment_at: function(p, time) {
+		const i = p.segments.findIndex(s => time < s.end);
+		return i < 0 ? p.segments.length : i;
+	},
+
+	_feed: async function(p) {
+		if (p.busy || p.stopped) {
+			return;
+		}
+		p.busy = true;
+		try {
+			while (!p.stopped && p.next < p.segments.length && p.segments[p.next].start < p.video.currentTime + k_player_buffer_ahead) {
+				const i = p.next++;
+				if (!player._buffered(p, p.segments[i])) {
+					if (p.video.currentTime > 2 * k_player_buffer_ahead) { // let go of what's well behind us, so long videos don't hit the SourceBuffer quota
+						await player._remove(p, 0, p.video.currentTime - k_player_buffer_ahead);
+					}
+					await player._append(p, await player._fetch_bytes(p.segments[i].url));
+				}
+			}
+			if (!p.stopped && p.next >= p.segments.length && p.ms.readyState == 'open' && !p.sb.updating) {
+				p.ms.endOfStream();
+			}
+		}
+		finally {
+			p.busy = false;
+		}
+	},
+
+	_buffered: function(p, segment) {
+		const b = p.sb.buffered;
+		for (let i = 0; i < b.length; i++) {
+			if (b.start(i) <= segment.start + 0.1 && b.end(i) >= segment.end - 0.1) {
+				return true;
+			}
+		}
+		return false;
+	},
+
+	_append: function(p, bytes) {
+		return new Promise((resolve, reject) => {
+			p.sb.addEventListener('updateend', resolve, {once: true});
+			p.sb.addEventListener('error', reject, {once: true});
+			p.sb.appendBuffer(bytes);
+		});
+	},
+
+	_remove: function(p, start, end) {
+		return new Promise(resolve => {
+			p.sb.addEventListener('updateend', resolve, {once: true});
+			p.sb.remove(start, end);
+		});
+	},
+
+	_fetch_text: async function(url) {
+		const response = await fetch(url);
+		if (!response.ok) {
+			throw response.status + ' for ' + url;
+		}
+		return response.text();
+	},
+
+	_fetch_bytes: async function(url) {
+		const response = await fetch(url);
+		if (!response.ok) {
+			throw response.status + ' for ' + url;
+		}
+		return response.arrayBuffer();
+	},
+}
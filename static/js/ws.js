@@ -46,25 +46,31 @@ ws.onmessage = function(event) {
 			messages.edit_message(payload.content, payload.message_id);
 			break;
 		case "messages":
-			messages.show_messages(payload.content, payload.scroll_to_bottom);
+			messages.show_messages(payload.content ?? messages.render_messages(payload.records, payload.context), payload.scroll_to_bottom);
 			break;
 		case "show_more_old_messages":
-			messages.show_more_old_messages(payload.content);
+			messages.show_more_old_messages(payload.content ?? messages.render_messages(payload.records, payload.context));
 			break;
 		case "show_more_new_messages":
-			messages.show_more_new_messages(payload.content);
+			messages.show_more_new_messages(payload.content ?? messages.render_messages(payload.records, payload.context));
 			break;
 		case "no_more_new_messages":
 			messages.no_more_new_messages();
 			break;
 		case "show_whole_thread":
-			messages.show_whole_thread(payload.content, payload.message_id);
+			messages.show_whole_thread(payload.content ?? messages.render_messages(payload.records, payload.context), payload.message_id);
 			break;
 		case "deliver_message_teaser":
 			messages.deliver_message_teaser(payload.teaser);
 			break;
 		case "inject_deliver_new_message":
-			messages.inject_deliver_new_message(payload.content, payload.new_mid, payload.reference_mid, payload.placement);
+			messages.inject_deliver_new_message(payload.content ?? messages.render_message(payload.records[0], payload.context), payload.new_mid, payload.reference_mid, payload.placement);
+			break;
+		case "patch_message":
+			messages.patch_message(payload.message_id, payload.fields);
+			break;
+		case "render_config":
+			messages.set_render_config(payload.config);
 			break;
 		case "remove_message":
 			messages.remove_message(payload.message_id);
@@ -87,19 +93,57 @@ ws.onmessage = function(event) {
 		case "show_assignments_print":
 			assignments.show_assignments_print(payload.content);
 			break;
+		case "append_assignments_print":
+			assignments.append_assignments_print(payload.content);
+			break;
 		case "reload":
 			window.location.href = '/';
 			break;
+		case "download":
+			download(payload.filename, payload.text);
+			break;
 		default:
 			console.log("ERROR - unknown payload task: " + payload.task);
 	}
 };
 
 
+const k_ws_retry_delays = [250, 1000, 2000, 4000, 8000]; // ms; reconnection attempts, after a dropped connection, before giving up and reloading the page
+let g_ws_retries = 0;
+let g_ws_resuming = false; // true from a dropped connection until a new one has re-identified (and so resumed; see identify())
+let g_ws_queue = []; // messages sent while not connected
+
+ws.onclose = function(event) {
+	if (g_ws_retries >= k_ws_retry_delays.length) {
+		location.reload();
+		return;
+	}
+	g_ws_resuming = true;
+	setTimeout(ws_reconnect, k_ws_retry_delays[g_ws_retries++] * (0.5 + Math.random())); // (jittered, so that a server restart's worth of clients don't all come back at once)
+};
+
+function ws_reconnect() {
+	const old = ws;
+	ws = new WebSocket(old.url);
+	ws.onopen = old.onopen;
+	ws.onmessage = old.onmessage;
+	ws.onclose = old.onclose;
+}
+
+function ws_resumed() { // called (see persistence.js) just after identify(), on each new connection
+	g_ws_retries = 0;
+	g_ws_resuming = false;
+	for (const message of g_ws_queue.splice(0)) {
+		ws.send(JSON.stringify(message));
+	}
+}
+
 function ws_send(message) {
-	if (!ws || ws.readyState == WebSocket.CLOSING || ws.readyState == WebSocket.CLOSED) {
+	if (!ws) {
 		//alert("Lost connection... going to reload page....");
 		location.reload();
+	} else if (ws.readyState != WebSocket.OPEN) {
+		g_ws_queue.push(message); // (sent once (re)connected, just after identify(); see ws_resumed())
 	} else {
 		//console.log("SENDING ws message: " + JSON.stringify(message));
 		ws.send(JSON.stringify(message));
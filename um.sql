@@ -25,7 +25,7 @@ CREATE TABLE id_key (id INTEGER PRIMARY KEY AUTOINCREMENT, idid TEXT, key TEXT U
 CREATE TABLE marriage (id INTEGER PRIMARY KEY, husband INTEGER REFERENCES person (id) ON DELETE CASCADE ON UPDATE CASCADE, wife INTEGER REFERENCES person (id) ON DELETE CASCADE ON UPDATE CASCADE);
 
 -- Table: message
-CREATE TABLE message (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT, author INTEGER REFERENCES user (id) ON DELETE RESTRICT ON UPDATE CASCADE, reply_to INTEGER REFERENCES message (id) ON DELETE CASCADE ON UPDATE CASCADE, reply_chain_patriarch INTEGER, sms INTEGER DEFAULT (0), created TEXT NOT NULL, sent TEXT, thread_updated TEXT, deleted TEXT, teaser TEXT, attachments INTEGER DEFAULT (0));
+CREATE TABLE message (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT, author INTEGER REFERENCES user (id) ON DELETE RESTRICT ON UPDATE CASCADE, reply_to INTEGER REFERENCES message (id) ON DELETE CASCADE ON UPDATE CASCADE, reply_chain_patriarch INTEGER, sms INTEGER DEFAULT (0), created TEXT NOT NULL, sent TEXT, thread_updated TEXT, deleted TEXT, teaser TEXT, attachments INTEGER DEFAULT (0), rendered TEXT, rendered_version INTEGER);
 
 -- Table: message_attachment
 CREATE TABLE message_attachment (message INTEGER REFERENCES message (id) ON DELETE CASCADE ON UPDATE CASCADE, attachment INTEGER REFERENCES attachment (id) ON DELETE CASCADE ON UPDATE CASCADE);
@@ -57,11 +57,14 @@ CREATE TABLE reset_code (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT NOT NUL
 -- Table: role
 CREATE TABLE role (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE);
 
+-- Table: session
+CREATE TABLE session (idid TEXT NOT NULL, page_id TEXT NOT NULL, snapshot TEXT NOT NULL, saved TEXT NOT NULL, PRIMARY KEY (idid, page_id));
+
 -- Table: tag
 CREATE TABLE tag (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, user REFERENCES user (id) ON DELETE CASCADE ON UPDATE CASCADE, active INTEGER NOT NULL DEFAULT (1), sms_messages INTEGER DEFAULT (0) NOT NULL, admin_only_post INTEGER DEFAULT (0) NOT NULL);
 
 -- Table: user
-CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT, person INTEGER REFERENCES person (id) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, created TEXT, verified TEXT, active INTEGER DEFAULT (0) NOT NULL);
+CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT, person INTEGER REFERENCES person (id) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, created TEXT, verified TEXT, active INTEGER DEFAULT (0) NOT NULL, timezone TEXT);
 
 -- Table: user_role
 CREATE TABLE user_role (user INTEGER REFERENCES user (id) ON DELETE CASCADE ON UPDATE CASCADE, role INTEGER REFERENCES role (id) ON DELETE CASCADE ON UPDATE CASCADE);
@@ -69,6 +72,9 @@ CREATE TABLE user_role (user INTEGER REFERENCES user (id) ON DELETE CASCADE ON U
 -- Table: user_tag
 CREATE TABLE user_tag (user INTEGER REFERENCES user (id) ON DELETE CASCADE ON UPDATE CASCADE, tag INTEGER REFERENCES tag (id) ON DELETE CASCADE ON UPDATE CASCADE);
 
+-- Index: attachment_filename
+CREATE INDEX attachment_filename ON attachment (filename);
+
 -- Index: message_pin_unique
 CREATE UNIQUE INDEX message_pin_unique ON message_pin (message, user);
 